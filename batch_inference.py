@@ -0,0 +1,296 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import argparse
+import os
+import queue
+import threading
+import time
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import torch
+import torchvision.transforms
+from PIL import Image
+
+from export import load_runner
+from unet import UNet_2D
+from runtime import select_device, configure_runtime, load_state_dict
+from tiling import check_overlap, tiled_inference
+from defects import defect_regions
+
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.bmp')
+
+
+#-----------------------------------------------------------------------#
+#                            load_model                                 #
+#  Build the UNet_2D used by the GUI, load its parameters and fuse it   #
+#  for inference. A model exported by export.py (.onnx or .ts) is       #
+#  loaded with load_runner, and for a parameter file the exports of the #
+#  same name are preferred when they are newer than it, so a retrained  #
+#  model.pt is never shadowed.                                          #
+#-----------------------------------------------------------------------#
+def load_model(path, device, use_export=True):
+    stem, ext = os.path.splitext(path)
+    if ext in ('.onnx', '.ts'):
+        return load_runner(path, device)
+    if use_export:
+        for exported in (stem + '.onnx', stem + '.ts'):
+            if os.path.exists(exported) and os.path.getmtime(exported) >= os.path.getmtime(path):
+                return load_runner(exported, device)
+    model = UNet_2D(1, 1, 32, 0.2)
+    model.load_state_dict(load_state_dict(path, device))
+    return model.to(device).fuse_for_inference()
+
+
+#-----------------------------------------------------------------------#
+#                          list_image_files                             #
+#   Expand directories and glob patterns into a sorted list of images   #
+#-----------------------------------------------------------------------#
+def list_image_files(inputs, extensions=IMAGE_EXTENSIONS):
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = glob(os.path.join(item, '*'))
+        else:
+            candidates = glob(item, recursive=True)
+        files += [f for f in candidates
+                  if os.path.isfile(f) and os.path.splitext(f)[1].lower() in extensions]
+    return sorted(set(files))
+
+
+#-----------------------------------------------------------------------#
+#                          mask_file_names                              #
+#  Path of the png mask of each image in output_dir, named after the    #
+#  image. Images of the same name in different directories keep their  #
+#  path relative to the common directory, and the extension is kept     #
+#  when two images only differ by it.                                   #
+#-----------------------------------------------------------------------#
+def mask_file_names(image_files, output_dir):
+    names = [os.path.basename(f) for f in image_files]
+    if len(set(os.path.splitext(name)[0] for name in names)) < len(names):
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in image_files])
+        names = [os.path.relpath(os.path.abspath(f), root) for f in image_files]
+    stems = [os.path.splitext(name)[0] for name in names]
+    if len(set(stems)) < len(stems):
+        stems = names
+    return {f: os.path.join(output_dir, stem + '.png') for f, stem in zip(image_files, stems)}
+
+
+#-----------------------------------------------------------------------#
+#                    preprocess_image / postprocess_mask                #
+#  Same conversions as MainWindow.doSegmentation: grayscale, resize to  #
+#  the network input size, and nearest upsampling of the binary mask.   #
+#-----------------------------------------------------------------------#
+def preprocess_image(image, input_size=(320, 480)):
+    """
+    Args:
+        image:      image in PIL
+        input_size: (height, width) of the network input
+    Returns:
+        (1, height, width) float tensor in [0, 1]
+    """
+    image = image.convert('L')
+    image = torchvision.transforms.Resize(input_size)(image)
+    return torchvision.transforms.ToTensor()(image)
+
+
+def postprocess_mask(output, size, threshold=0.5):
+    """
+    Args:
+        output:    (height, width) array of defect probabilities
+        size:      (width, height) of the original image
+        threshold: threshold value to create the binary mask
+    Returns:
+        binary mask in PIL ('L', 0 or 255) at the original size
+    """
+    mask = Image.fromarray(((output > threshold) * 255).astype(np.uint8))
+    return mask.resize(size, Image.NEAREST)
+
+
+#-----------------------------------------------------------------------#
+#                        run_batch_inference                            #
+#  Stream images through the model with a producer/consumer pipeline:   #
+#  loader threads decode and resize, the calling thread batches and     #
+#  runs the forward pass, and writer threads upsample and encode the    #
+#  png masks. The bounded queues keep the memory use constant.          #
+#-----------------------------------------------------------------------#
+# image_files: list of image paths                                      #
+# model:       UNet_2D in eval mode, on device                          #
+# output_dir:  directory to write the binary png masks to               #
+# batch_size:  number of images per forward pass                        #
+# num_loaders, num_writers: number of decoding and encoding threads     #
+# tiled:       run tiled_inference on the full resolution images        #
+#              instead of resizing them to input_size                   #
+# overlap, tile_batch_size: tiled_inference settings                    #
+# defects_file: csv to write the defect_regions of every mask to, one   #
+#              row per defect, in pixels of the image                   #
+# pix_per_mm:  scale of the images, adds the defect geometry in mm      #
+# Returns a DataFrame with one row of defect statistics per image       #
+#-----------------------------------------------------------------------#
+def run_batch_inference(image_files, model, device, output_dir, batch_size=8,
+                        threshold=0.5, input_size=(320, 480), num_loaders=2, num_writers=2,
+                        tiled=False, overlap=(64, 96), tile_batch_size=4, defects_file=None,
+                        pix_per_mm=None):
+    if tiled:
+        check_overlap(input_size, overlap)
+    os.makedirs(output_dir, exist_ok=True)
+    path_queue = queue.Queue()
+    for path in image_files:
+        path_queue.put(path)
+    load_queue = queue.Queue(maxsize=2 * batch_size)
+    save_queue = queue.Queue(maxsize=2 * batch_size)
+    summary = []
+    defects = []
+
+    mask_files = mask_file_names(image_files, output_dir)
+
+    # a failed image is recorded in the summary, it must not stop its thread: the
+    # calling thread waits for the end of every loader, and the writers drain save_queue
+    def loader():
+        try:
+            while True:
+                try:
+                    path = path_queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    with Image.open(path) as image:
+                        size = image.size
+                        if tiled:
+                            input = torchvision.transforms.functional.to_tensor(image.convert('L'))[0]
+                        else:
+                            input = preprocess_image(image, input_size)
+                except Exception as e:
+                    summary.append(dict(file=path, error=str(e) or type(e).__name__))
+                    continue
+                load_queue.put((path, size, input))
+        finally:
+            load_queue.put(None)
+
+    def writer():
+        while True:
+            item = save_queue.get()
+            if item is None:
+                break
+            path, size, output = item
+            mask_file = mask_files[path]
+            try:
+                mask = postprocess_mask(output, size, threshold)
+                os.makedirs(os.path.dirname(mask_file), exist_ok=True)
+                mask.save(mask_file)
+                mask = np.asarray(mask)
+                regions = defect_regions(mask, pix_per_mm)
+            except Exception as e:
+                summary.append(dict(file=path, error=str(e) or type(e).__name__))
+                continue
+            defect_pixels = int(np.count_nonzero(mask))
+            summary.append(dict(file=path, mask=mask_file, width=size[0], height=size[1],
+                                defect_pixels=defect_pixels,
+                                defect_ratio=defect_pixels / (size[0] * size[1]),
+                                defects=len(regions), max_probability=float(output.max())))
+            if defects_file is not None and len(regions):
+                regions.insert(0, 'file', path)
+                defects.append(regions)
+
+    loaders = [threading.Thread(target=loader, daemon=True) for _ in range(num_loaders)]
+    writers = [threading.Thread(target=writer, daemon=True) for _ in range(num_writers)]
+    for t in loaders + writers:
+        t.start()
+
+    start = time.perf_counter()
+    running = num_loaders
+    batch = []
+    with torch.no_grad():
+        while running:
+            item = load_queue.get()
+            if item is None:
+                running -= 1
+            elif tiled:
+                # the tiles of one image already make up the batches
+                path, size, input = item
+                output = tiled_inference(model, input, device, input_size, overlap,
+                                         tile_batch_size)
+                save_queue.put((path, size, output))
+            else:
+                batch.append(item)
+            if len(batch) == batch_size or (batch and not running):
+                input = torch.stack([b[2] for b in batch]).to(device)
+                output = model(input).squeeze(1).cpu().numpy()
+                for (path, size, _), o in zip(batch, output):
+                    save_queue.put((path, size, o))
+                batch = []
+
+    for _ in writers:
+        save_queue.put(None)
+    for t in loaders + writers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    n_done = sum('error' not in s for s in summary)
+    print(f'{n_done} images in {elapsed:.2f} s, {n_done / elapsed:.2f} images/s')
+    df = pd.DataFrame.from_records(summary, columns=['file', 'mask', 'width', 'height',
+                                                     'defect_pixels', 'defect_ratio', 'defects',
+                                                     'max_probability', 'error'])
+    df = df.astype({'width': 'Int64', 'height': 'Int64', 'defect_pixels': 'Int64',
+                    'defects': 'Int64'})
+    if defects_file is not None:
+        columns = ['file'] + list(defect_regions(np.zeros((1, 1)), pix_per_mm).columns)
+        defects = pd.concat(defects) if defects else pd.DataFrame(columns=columns)
+        defects.sort_values(['file', 'defect'], ignore_index=True).to_csv(defects_file,
+                                                                          index=False)
+    return df.sort_values('file', ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Detect defects in a directory or glob of backlight images.')
+    parser.add_argument('inputs', nargs='+', help='image directories or glob patterns')
+    parser.add_argument('--model', default='model.pt',
+                        help='model parameter file, or a model exported by export.py')
+    parser.add_argument('--eager', action='store_true',
+                        help='run UNet_2D even when an up-to-date exported model exists')
+    parser.add_argument('--output', default='masks', help='directory of the png masks')
+    parser.add_argument('--summary', default=None,
+                        help='defect summary csv, defaults to <output>/summary.csv')
+    parser.add_argument('--defects', default=None,
+                        help='csv of the geometry of every defect, defaults to '
+                             '<output>/defects.csv')
+    parser.add_argument('--pix-per-mm', type=float, default=None,
+                        help='image scale, to report the defect geometry in mm')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--loaders', type=int, default=2, help='number of decoding threads')
+    parser.add_argument('--writers', type=int, default=2, help='number of encoding threads')
+    parser.add_argument('--tiled', action='store_true',
+                        help='detect on overlapping tiles of the full resolution images')
+    parser.add_argument('--overlap', type=int, nargs=2, default=[64, 96],
+                        metavar=('HEIGHT', 'WIDTH'), help='overlap between tiles')
+    parser.add_argument('--tile-batch-size', type=int, default=4,
+                        help='number of tiles per forward pass')
+    parser.add_argument('--device', default=None,
+                        help='cuda, mps or cpu, the fastest available by default')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='intra-op threads on CPU, all available cores by default')
+    args = parser.parse_args()
+
+    try:
+        check_overlap((320, 480), args.overlap)
+    except ValueError as e:
+        parser.error(f'--overlap: {e}')
+    image_files = list_image_files(args.inputs)
+    if not image_files:
+        parser.error('no image found in ' + ', '.join(args.inputs))
+    device = configure_runtime(select_device(args.device), args.threads)
+    model = load_model(args.model, device, use_export=not args.eager)
+
+    df = run_batch_inference(image_files, model, device, args.output,
+                             batch_size=args.batch_size, threshold=args.threshold,
+                             num_loaders=args.loaders, num_writers=args.writers,
+                             tiled=args.tiled, overlap=tuple(args.overlap),
+                             tile_batch_size=args.tile_batch_size,
+                             defects_file=args.defects or os.path.join(args.output, 'defects.csv'),
+                             pix_per_mm=args.pix_per_mm)
+    df.to_csv(args.summary or os.path.join(args.output, 'summary.csv'), index=False)
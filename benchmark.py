@@ -0,0 +1,775 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+# The GUI suites are in benchmark_gui, the other suites run without Qt. #
+#-----------------------------------------------------------------------#
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from glob import glob
+import numpy as np
+from scipy import ndimage
+import pandas as pd
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from defects import defect_regions, EIGHT_CONNECTED
+from unet import UNet_2D
+from runtime import select_device, configure_runtime, load_state_dict
+from dataset import DefectDetectionDataset, make_loader
+from loss import WeightedBCELoss, TverskyLoss, WeightedBCEWithLogitsLoss, TverskyWithLogitsLoss
+from train import train_2D, train_step
+from transforms import BatchAugmentation
+from metrics import performance_metrics
+
+
+#-----------------------------------------------------------------------#
+#                              timeit                                   #
+#      Return the best wall time (s) of fn() over some repetitions      #
+#-----------------------------------------------------------------------#
+def timeit(fn, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+#-----------------------------------------------------------------------#
+#                          benchmark_defects                            #
+#  Time defect_regions against measuring the labeled components one by  #
+#  one, on masks of random disks at several resolutions. The loop only  #
+#  measures the moments and boxes, defect_regions also skeletonizes the #
+#  defects for their lengths and widths.                                #
+#-----------------------------------------------------------------------#
+# sizes:     (width, height) pairs to test                              #
+# n_defects: number of disks drawn, touching disks merge                #
+#-----------------------------------------------------------------------#
+def _loop_defect_regions(mask):
+    labels, _ = ndimage.label(mask, structure=EIGHT_CONNECTED)
+    rows = []
+    for i, box in enumerate(ndimage.find_objects(labels), 1):
+        y, x = np.nonzero(labels[box] == i)
+        y, x = y + box[0].start, x + box[1].start
+        cov = np.cov(np.vstack([x, y]), bias=True) + np.eye(2) / 12
+        minor, major = 4 * np.sqrt(np.maximum(np.linalg.eigvalsh(cov), 0))
+        rows.append((len(x), box[1].start, box[0].start, box[1].stop - box[1].start,
+                     box[0].stop - box[0].start, x.mean(), y.mean(), major, minor))
+    return rows
+
+
+def _random_disks(size, n_defects, radius=4, seed=0):
+    w, h = size
+    rng = np.random.default_rng(seed)
+    centres = np.zeros((h, w), dtype=bool)
+    centres[rng.integers(0, h, n_defects), rng.integers(0, w, n_defects)] = True
+    yy, xx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    return ndimage.binary_dilation(centres, structure=yy ** 2 + xx ** 2 <= radius ** 2)
+
+
+def benchmark_defects(sizes=((480, 320), (1600, 1200), (3840, 2160)), n_defects=(10, 1000, 5000)):
+    records = []
+    for w, h in sizes:
+        for n in n_defects:
+            mask = _random_disks((w, h), n)
+            n_found = len(defect_regions(mask))
+            t_vec = timeit(lambda: defect_regions(mask))
+            t_loop = timeit(lambda: _loop_defect_regions(mask), repeat=1)
+            records.append((f'{w}x{h}', n_found, t_vec * 1e3, t_loop * 1e3, t_loop / t_vec))
+            print(f'{w}x{h}, {n_found:5d} defects: vectorized {t_vec * 1e3:8.2f} ms, '
+                  f'loop {t_loop * 1e3:9.2f} ms')
+
+    return pd.DataFrame.from_records(records, columns=['size', 'defects', 'vectorized_ms',
+                                                       'loop_ms', 'speedup'])
+
+
+#-----------------------------------------------------------------------#
+#                        benchmark_augmentation                         #
+#  Time the per-sample PIL augmentation of DefectDetectionDataset       #
+#  against BatchAugmentation of the collated uint8 batch, for gray and  #
+#  color images of the cached size.                                     #
+#-----------------------------------------------------------------------#
+def benchmark_augmentation(batch_size=16, size=(320, 480), device='cpu'):
+    records = []
+    rng = np.random.default_rng(0)
+    dataset = DefectDetectionDataset([], 'train', output_size=size)
+    masks = (rng.random((batch_size, 1) + size) > 0.9).astype(np.uint8) * 255
+    for kind in ['gray', 'color']:
+        augment = BatchAugmentation(gray=kind == 'gray')
+        images = rng.integers(0, 256, (batch_size, 3) + size, dtype=np.uint8)
+        if kind == 'gray':
+            images[:, 1:] = images[:, :1]
+        pairs = [(Image.fromarray(i.transpose(1, 2, 0)), Image.fromarray(m[0]))
+                 for i, m in zip(images, masks)]
+        t_pil = timeit(lambda: [dataset.transform(i, m, 'train') for i, m in pairs])
+        batch = torch.from_numpy(images).to(device), torch.from_numpy(masks).to(device)
+        t_batch = timeit(lambda: augment(*batch))
+        records.append((kind, batch_size, t_pil * 1e3, t_batch * 1e3, t_pil / t_batch))
+        print(f'{kind:>5} batch of {batch_size}: PIL {t_pil * 1e3:8.2f} ms, '
+              f'batched {t_batch * 1e3:8.2f} ms')
+
+    return pd.DataFrame.from_records(records, columns=['images', 'batch_size', 'pil_ms',
+                                                       'batched_ms', 'speedup'])
+
+
+#-----------------------------------------------------------------------#
+#                         benchmark_loader                              #
+#  Training throughput in samples/s of the data path alone (loading,    #
+#  transfer and batch augmentation), of the model alone (training steps #
+#  on one repeated batch), and of both together. The slower of the two  #
+#  first rates is the bottleneck of the training loop.                  #
+#-----------------------------------------------------------------------#
+# loader:          DataLoader of a batch_transform dataset              #
+# batch_transform: BatchAugmentation applied on the device              #
+# n_batches:       batches timed per stage, after one warm-up batch     #
+#-----------------------------------------------------------------------#
+def benchmark_loader(loader, model, device, batch_transform, n_batches=20):
+    criterion = TverskyLoss(1e-10, 0.3, .7)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0001)
+    model.train()
+
+    def batches():
+        # endless iteration, restarting the (persistent) workers at each epoch
+        while True:
+            for data, target in loader:
+                data = data.to(device, non_blocking=True)
+                target = target.to(device, non_blocking=True)
+                yield batch_transform(data, target)
+
+    def step(data, target):
+        train_step(model, optimizer, criterion, data, target)
+
+    def rate(next_batch, train):
+        # one warm-up batch, then n_batches timed
+        samples = 0
+        for i in range(n_batches + 1):
+            if i == 1:
+                start = time.perf_counter()
+            data, target = next_batch()
+            if train:
+                step(data, target)
+            samples += data.shape[0] if i else 0
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return samples / (time.perf_counter() - start)
+
+    stream = batches()
+    batch = next(stream)
+    rates = {
+        'data': rate(lambda: next(stream), train=False),
+        'model': rate(lambda: batch, train=True),
+        'data+model': rate(lambda: next(stream), train=True),
+    }
+    bottleneck = 'data' if rates['data'] < rates['model'] else 'model'
+    for stage, samples_per_s in rates.items():
+        print(f'{stage:>10}: {samples_per_s:8.2f} samples/s')
+    print(f'bottleneck: {bottleneck}')
+    return pd.DataFrame.from_records(list(rates.items()), columns=['stage', 'samples_per_s'])
+
+
+#-----------------------------------------------------------------------#
+#                        check_fast_training                            #
+#  Train the same initial UNet_2D with the same random draws in float32 #
+#  and in the fast mode of train_2D (mixed precision, channels_last),   #
+#  and compare the epoch time and the final validation Tversky loss.    #
+#-----------------------------------------------------------------------#
+# loaders:          loaders of batch_transform datasets                 #
+# batch_transforms: train_2D batch transforms                           #
+# tolerance:        largest accepted difference of the final losses     #
+# Returns the summary DataFrame and the list of failures                #
+#-----------------------------------------------------------------------#
+def check_fast_training(loaders, batch_transforms, device, model_kwargs=None, n_epochs=2,
+                        tolerance=0.02):
+    model_kwargs = model_kwargs or dict(in_channels=1, out_channels=1, init_features=32,
+                                        dropout_p=0.2)
+    torch.manual_seed(0)
+    initial = UNet_2D(**model_kwargs).state_dict()
+    records = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode, fast in [('float32', False), ('fast', True)]:
+            model = UNet_2D(**model_kwargs)
+            model.load_state_dict(initial)
+            model.to(device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.0001)
+            losses = []
+            torch.manual_seed(1)
+            start = time.perf_counter()
+            train_2D(n_epochs, loaders, model, optimizer, TverskyLoss(1e-10, 0.3, .7), device,
+                     os.path.join(tmp, mode + '.pt'),
+                     on_epoch=lambda epoch, train_loss, valid_loss: losses.append(valid_loss),
+                     batch_transforms=batch_transforms, amp=fast, channels_last=fast,
+                     history_path=os.path.join(tmp, mode + '.csv'))
+            epoch_s = (time.perf_counter() - start) / n_epochs
+            records.append((mode, epoch_s, losses[-1]))
+
+    summary = pd.DataFrame.from_records(records, columns=['mode', 'epoch_s', 'valid_loss'])
+    difference = abs(summary['valid_loss'][1] - summary['valid_loss'][0])
+    failures = []
+    if difference > tolerance:
+        failures.append(f'final validation loss differs by {difference:.4f} '
+                        f'from float32 (tolerance {tolerance})')
+    return summary, failures
+
+
+#-----------------------------------------------------------------------#
+#                            layer_flops                                #
+#    Floating point operations of one call of a leaf module, counting   #
+#    a multiply-accumulate as 2 operations                              #
+#-----------------------------------------------------------------------#
+def layer_flops(module, input, output):
+    x = input[0]
+    if isinstance(module, nn.Conv2d):
+        kernel = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        flops = 2 * output.numel() * kernel
+        if module.bias is not None:
+            flops += output.numel()
+        return flops
+    if isinstance(module, nn.ConvTranspose2d):
+        kernel = module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        flops = 2 * x.numel() * kernel
+        if module.bias is not None:
+            flops += output.numel()
+        return flops
+    if isinstance(module, nn.BatchNorm2d):
+        # a scale and a shift per element at inference
+        return 2 * output.numel()
+    if isinstance(module, nn.SiLU):
+        # x * sigmoid(x): exp, add, div and mul
+        return 4 * output.numel()
+    if isinstance(module, nn.MaxPool2d):
+        return x.numel()
+    return 0
+
+
+#-----------------------------------------------------------------------#
+#                           profile_layers                              #
+#   Run one forward pass and record FLOPs, wall time, output size and   #
+#   number of calls of every leaf module. Modules shared by several     #
+#   call sites (pool, dropout) are summed over their calls.             #
+#-----------------------------------------------------------------------#
+# model:  network to profile, it is put in eval mode                    #
+# input:  input tensor, on the same device as model                     #
+# repeat: number of forward passes, the best time per layer is kept     #
+#-----------------------------------------------------------------------#
+def profile_layers(model, input, repeat=3):
+    model.eval()
+    stats = {}
+    starts = {}
+    handles = []
+    sync = torch.cuda.synchronize if input.is_cuda else (lambda: None)
+
+    def pre_hook(module, input):
+        sync()
+        starts[module] = time.perf_counter()
+
+    def hook(module, input, output):
+        sync()
+        elapsed = time.perf_counter() - starts[module]
+        s = stats[module]
+        s['calls'] += 1
+        s['times'].append(elapsed)
+        s['flops'] += layer_flops(module, input, output)
+        s['output_MB'] += output.numel() * output.element_size() / 2**20
+
+    names = {}
+    for name, module in model.named_modules():
+        if len(list(module.children())) == 0:
+            names[module] = name
+            stats[module] = dict(calls=0, times=[], flops=0, output_MB=0)
+            handles.append(module.register_forward_pre_hook(pre_hook))
+            handles.append(module.register_forward_hook(hook))
+
+    with torch.no_grad():
+        model(input)  # warm up
+        for s in stats.values():
+            s.update(calls=0, times=[], flops=0, output_MB=0)
+        for _ in range(repeat):
+            model(input)
+    for h in handles:
+        h.remove()
+
+    records = []
+    for module, s in stats.items():
+        calls = s['calls'] // repeat
+        if calls == 0:
+            continue
+        # best time of each call, summed over the calls of one pass
+        times = np.array(s['times']).reshape(repeat, calls).min(axis=0).sum()
+        records.append((names[module], type(module).__name__, calls,
+                        s['flops'] // repeat, times * 1e3, s['output_MB'] / repeat,
+                        sum(p.numel() for p in module.parameters())))
+    return pd.DataFrame.from_records(records, columns=['layer', 'type', 'calls', 'flops',
+                                                       'time_ms', 'output_MB', 'params'])
+
+
+#-----------------------------------------------------------------------#
+#                         peak_forward_memory                           #
+#  Peak memory (MB) of a single forward pass. On CPU it is measured in  #
+#  a fresh process, where a thread samples the resident set size while  #
+#  the forward pass runs (ru_maxrss cannot be used, a spawned child     #
+#  inherits the high-water mark of its parent).                         #
+#-----------------------------------------------------------------------#
+def _resident_memory():
+    # current resident set size in MB, Linux only
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def _peak_forward_memory_worker(model_kwargs, size, queue):
+    torch.manual_seed(0)
+    model = UNet_2D(**model_kwargs).eval()
+    input = torch.rand(1, model_kwargs.get('in_channels', 1), *size)
+    before = _resident_memory()
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], _resident_memory())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    with torch.no_grad():
+        model(input)
+    done.set()
+    sampler.join()
+    queue.put(max(peak[0], _resident_memory()) - before)
+
+
+def peak_forward_memory(model_kwargs, size, device='cpu'):
+    if device != 'cpu':
+        model = UNet_2D(**model_kwargs).to(device).eval()
+        input = torch.rand(1, model_kwargs.get('in_channels', 1), *size, device=device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        with torch.no_grad():
+            model(input)
+        return (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    worker = context.Process(target=_peak_forward_memory_worker,
+                             args=(model_kwargs, size, queue))
+    worker.start()
+    worker.join()
+    return queue.get() if worker.exitcode == 0 else np.nan
+
+
+def _training_step(model_kwargs, size, batch_size, micro_batch_size, checkpointing,
+                   criterion=None, device='cpu'):
+    # model, optimizer and a closure running one training step of UNet_2D
+    torch.manual_seed(0)
+    model = UNet_2D(**model_kwargs).to(device).train()
+    model.checkpointing = checkpointing
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0001)
+    criterion = criterion or TverskyLoss(1e-10, 0.3, .7)
+    data = torch.rand(batch_size, model_kwargs.get('in_channels', 1), *size, device=device)
+    target = (torch.rand(batch_size, 1, *size, device=device) > 0.9).float()
+    return lambda: train_step(model, optimizer, criterion, data, target, micro_batch_size)
+
+
+def _loss_step(criterion, logits, size, batch_size, device='cpu'):
+    # a closure running the loss and its backward pass on a batch of network outputs
+    torch.manual_seed(0)
+    output = torch.randn(batch_size, 1, *size, device=device, requires_grad=True)
+    target = (torch.rand(batch_size, 1, *size, device=device) > 0.9).float()
+
+    def step():
+        loss = criterion(output if logits else torch.sigmoid(output), target)
+        loss.backward()
+        output.grad = None
+    return step
+
+
+def peak_step_memory(make_step, args, device, n_steps):
+    # peak memory (MB) and time (s) of the steps run by the closure make_step(*args, device)
+    if device.type == 'cuda':
+        step = make_step(*args, device=device)
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        step()
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            step()
+        torch.cuda.synchronize(device)
+        step_s = (time.perf_counter() - start) / n_steps
+        return (torch.cuda.max_memory_allocated(device) - base) / 2**20, step_s
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    worker = context.Process(target=_peak_step_memory_worker,
+                             args=(make_step, args, n_steps, queue))
+    worker.start()
+    worker.join()
+    return queue.get() if worker.exitcode == 0 else (np.nan, np.nan)
+
+
+def _peak_step_memory_worker(make_step, args, n_steps, queue):
+    step = make_step(*args, device='cpu')
+    before = _resident_memory()
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], _resident_memory())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    # the first step allocates the gradients and the optimizer state, and is not timed
+    step()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    queue.put((max(peak[0], _resident_memory()) - before, elapsed / n_steps))
+
+
+#-----------------------------------------------------------------------#
+#                       benchmark_training_memory                       #
+#  Peak memory of the activations against throughput of UNet_2D        #
+#  training steps, with gradient accumulation over micro-batches and    #
+#  activation checkpointing. The peak includes the gradients and the    #
+#  optimizer state, the same for all settings. On the CPU, every        #
+#  setting runs in a fresh process and the peak is the growth of the    #
+#  resident set from before the first step.                             #
+#-----------------------------------------------------------------------#
+# size:       (height, width) of the training crops                     #
+# batch_size: samples per optimizer step                                #
+# settings:   (micro_batch_size, checkpointing) pairs to compare, None  #
+#             for the whole batch at once                               #
+#-----------------------------------------------------------------------#
+def benchmark_training_memory(size=(640, 960), batch_size=16,
+                              settings=((None, False), (4, False), (4, True), (1, True)),
+                              model_kwargs=None, device='cpu', n_steps=2):
+    model_kwargs = model_kwargs or dict(in_channels=1, out_channels=1, init_features=32,
+                                        dropout_p=0.2)
+    device = torch.device(device)
+    records = []
+    for micro_batch_size, checkpointing in settings:
+        args = (model_kwargs, size, batch_size, micro_batch_size, checkpointing)
+        peak_MB, step_s = peak_step_memory(_training_step, args, device, n_steps)
+        records.append((micro_batch_size or batch_size, checkpointing, peak_MB,
+                        batch_size / step_s))
+        print(f'micro-batch {micro_batch_size or batch_size:>3}, checkpointing '
+              f'{checkpointing!s:>5}: peak {peak_MB:9.1f} MB, {batch_size / step_s:7.2f} samples/s')
+
+    return pd.DataFrame.from_records(records, columns=['micro_batch_size', 'checkpointing',
+                                                       'peak_MB', 'samples_per_s'])
+
+
+#-----------------------------------------------------------------------#
+#                            benchmark_loss                             #
+#  Peak memory and time of the loss functions on the sigmoid outputs    #
+#  against their fused variants on the logits, for the loss and its     #
+#  backward pass alone and for whole UNet_2D training steps             #
+#-----------------------------------------------------------------------#
+# size, batch_size: shape of the training batches                       #
+# model_kwargs:     UNet_2D arguments, defaults to the GUI model        #
+#-----------------------------------------------------------------------#
+def benchmark_loss(size=(320, 480), batch_size=16, model_kwargs=None, device='cpu', n_steps=2):
+    model_kwargs = model_kwargs or dict(in_channels=1, out_channels=1, init_features=32,
+                                        dropout_p=0.2)
+    device = torch.device(device)
+    weights = torch.tensor([0.9, 0.1])
+    variants = [
+        ('WeightedBCE', WeightedBCELoss(weights), False),
+        ('WeightedBCEWithLogits', WeightedBCEWithLogitsLoss(weights), True),
+        ('Tversky', TverskyLoss(1e-10, 0.3, .7), False),
+        ('TverskyWithLogits', TverskyWithLogitsLoss(1e-10, 0.3, .7), True),
+    ]
+    records = []
+    for name, criterion, logits in variants:
+        loss_MB, loss_s = peak_step_memory(_loss_step, (criterion, logits, size, batch_size),
+                                           device, max(n_steps, 5))
+        args = (dict(model_kwargs, return_logits=logits), size, batch_size, None, False, criterion)
+        step_MB, step_s = peak_step_memory(_training_step, args, device, n_steps)
+        records.append((name, loss_MB, loss_s * 1e3, step_MB, step_s * 1e3))
+        print(f'{name:>21}: loss {loss_MB:7.1f} MB {loss_s * 1e3:8.2f} ms, '
+              f'training step {step_MB:8.1f} MB {step_s * 1e3:9.1f} ms')
+
+    return pd.DataFrame.from_records(records, columns=['loss', 'loss_peak_MB', 'loss_ms',
+                                                       'step_peak_MB', 'step_ms'])
+
+
+#-----------------------------------------------------------------------#
+#                           benchmark_export                            #
+#  Parity and latency of UNet_2D fused for inference and of the         #
+#  exported models against eager UNet_2D. The BatchNorm running         #
+#  statistics are randomized first, so that the folding into the        #
+#  convolutions is checked against non-trivial values.                  #
+#-----------------------------------------------------------------------#
+# sizes:     (height, width) input sizes, the first one is traced       #
+# tolerance: largest absolute probability difference accepted           #
+# Returns the summary DataFrame and the list of parity failures         #
+#-----------------------------------------------------------------------#
+def benchmark_export(sizes=((320, 480), (640, 960)), model_kwargs=None, batch_size=1,
+                     tolerance=1e-4):
+    from export import export_torchscript, export_onnx, load_runner, onnxruntime
+    model_kwargs = model_kwargs or dict(in_channels=1, out_channels=1, init_features=32,
+                                        dropout_p=0.2)
+    torch.manual_seed(0)
+    model = UNet_2D(**model_kwargs)
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    model.eval()
+    fused = model.fuse_for_inference()
+
+    records = []
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        runners = {'TorchScript': (export_torchscript, os.path.join(tmp, 'model.ts'))}
+        if onnxruntime is not None:
+            runners['ONNX Runtime'] = (export_onnx, os.path.join(tmp, 'model.onnx'))
+        for name, (export, path) in list(runners.items()):
+            try:
+                export(model, path, sizes[0])
+            except (ImportError, torch.onnx.OnnxExporterError) as e:
+                print(f'{name} skipped: {e}')
+                del runners[name]
+                continue
+            runners[name] = load_runner(path)
+
+        with torch.no_grad():
+            for size in sizes:
+                input = torch.rand(batch_size, model_kwargs.get('in_channels', 1), *size)
+                reference = model(input)
+                eager_s = timeit(lambda: model(input))
+                records.append((f'{size[0]}x{size[1]}', 'eager', eager_s * 1e3, 1.0, 0.0))
+                for name, runner in [('fused', fused)] + list(runners.items()):
+                    runner(input)  # warm-up, TorchScript optimizes on the first calls
+                    diff = float((runner(input) - reference).abs().max())
+                    runner_s = timeit(lambda: runner(input))
+                    records.append((f'{size[0]}x{size[1]}', name, runner_s * 1e3,
+                                    eager_s / runner_s, diff))
+                    if diff > tolerance:
+                        failures.append(f'{name} {size[0]}x{size[1]}: max difference '
+                                        f'{diff:.2e} > {tolerance:.0e}')
+
+    return pd.DataFrame.from_records(records, columns=['size', 'runtime', 'time_ms', 'speedup',
+                                                       'max_abs_diff']), failures
+
+
+#-----------------------------------------------------------------------#
+#                            benchmark_int8                             #
+#  Accuracy and CPU latency of the static int8 quantization of UNet_2D  #
+#  against the float32 model fused for inference. The Dice coefficient #
+#  of each model is computed with performance_metrics over all the      #
+#  pixels of the evaluation set, and the agreement is the Dice of the   #
+#  int8 masks against the float32 ones.                                 #
+#-----------------------------------------------------------------------#
+# model:       UNet_2D with the trained parameters                      #
+# calibration: images_path_list to sample the calibration images from  #
+# loader:      evaluation DataLoader of (image, mask) pairs, without    #
+#              the calibration images, or the Dice is optimistic        #
+#-----------------------------------------------------------------------#
+def benchmark_int8(model, calibration, loader, n_samples=32, input_size=(320, 480),
+                   threshold=0.5):
+    from export import load_runner, save_frozen
+    from quantize import calibration_batches, quantize_int8
+    fp32 = model.cpu().fuse_for_inference()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model_int8.ts')
+        save_frozen(quantize_int8(model, calibration_batches(calibration, n_samples,
+                                                             input_size=input_size)),
+                    path, input_size)
+        # timed as deployed, from the saved artifact
+        int8 = load_runner(path)
+
+    masks = {'float32': [], 'int8': []}
+    targets = []
+    with torch.no_grad():
+        for data, target in loader:
+            targets.append(target >= 0.5)
+            for name, runner in (('float32', fp32), ('int8', int8)):
+                masks[name].append(runner(data) > threshold)
+    targets = torch.cat(targets).to(torch.uint8)
+    masks = {name: torch.cat(m).to(torch.uint8) for name, m in masks.items()}
+
+    input = torch.rand(1, 1, *input_size)
+    records = []
+    with torch.no_grad():
+        for name, runner in (('float32', fp32), ('int8', int8)):
+            runner(input)
+            time_s = timeit(lambda: runner(input))
+            dice = performance_metrics()(masks[name], targets)[5]
+            agreement = performance_metrics()(masks[name], masks['float32'])[5]
+            records.append((name, dice, agreement, time_s * 1e3))
+    df = pd.DataFrame.from_records(records, columns=['model', 'DSC', 'DSC_vs_float32',
+                                                     'time_ms'])
+    df['speedup'] = df['time_ms'].iloc[0] / df['time_ms']
+    return df
+
+
+#-----------------------------------------------------------------------#
+#                            benchmark_unet                             #
+#  Per-layer FLOPs, wall time and peak memory of UNet_2D forward passes #
+#-----------------------------------------------------------------------#
+# sizes:        (height, width) input sizes to test                     #
+# model_kwargs: UNet_2D arguments, defaults to the GUI model            #
+# baseline:     csv written by a previous run. The run fails when a     #
+#               layer with weights is called more than once, when FLOPs #
+#               differ from the baseline, or when the total time        #
+#               exceeds the baseline by more than time_tolerance.       #
+#-----------------------------------------------------------------------#
+def benchmark_unet(sizes=((320, 480), (640, 960), (1280, 1920)), model_kwargs=None,
+                   device='cpu', baseline=None, time_tolerance=0.5):
+    if model_kwargs is None:
+        model_kwargs = dict(in_channels=1, out_channels=1, init_features=32, dropout_p=0.2)
+    torch.manual_seed(0)
+    model = UNet_2D(**model_kwargs).to(device)
+
+    summary = []
+    failures = []
+    for size in sizes:
+        input = torch.rand(1, model_kwargs.get('in_channels', 1), *size, device=device)
+        layers = profile_layers(model, input)
+        peak = peak_forward_memory(model_kwargs, size, device)
+        name = f'{size[0]}x{size[1]}'
+        print(f'=== {name} ===')
+        print(layers.to_string(index=False))
+        summary.append((name, layers['flops'].sum() / 1e9, layers['time_ms'].sum(), peak))
+
+        repeated = layers[(layers['calls'] > 1) & (layers['params'] > 0)]
+        if len(repeated):
+            failures.append(f'{name}: layers run more than once per forward pass: '
+                            f'{", ".join(repeated["layer"])}')
+
+    summary = pd.DataFrame.from_records(summary, columns=['size', 'GFLOPs', 'time_ms',
+                                                          'peak_MB'])
+    if baseline is not None:
+        reference = pd.read_csv(baseline).set_index('size')
+        for _, row in summary.iterrows():
+            if row['size'] not in reference.index:
+                continue
+            ref = reference.loc[row['size']]
+            if not np.isclose(row['GFLOPs'], ref['GFLOPs'], rtol=1e-6):
+                failures.append(f'{row["size"]}: {row["GFLOPs"]:.3f} GFLOPs, '
+                                f'baseline {ref["GFLOPs"]:.3f}')
+            if row['time_ms'] > ref['time_ms'] * (1 + time_tolerance):
+                failures.append(f'{row["size"]}: {row["time_ms"]:.1f} ms, '
+                                f'baseline {ref["time_ms"]:.1f} ms')
+    return summary, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Performance benchmarks.')
+    parser.add_argument('suite', choices=['overlay', 'unet', 'augment', 'loader', 'amp',
+                                          'memory', 'loss', 'export', 'int8', 'defects',
+                                          'canvas', 'pyramid'])
+    parser.add_argument('--baseline', default=None,
+                        help='csv of a previous unet run to check regressions against')
+    parser.add_argument('--save', default=None, help='save the unet summary to this csv')
+    parser.add_argument('--images', default='dataset/set1',
+                        help='directory of the training pairs of the loader and amp suites')
+    parser.add_argument('--val-images', default='dataset/set2',
+                        help='directory of the validation pairs of the amp and int8 suites')
+    parser.add_argument('--epochs', type=int, default=2, help='epochs of the amp suite')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--model', default='model.pt',
+                        help='model parameter file of the int8 suite')
+    parser.add_argument('--samples', type=int, default=32,
+                        help='calibration images of the int8 suite')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='loader processes, all available cores but one by default')
+    args = parser.parse_args()
+
+    if args.suite == 'overlay':
+        from benchmark_gui import benchmark_overlay
+        print(benchmark_overlay().to_string(index=False))
+    elif args.suite == 'defects':
+        print(benchmark_defects().to_string(index=False))
+    elif args.suite == 'canvas':
+        from benchmark_gui import benchmark_canvas
+        summary = benchmark_canvas()
+        print(summary.to_string(index=False))
+        sys.exit(0 if summary['identical'].all() else 1)
+    elif args.suite == 'pyramid':
+        from benchmark_gui import benchmark_pyramid
+        summary = benchmark_pyramid()
+        print(summary.to_string(index=False))
+        sys.exit(0 if (summary['error'] < summary['preview_error']).all() else 1)
+    elif args.suite == 'augment':
+        device = configure_runtime(select_device())
+        print(benchmark_augmentation(device=device).to_string(index=False))
+    elif args.suite == 'loader':
+        device = configure_runtime(select_device())
+        dataset = DefectDetectionDataset(glob(os.path.join(args.images, '*.jpeg')), 'train',
+                                         batch_transform=True)
+        if len(dataset) == 0:
+            parser.error('no jpeg image in ' + args.images)
+        loader = make_loader(dataset, args.batch_size, device, shuffle=True,
+                             num_workers=args.workers)
+        model = UNet_2D(1, 1, 32, 0.2).to(device)
+        print(benchmark_loader(loader, model, device, BatchAugmentation(
+            gray=dataset.gray_images())).to_string(index=False))
+    elif args.suite == 'amp':
+        device = configure_runtime(select_device())
+        loaders = {}
+        for phase, images in [('train', args.images), ('val', args.val_images)]:
+            dataset = DefectDetectionDataset(glob(os.path.join(images, '*.jpeg')), phase,
+                                             batch_transform=True)
+            if len(dataset) == 0:
+                parser.error('no jpeg image in ' + images)
+            loaders[phase] = make_loader(dataset, args.batch_size, device,
+                                         shuffle=phase == 'train', num_workers=args.workers)
+        gray = all(loader.dataset.gray_images() for loader in loaders.values())
+        batch_transforms = {'train': BatchAugmentation(gray=gray),
+                            'val': BatchAugmentation(augment=False, gray=gray)}
+        summary, failures = check_fast_training(loaders, batch_transforms, device,
+                                                n_epochs=args.epochs)
+        print(summary.to_string(index=False))
+        for failure in failures:
+            print('MISMATCH:', failure)
+        sys.exit(1 if failures else 0)
+    elif args.suite == 'memory':
+        device = configure_runtime(select_device())
+        print(benchmark_training_memory(batch_size=args.batch_size,
+                                        device=device).to_string(index=False))
+    elif args.suite == 'loss':
+        device = configure_runtime(select_device())
+        print(benchmark_loss(batch_size=args.batch_size, device=device).to_string(index=False))
+    elif args.suite == 'export':
+        configure_runtime('cpu')
+        summary, failures = benchmark_export()
+        print(summary.to_string(index=False))
+        for failure in failures:
+            print('MISMATCH:', failure)
+        sys.exit(1 if failures else 0)
+    elif args.suite == 'int8':
+        configure_runtime('cpu')
+        images = sorted(glob(os.path.join(args.val_images, '*.jpeg')))
+        # the int8 model is scored on the images it was not calibrated on
+        calibration = random.Random(0).sample(images, min(args.samples, len(images) // 2))
+        if not calibration:
+            parser.error('less than 2 jpeg images in ' + args.val_images)
+        held_out = sorted(set(images) - set(calibration))
+        dataset = DefectDetectionDataset(held_out, 'val')
+        loader = make_loader(dataset, args.batch_size, 'cpu', num_workers=args.workers)
+        model = UNet_2D(1, 1, 32, 0.2)
+        model.load_state_dict(load_state_dict(args.model, 'cpu'))
+        print(f'calibrated on {len(calibration)} images, scored on {len(held_out)}')
+        print(benchmark_int8(model, calibration, loader, len(calibration)).to_string(index=False))
+    elif args.suite == 'unet':
+        configure_runtime('cpu')
+        summary, failures = benchmark_unet(baseline=args.baseline)
+        print(summary.to_string(index=False))
+        if args.save:
+            summary.to_csv(args.save, index=False)
+        for failure in failures:
+            print('REGRESSION:', failure)
+        sys.exit(1 if failures else 0)
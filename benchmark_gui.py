@@ -0,0 +1,393 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import sys
+import time
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QEvent, QPoint, QPointF, QRectF, QSize, Qt
+from PyQt5.QtGui import QColor, QImage, QMouseEvent, QPainter, QPixmap, QWheelEvent
+from PyQt5.QtWidgets import QApplication, QLabel, QLayout, QStackedLayout, QWidget
+
+from benchmark import _random_disks, timeit
+from overlay import binary_to_overlay, mask_to_overlay, overlay_to_binary
+from main import Background, Canvas, LayerView
+from pyramid import ImagePyramid, image_array
+from workers import TileWorker
+
+
+#-----------------------------------------------------------------------#
+#                         benchmark_overlay                             #
+#  Compare the vectorized mask conversion with the per-pixel QColor     #
+#  loops previously used in MainWindow, at several resolutions          #
+#-----------------------------------------------------------------------#
+# sizes:      (width, height) pairs to test                             #
+# loop_limit: largest pixel count the per-pixel loops are run on, they  #
+#             take minutes on multi-megapixel frames                    #
+#-----------------------------------------------------------------------#
+def _loop_binary_to_overlay(mask_image):
+    trans_mask_image = QImage(mask_image.size(), QImage.Format_ARGB32)
+    for i in range(mask_image.width()):
+        for j in range(mask_image.height()):
+            pixel_color = mask_image.pixelColor(i, j)
+            if pixel_color == QColor(0, 0, 0):
+                pixel_color.setAlphaF(0)
+                trans_mask_image.setPixelColor(i, j, pixel_color)
+            elif pixel_color == QColor(255, 255, 255):
+                pixel_color.setAlphaF(0.6)
+                trans_mask_image.setPixelColor(i, j, pixel_color)
+    return trans_mask_image
+
+
+def _loop_overlay_to_binary(mask):
+    mask = mask.copy()
+    for i in range(mask.width()):
+        for j in range(mask.height()):
+            pixel_color = mask.pixelColor(i, j)
+            pixel_color.setAlphaF(1)
+            mask.setPixelColor(i, j, pixel_color)
+    return mask
+
+
+def benchmark_overlay(sizes=((480, 320), (1600, 1200), (2448, 2048), (3840, 2160)),
+                      loop_limit=2_000_000):
+    records = []
+    rng = np.random.default_rng(0)
+    for w, h in sizes:
+        binary = (rng.random((h, w)) > 0.9).astype(np.uint8) * 255
+        # opaque black and white mask, as decoded from a png or the model output
+        mask_image = overlay_to_binary(binary_to_overlay(binary)).convertToFormat(
+            QImage.Format_RGB32)
+        overlay = binary_to_overlay(binary)
+
+        ops = {
+            'binary_to_overlay': (lambda: binary_to_overlay(binary),
+                                  lambda: _loop_binary_to_overlay(mask_image)),
+            'mask_to_overlay': (lambda: mask_to_overlay(mask_image),
+                                lambda: _loop_binary_to_overlay(mask_image)),
+            'overlay_to_binary': (lambda: overlay_to_binary(overlay),
+                                  lambda: _loop_overlay_to_binary(overlay)),
+        }
+        for name, (vectorized, loop) in ops.items():
+            t_vec = timeit(vectorized)
+            t_loop = timeit(loop, repeat=1) if w * h <= loop_limit else np.nan
+            records.append((name, f'{w}x{h}', t_vec * 1e3, t_loop * 1e3, t_loop / t_vec))
+            print(f'{name:>18} {w}x{h}: vectorized {t_vec * 1e3:9.2f} ms, '
+                  f'loop {t_loop * 1e3:11.2f} ms')
+
+    return pd.DataFrame.from_records(records, columns=['op', 'size', 'vectorized_ms',
+                                                       'loop_ms', 'speedup'])
+
+
+#-----------------------------------------------------------------------#
+#                          benchmark_canvas                             #
+#  Frame time of synthetic brush strokes, pans and zooms on the         #
+#  annotation LayerView, with the mask over its background, against    #
+#  the previous stacked QLabel layers, which painted every mouse move   #
+#  with a new QPainter and repainted the whole layers for it            #
+#-----------------------------------------------------------------------#
+# sizes:           (width, height) of the mask and background images    #
+# scales:          display zooms, 0.25 shows most of a 4K image         #
+# moves_per_frame: mouse moves delivered between two frames             #
+# Returns the summary DataFrame. paints counts the paint events of all  #
+# the layers per frame, identical tells that both drew the same mask    #
+# and the same frame                                                    #
+#-----------------------------------------------------------------------#
+class _StackedLayer(QLabel):
+    def __init__(self, pixmap, widget_size, scale):
+        super().__init__()
+        self.layer_pixmap = pixmap
+        self.setPixmap(pixmap)
+        self.lefttop = QPointF(0, 0)
+        self.moved_lefttop = QPointF(0, 0)
+        self.original_center = QPointF(widget_size[0] / 2, widget_size[1] / 2)
+        self.scale = scale
+        self.partner = None
+        self.paints = 0
+        self.pen_color = QColor('#ffffff')
+        self.pen_color.setAlphaF(0.6)
+
+    def _toPixmap(self, pos):
+        return QPointF((pos.x() - self.moved_lefttop.x() * self.scale) / self.scale,
+                       (pos.y() - self.moved_lefttop.y() * self.scale) / self.scale)
+
+    def _paint(self, draw):
+        painter = QPainter(self.layer_pixmap)
+        self.setPixmap(self.layer_pixmap)
+        pen = painter.pen()
+        pen.setWidth(5)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        pen.setColor(self.pen_color)
+        painter.setPen(pen)
+        draw(painter)
+        painter.end()
+        self.update()
+
+    def mousePressEvent(self, e):
+        if e.button() == Qt.LeftButton:
+            self.last = self._toPixmap(e.pos())
+            self._paint(lambda painter: painter.drawPoint(self.last))
+        else:
+            self.start_pos = e.pos()
+
+    def mouseMoveEvent(self, e):
+        if e.buttons() & Qt.LeftButton:
+            now = self._toPixmap(e.pos())
+            self._paint(lambda painter: painter.drawLine(self.last, now))
+            self.last = now
+        else:
+            self.lefttop = self.lefttop + (e.pos() - self.start_pos) / self.scale
+            self.start_pos = e.pos()
+            self.update()
+
+    def wheelEvent(self, e):
+        self.scale *= 1.1 if e.angleDelta().y() > 0 else 1 / 1.1
+        self.update()
+
+    def paintEvent(self, e):
+        self.paints += 1
+        scale_painter = QPainter(self)
+        scale_painter.scale(self.scale, self.scale)
+        move_x = self.original_center.x() / self.scale - self.layer_pixmap.width() / 2
+        move_y = self.original_center.y() / self.scale - self.layer_pixmap.height() / 2
+        self.moved_lefttop = QPointF(self.lefttop.x() + move_x, self.lefttop.y() + move_y)
+        scale_painter.drawPixmap(self.moved_lefttop, self.layer_pixmap)
+        scale_painter.end()
+        if self.partner is not None:
+            self.partner.lefttop = self.lefttop
+            self.partner.scale = self.scale
+            self.partner.update()
+
+
+class _CountingLayerView(LayerView):
+    paints = 0
+
+    def paintEvent(self, e):
+        self.paints += 1
+        super().paintEvent(e)
+
+
+def _background_pixmap(size):
+    background = QPixmap(size)
+    background.fill(QColor(128, 128, 128))
+    return background
+
+
+# Returns the top level widget, the widget receiving the mouse, the widgets counting their
+# paints and a function returning the mask
+def _layer_view(mask, widget_size, scale):
+    view = _CountingLayerView(QSize(*widget_size))
+    background = Background(QSize(*widget_size))
+    background.back_pixmap = _background_pixmap(mask.size())
+    canvas = Canvas(QSize(*widget_size))
+    canvas.mask_pixmap = QPixmap.fromImage(mask)
+    canvas.is_annotation = True
+    view.addLayer(background)
+    view.addLayer(canvas)
+    view.scale = scale
+    view.resize(*widget_size)
+    return view, view, [view], lambda: canvas.mask_pixmap.toImage()
+
+
+def _stacked_view(mask, widget_size, scale):
+    widget = QWidget()
+    layout = QStackedLayout(widget)
+    layout.setStackingMode(QStackedLayout.StackingMode.StackAll)
+    canvas = _StackedLayer(QPixmap.fromImage(mask), widget_size, scale)
+    background = _StackedLayer(_background_pixmap(mask.size()), widget_size, scale)
+    canvas.partner = background
+    layout.addWidget(canvas)
+    layout.addWidget(background)
+    # the labels ask for the size of their pixmap, MainWindow squeezes them in a fixed size
+    layout.setSizeConstraint(QLayout.SetNoConstraint)
+    widget.resize(*widget_size)
+    return widget, canvas, [canvas, background], lambda: canvas.layer_pixmap.toImage()
+
+
+# mouse events of each frame along a Lissajous curve over the widget
+def _synthetic_events(op, n_frames, moves_per_frame, widget_size):
+    w, h = widget_size
+    t = np.linspace(0, 2 * np.pi, n_frames * moves_per_frame + 1)
+    points = [QPointF(x, y) for x, y in zip(w / 2 + 0.4 * w * np.sin(3 * t),
+                                           h / 2 + 0.4 * h * np.sin(2 * t))]
+    if op == 'zoom':
+        # one wheel step per frame, in and out
+        return None, [[QWheelEvent(points[0], points[0], QPoint(0, 0),
+                                   QPoint(0, 120 if i % 4 < 2 else -120), Qt.NoButton,
+                                   Qt.NoModifier, Qt.NoScrollPhase, False)]
+                      for i in range(n_frames)], None
+    button = Qt.LeftButton if op == 'stroke' else Qt.MiddleButton
+    press = QMouseEvent(QEvent.MouseButtonPress, points[0], button, button, Qt.NoModifier)
+    moves = [[QMouseEvent(QEvent.MouseMove, point, Qt.NoButton, button, Qt.NoModifier)
+              for point in points[1 + i * moves_per_frame:1 + (i + 1) * moves_per_frame]]
+             for i in range(n_frames)]
+    release = QMouseEvent(QEvent.MouseButtonRelease, points[-1], button, Qt.NoButton,
+                          Qt.NoModifier)
+    return press, moves, release
+
+
+def _synthetic_frames(target, painted, press, frames, release):
+    if press is not None:
+        QApplication.sendEvent(target, press)
+    QApplication.processEvents()
+    paints = sum(widget.paints for widget in painted)
+    frame_times = []
+    for events in frames:
+        start = time.perf_counter()
+        for event in events:
+            QApplication.sendEvent(target, event)
+        QApplication.processEvents()
+        frame_times.append(time.perf_counter() - start)
+    if release is not None:
+        QApplication.sendEvent(target, release)
+    QApplication.processEvents()
+    return np.array(frame_times), (sum(widget.paints for widget in painted) - paints) / len(frames)
+
+
+def benchmark_canvas(sizes=((1600, 1200), (3840, 2160)), scales=(1.0, 0.25), n_frames=120,
+                     moves_per_frame=4, widget_size=(800, 600)):
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    records = []
+    for w, h in sizes:
+        mask = binary_to_overlay(_random_disks((w, h), 1000, radius=8))
+        for scale in scales:
+            for op in ('stroke', 'pan', 'zoom'):
+                results = {}
+                for name, make_view in (('view', _layer_view), ('stacked', _stacked_view)):
+                    widget, target, painted, get_mask = make_view(mask, widget_size, scale)
+                    widget.show()
+                    QApplication.processEvents()
+                    times, paints = _synthetic_frames(
+                        target, painted,
+                        *_synthetic_events(op, n_frames, moves_per_frame, widget_size))
+                    results[name] = (times, paints, get_mask(), widget.grab().toImage())
+                    widget.close()
+                view, stacked = results['view'], results['stacked']
+                identical = view[2] == stacked[2] and view[3] == stacked[3]
+                frame, stacked_frame = np.median(view[0]), np.median(stacked[0])
+                records.append((f'{w}x{h}', scale, op, frame * 1e3,
+                                np.percentile(view[0], 95) * 1e3, view[1], stacked_frame * 1e3,
+                                np.percentile(stacked[0], 95) * 1e3, stacked[1],
+                                stacked_frame / frame, identical))
+                print(f'{w}x{h}, zoom {scale}, {op:>6}: view {frame * 1e3:7.2f} ms, '
+                      f'stacked layers {stacked_frame * 1e3:7.2f} ms per frame')
+    return pd.DataFrame.from_records(records, columns=['size', 'zoom', 'op', 'frame_ms',
+                                                       'frame_p95_ms', 'paints',
+                                                       'stacked_frame_ms', 'stacked_frame_p95_ms',
+                                                       'stacked_paints', 'speedup',
+                                                       'identical'])
+
+
+#-----------------------------------------------------------------------#
+#                         benchmark_pyramid                             #
+#  Frame time of pans and zooms over a 108 MP image shown through its   #
+#  ImagePyramid, at several zooms, against drawing each frame from the  #
+#  full resolution image scaled with Qt.SmoothTransformation, which is  #
+#  sharp and without aliasing too. The previous viewer only showed the  #
+#  image scaled to the view, blurred when zoomed in.                    #
+#-----------------------------------------------------------------------#
+# size:   (width, height) of the synthetic gray image                   #
+# scales: display zooms, 1 shows the whole image                        #
+# Returns the summary DataFrame. ready_ms is the time the TileWorker    #
+# takes to build the tiles of the first frame, error and preview_error  #
+# are the mean absolute differences in gray levels of the last frame of #
+# the pyramid and of the previous viewer to the smoothly scaled frame,  #
+# cache_mb the size of the tile cache at the end                        #
+#-----------------------------------------------------------------------#
+class _ScaledBackground(Background):
+    def draw(self, painter, rect, origin, scale):
+        sx, sy = self.imageScale()
+        image = self.pyramid.image
+        source = QRectF((rect.x() / scale - origin.x()) * sx, (rect.y() / scale - origin.y()) * sy,
+                        rect.width() / scale * sx, rect.height() / scale * sy)
+        source = source.toAlignedRect().intersected(image.rect())
+        if source.isEmpty():
+            return
+        target = QRectF(source.x() / sx, source.y() / sy, source.width() / sx, source.height() / sy)
+        size = QSize(max(round(target.width() * scale), 1), max(round(target.height() * scale), 1))
+        painter.drawImage(target.translated(origin),
+                          image.copy(source).scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+
+
+def _noise_image(size, seed=0):
+    # uneven rows and fine noise over a gradient, which aliases when sampled
+    w, h = size
+    rng = np.random.default_rng(seed)
+    array = (np.linspace(60, 180, w, dtype=np.float32)[None, :]
+             + rng.normal(0, 20, (h, 1)).astype(np.float32)).clip(0, 215).astype(np.uint8)
+    array += rng.integers(0, 40, (h, w), dtype=np.uint8)
+    return QImage(array.data, w, h, w, QImage.Format_Grayscale8).copy()
+
+
+def _pyramid_view(background, image, widget_size, scale):
+    view = _CountingLayerView(QSize(*widget_size))
+    background.pyramid = ImagePyramid(image)
+    background.back_pixmap = QPixmap.fromImage(image.scaled(*widget_size, Qt.KeepAspectRatio))
+    view.addLayer(background)
+    view.scale = scale
+    view.resize(*widget_size)
+    return view
+
+
+def _wait_tiles(view, background, timeout=60):
+    # until the tiles of the whole view are built
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        _, keys = background.tilesUnder(view.rect(), view.origin(background.pixmap()), view.scale)
+        if all(background.pyramid.cache.get(key) is not None for key in keys):
+            break
+        QApplication.processEvents()
+        time.sleep(0.001)
+    QApplication.processEvents()
+    return time.perf_counter() - start
+
+
+def _gray_frame(view):
+    # image_array is a view of the QImage, only valid while it is referenced
+    frame = view.grab().toImage().convertToFormat(QImage.Format_Grayscale8)
+    return image_array(frame)[..., 0].copy()
+
+
+def benchmark_pyramid(size=(12000, 9000), scales=(1.0, 4.0, 16.0), n_frames=40,
+                      moves_per_frame=4, widget_size=(800, 600)):
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    image = _noise_image(size)
+    tile_worker = TileWorker()
+    tile_worker.start()
+    records = []
+    for scale in scales:
+        for op in ('pan', 'zoom'):
+            results = {}
+            for name, background in (('pyramid', Background(QSize(*widget_size), tile_worker)),
+                                     ('scaled', _ScaledBackground(QSize(*widget_size))),
+                                     ('preview', Background(QSize(*widget_size)))):
+                view = _pyramid_view(background, image, widget_size, scale)
+                if name == 'preview':
+                    background.pyramid = None
+                view.show()
+                QApplication.processEvents()
+                ready = _wait_tiles(view, background) if name == 'pyramid' else 0
+                times, _ = _synthetic_frames(view, [view],
+                                             *_synthetic_events(op, n_frames, moves_per_frame,
+                                                                widget_size))
+                if name == 'pyramid':
+                    _wait_tiles(view, background)
+                cache = background.pyramid.cache.n_bytes if name != 'preview' else 0
+                results[name] = (times, ready, _gray_frame(view).astype(np.int16), cache)
+                view.close()
+            pyramid, scaled, preview = results['pyramid'], results['scaled'], results['preview']
+            frame, scaled_frame = np.median(pyramid[0]), np.median(scaled[0])
+            error = np.abs(pyramid[2] - scaled[2]).mean()
+            preview_error = np.abs(preview[2] - scaled[2]).mean()
+            records.append((f'{size[0]}x{size[1]}', scale, op, frame * 1e3,
+                            np.percentile(pyramid[0], 95) * 1e3, pyramid[1] * 1e3,
+                            scaled_frame * 1e3, np.percentile(scaled[0], 95) * 1e3,
+                            scaled_frame / frame, error, preview_error, pyramid[3] / 2 ** 20))
+            print(f'zoom {scale}, {op:>4}: pyramid {frame * 1e3:7.2f} ms, '
+                  f'scaled full image {scaled_frame * 1e3:7.2f} ms per frame')
+    tile_worker.stop()
+    return pd.DataFrame.from_records(records, columns=['size', 'zoom', 'op', 'frame_ms',
+                                                       'frame_p95_ms', 'ready_ms',
+                                                       'scaled_frame_ms', 'scaled_frame_p95_ms',
+                                                       'speedup', 'error', 'preview_error',
+                                                       'cache_mb'])
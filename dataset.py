@@ -3,7 +3,7 @@
 #-----------------------------------------------------------------------#
 from transforms import Resize, Rotate, HorizontalFlip, VerticalFlip,\
      Normalize, ToTensor
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 from glob import glob
 import random
@@ -11,17 +11,88 @@ from random import shuffle
 import os
 import numpy as np
 import torch
+import hashlib
 
 import torchvision.transforms
 
+from runtime import as_device, available_cores
+
+
+def mask_path(image_path):
+    # The mask is in png, with the same name as the image.
+    return os.path.splitext(image_path)[0] + '.png'
+
+
+#-----------------------------------------------------------------------#
+#                            DatasetCache                               #
+#  On-disk cache of decoded image and mask pairs resized to output_size.#
+#  Each pair is one memory-mapped uint8 .npy file of shape (H, W, 4):   #
+#  the RGB image and the mask. The file name is a hash of the image     #
+#  path, the mtime and size of the image and mask files and the output  #
+#  size, so a pair is re-decoded only when one of its files changes,    #
+#  e.g. when a revised annotation is saved into the train set.          #
+#-----------------------------------------------------------------------#
+class DatasetCache():
+    def __init__(self, cache_dir, output_size = (320, 480)):
+        self.cache_dir = cache_dir
+        self.output_size = output_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, image_path):
+        key = [os.path.abspath(image_path), str(self.output_size)]
+        for f in [image_path, mask_path(image_path)]:
+            st = os.stat(f)
+            key += [str(st.st_mtime_ns), str(st.st_size)]
+        name = hashlib.sha1('|'.join(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def load(self, image_path):
+        """
+        Args:
+            image_path: path of the jpeg image
+        Returns:
+            (H, W, 4) read-only memory-mapped uint8 array, decoding and
+            storing the pair first if it is not cached yet
+        """
+        path = self.entry_path(image_path)
+        if not os.path.exists(path):
+            size = (self.output_size[1], self.output_size[0])
+            image = Image.open(image_path).convert('RGB').resize(size, Image.NEAREST)
+            mask = Image.open(mask_path(image_path)).convert('L').resize(size, Image.NEAREST)
+            pair = np.concatenate([np.asarray(image), np.asarray(mask)[..., None]], axis=-1)
+            # write then rename, so that concurrent loader workers never read a partial file
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, pair)
+            os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+    def prune(self, images_path_list):
+        # remove the entries of changed or deleted pairs
+        keep = {os.path.basename(self.entry_path(p)) for p in images_path_list}
+        for f in os.listdir(self.cache_dir):
+            if f not in keep:
+                os.remove(os.path.join(self.cache_dir, f))
+
 
 class DefectDetectionDataset(Dataset):    
-    def __init__(self, images_path_list, set_name, output_size = (320, 480), no_transform =  False):
+    def __init__(self, images_path_list, set_name, output_size = (320, 480), no_transform =  False,
+                 cache_dir = None, batch_transform = False):
+        """
+        Args:
+            cache_dir:       directory of a DatasetCache. The pairs are then decoded and resized
+                             once, and only the random augmentations run at every epoch.
+            batch_transform: return the uint8 RGB image and mask resized to output_size,
+                             without augmentation. The collated batches are then transformed
+                             at once by a transforms.BatchAugmentation.
+        """
         super().__init__()
         self.images_path_list = images_path_list
         self.set_name = set_name
         self.output_size = output_size
         self.no_transform = no_transform
+        self.cache = DatasetCache(cache_dir, output_size) if cache_dir else None
+        self.batch_transform = batch_transform
 
     def transform(self, image, mask, set_name, no_transform=False):
         """
@@ -82,17 +153,75 @@ class DefectDetectionDataset(Dataset):
     def __len__(self):
         return len(self.images_path_list)
 
+    def gray_images(self):
+        # True when every image file is grayscale, from the file headers only
+        for path in self.images_path_list:
+            with Image.open(path) as image:
+                if image.mode not in ('1', 'L'):
+                    return False
+        return True
+
+    def load_pair(self, idx):
+        """
+        Returns:
+            (H, W, 4) uint8 array of the RGB image and the mask resized to output_size
+        """
+        if self.cache is not None:
+            return self.cache.load(self.images_path_list[idx])
+        size = (self.output_size[1], self.output_size[0])
+        image = Image.open(self.images_path_list[idx]).convert('RGB').resize(size, Image.NEAREST)
+        mask = Image.open(mask_path(self.images_path_list[idx])).convert('L').resize(size, Image.NEAREST)
+        return np.concatenate([np.asarray(image), np.asarray(mask)[..., None]], axis=-1)
+
     def __getitem__(self, idx):
         # Generate one batch of data
-        # Open the image file which is in jpg     
-        image = Image.open(self.images_path_list[idx])
-        # The mask is in png. 
-        # Use the image path, and change its extension to png to get the mask's path.
-        mask = Image.open(os.path.splitext(self.images_path_list[idx])[0]+'.png') 
+        if self.batch_transform:
+            # channels first uint8 tensors, 4 times smaller than float to collate and transfer
+            pair = torch.from_numpy(np.array(self.load_pair(idx)).transpose(2, 0, 1))
+            return pair[:3], pair[3:]
+        if self.cache is not None:
+            # decoded pair already resized to output_size
+            pair = self.cache.load(self.images_path_list[idx])
+            image = Image.fromarray(np.ascontiguousarray(pair[..., :3]))
+            mask = Image.fromarray(np.ascontiguousarray(pair[..., 3]))
+        else:
+            # Open the image file which is in jpg     
+            image = Image.open(self.images_path_list[idx])
+            # The mask is in png. 
+            # Use the image path, and change its extension to png to get the mask's path.
+            mask = Image.open(mask_path(self.images_path_list[idx]))
         
         # Transform the image and mask PILs to torch tensors. 
         # Perform augmentation if required.
         image, mask = self.transform(image, mask, self.set_name, self.no_transform)
         
         #return the image and mask pair tensors
-        return image, mask
\ No newline at end of file
+        return image, mask
+
+
+#-----------------------------------------------------------------------#
+#                            make_loader                                #
+#  DataLoader of a DefectDetectionDataset decoding in parallel worker   #
+#  processes. The workers are kept alive between epochs and prefetch    #
+#  batches ahead of the training loop. A worker collates each batch     #
+#  into a tensor in shared memory and only passes its handle, so the    #
+#  uint8 batches of batch_transform datasets are never pickled.         #
+#-----------------------------------------------------------------------#
+# device:          training device, batches are pinned for CUDA         #
+# num_workers:     loader processes, all available cores but one (left  #
+#                  to the training loop) by default, at most 8          #
+# prefetch_factor: batches loaded in advance by each worker             #
+#-----------------------------------------------------------------------#
+def default_num_workers():
+    return max(0, min(8, available_cores() - 1))
+
+
+def make_loader(dataset, batch_size, device, shuffle=False, num_workers=None, prefetch_factor=2):
+    device = as_device(device)
+    if num_workers is None:
+        num_workers = default_num_workers()
+    workers = {}
+    if num_workers > 0:
+        workers = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=device.type == 'cuda', **workers)
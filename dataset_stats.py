@@ -0,0 +1,90 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from dataset import mask_path
+from runtime import available_cores
+
+
+STATS_COLUMNS = ['mask', 'mtime_ns', 'file_size', 'width', 'height',
+                 'defect_pixels', 'defect_ratio']
+
+
+#-----------------------------------------------------------------------#
+#                            mask_statistics                            #
+#     Defect area of one raw mask, at the resolution it was drawn at    #
+#-----------------------------------------------------------------------#
+def mask_statistics(path):
+    st = os.stat(path)
+    with Image.open(path) as mask:
+        # a pixel is a defect from half intensity, as the 0.5 threshold on the tensors
+        defect_pixels = int(np.count_nonzero(np.asarray(mask.convert('L')) >= 128))
+        width, height = mask.size
+    return dict(mask=path, mtime_ns=st.st_mtime_ns, file_size=st.st_size, width=width,
+                height=height, defect_pixels=defect_pixels,
+                defect_ratio=defect_pixels / (width * height))
+
+
+#-----------------------------------------------------------------------#
+#                            MaskStatistics                             #
+#  Defect area of every mask of a dataset, kept in a csv next to the    #
+#  dataset. update() reads only the masks that are new or changed since #
+#  the last call (by mtime and size), in parallel threads, and rewrites #
+#  the csv, so the statistics of a dataset growing by a few annotations #
+#  take seconds instead of a pass over all the images.                  #
+#-----------------------------------------------------------------------#
+class MaskStatistics():
+    def __init__(self, stats_file, num_workers = None):
+        self.stats_file = stats_file
+        self.num_workers = num_workers or min(8, available_cores())
+
+    def load(self):
+        if os.path.exists(self.stats_file):
+            return pd.read_csv(self.stats_file)
+        return pd.DataFrame(columns=STATS_COLUMNS)
+
+    def update(self, images_path_list):
+        """
+        Args:
+            images_path_list: paths of the jpeg images
+        Returns:
+            DataFrame of the statistics of the masks of the images, in order
+        """
+        masks = [mask_path(p) for p in images_path_list]
+        cached = {row.mask: row._asdict() for row in self.load().itertuples(index=False)}
+        stale = []
+        for m in masks:
+            st = os.stat(m)
+            row = cached.get(m)
+            if row is None or row['mtime_ns'] != st.st_mtime_ns or row['file_size'] != st.st_size:
+                stale.append(m)
+
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            for row in pool.map(mask_statistics, stale):
+                cached[row['mask']] = row
+
+        # keep the masks of other datasets sharing the file, drop the deleted ones
+        rows = [r for m, r in cached.items() if os.path.exists(m)]
+        df = pd.DataFrame.from_records(rows, columns=STATS_COLUMNS)
+        if stale or len(rows) != len(cached):
+            # write then rename, so that an interrupted update leaves the previous file
+            tmp = f'{self.stats_file}.{os.getpid()}.tmp'
+            df.to_csv(tmp, index=False)
+            os.replace(tmp, self.stats_file)
+        return df.set_index('mask').loc[masks].reset_index()
+
+
+#-----------------------------------------------------------------------#
+#                            class_weights                              #
+#  Positive and negative pixel ratios of a dataset, for WeightedBCELoss.#
+#  Every image counts the same, as after resizing to the network input. #
+#-----------------------------------------------------------------------#
+def class_weights(stats):
+    positive_weight = float(stats['defect_ratio'].mean()) if len(stats) else 0.0
+    return positive_weight, 1 - positive_weight
@@ -0,0 +1,401 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+
+
+#-----------------------------------------------------------------------#
+#                    Defect instances of a binary mask                  #
+#-----------------------------------------------------------------------#
+# Every 8-connected component of the mask is one defect. Coordinates    #
+# are in pixels of the mask, x to the right and y down, with the centre #
+# of the top left pixel at (0, 0).                                      #
+# area_px:        number of pixels                                      #
+# x, y:           top left pixel of the bounding box                    #
+# width, height:  size of the bounding box                              #
+# centroid_x, centroid_y: centre of mass                                #
+# orientation:    angle in degrees between the x axis and the major     #
+#                 axis, counterclockwise as displayed, in (-90, 90]     #
+# major_axis, minor_axis: lengths of the axes of the ellipse with the   #
+#                 same second moments as the defect                     #
+# length:         length along the defect, the longest path through its #
+#                 skeleton, so that curved cracks are measured in full  #
+# max_width:      diameter of the largest disk inside the defect        #
+# closed:         the skeleton has a loop, as for a ring or a closed    #
+#                 crack, and length is measured around all its loops    #
+#-----------------------------------------------------------------------#
+DEFECT_COLUMNS = ['defect', 'area_px', 'x', 'y', 'width', 'height', 'centroid_x',
+                  'centroid_y', 'orientation', 'major_axis', 'minor_axis', 'length',
+                  'max_width', 'closed']
+
+# columns converted to millimetres, and their names
+LENGTH_COLUMNS = {'width': 'width_mm', 'height': 'height_mm', 'centroid_x': 'centroid_x_mm',
+                  'centroid_y': 'centroid_y_mm', 'major_axis': 'major_axis_mm',
+                  'minor_axis': 'minor_axis_mm', 'length': 'length_mm',
+                  'max_width': 'max_width_mm'}
+
+EIGHT_CONNECTED = np.ones((3, 3), dtype=bool)
+
+
+#-----------------------------------------------------------------------#
+#                         Zhang-Suen thinning                           #
+# Zhang, T. Y.; Suen, C. Y. A fast parallel algorithm for thinning      #
+#    digital patterns. Commun. ACM 27, 3 (1984), 236–239.               #
+#-----------------------------------------------------------------------#
+# The 8 neighbours P2..P9 of a pixel, clockwise from the north one, are #
+# packed into the bits of a code, and whether a pixel is deleted in     #
+# each of the two sub-iterations is looked up from its code.            #
+#-----------------------------------------------------------------------#
+def _thinning_tables():
+    codes = np.arange(256)
+    p = (codes[:, None] >> np.arange(8)) & 1  # P2, P3, ..., P9
+    b = p.sum(axis=1)
+    a = ((p == 0) & (np.roll(p, -1, axis=1) == 1)).sum(axis=1)
+    p2, p4, p6, p8 = p[:, 0], p[:, 2], p[:, 4], p[:, 6]
+    removable = (b >= 2) & (b <= 6) & (a == 1)
+    first = removable & (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+    second = removable & (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+    return first, second
+
+
+THINNING_TABLES = _thinning_tables()
+
+
+def _neighbour_offsets(stride):
+    # P2..P9 in a flat array of row length stride
+    return np.array([-stride, -stride + 1, 1, stride + 1, stride, stride - 1, -1, -stride - 1])
+
+
+def skeletonize(mask):
+    """
+    Args:
+        mask: (height, width) array, nonzero for defect pixels
+    Returns:
+        (height, width) bool array of the one pixel wide skeleton. Only the
+        pixels along the shrinking borders of the defects are visited, so the
+        cost follows the defect area rather than the image size.
+    """
+    mask = np.asarray(mask) != 0
+    padded = np.pad(mask, 1).astype(np.uint8)
+    flat = padded.ravel()
+    offsets = _neighbour_offsets(padded.shape[1])
+    weights = 1 << np.arange(8)
+    # only pixels next to the background can be deleted, and a pixel only gets there
+    # when one of its neighbours is deleted, so the iterations follow the border
+    candidates = np.flatnonzero(flat)
+    # deduplicates the candidates without sorting: each keeps its last occurrence
+    stamp = np.empty(flat.size, dtype=np.int32)
+    every_pixel = True
+    changed = True
+    while changed:
+        changed = False
+        for table in THINNING_TABLES:
+            codes = flat[candidates[:, None] + offsets] @ weights
+            delete = table[codes]
+            if delete.any():
+                removed = candidates[delete]
+                flat[removed] = 0
+                changed = True
+                if every_pixel and 8 * len(removed) >= len(candidates):
+                    # thin defects are done in a few iterations, keep all their pixels
+                    candidates = candidates[~delete]
+                    continue
+                every_pixel = False
+                neighbours = (removed[:, None] + offsets).ravel()
+                candidates = np.concatenate([candidates[~delete & (codes != 255)],
+                                             neighbours[flat[neighbours] != 0]])
+                stamp[candidates] = np.arange(len(candidates), dtype=np.int32)
+                candidates = candidates[stamp[candidates] == np.arange(len(candidates))]
+    return padded[1:-1, 1:-1].astype(bool)
+
+
+#-----------------------------------------------------------------------#
+#                          skeleton_lengths                             #
+#  Length and largest width of every labeled defect, from its skeleton. #
+#  The skeleton pixels of all the defects make one sparse graph, whose  #
+#  edges join 8-neighbours with their distance, 1 or sqrt(2). The       #
+#  longest path of each defect is found with two Dijkstra sweeps run    #
+#  from one pixel per defect at once: the farthest pixel from any pixel #
+#  is an end of the longest path, exactly so for a tree. The path is    #
+#  then measured along chords, which follow curves without the bias of  #
+#  the 8-neighbour steps. The largest width is twice the distance from  #
+#  the skeleton to the background, found with a KD-tree of the          #
+#  background pixels along the contours, and the same distance at both  #
+#  ends of the path extends the length to the ends of the defect, which #
+#  the thinning shortens.                                               #
+#  A skeleton with a loop, E - V + C > 0 edges E, pixels V and parts C, #
+#  is not a tree and its longest path would only be about half a ring.  #
+#  The count leaves out the diagonal edges next to two axis edges, they #
+#  make triangles at the corners of any skeleton. The branches of such  #
+#  a defect are pruned, and its loops are split into chains at the      #
+#  junctions, the pixels on more than two edges; a loop without one is  #
+#  cut at one pixel. Every chain is measured as above and joined to the #
+#  junctions or the cut pixel at its ends, and the length is the longer #
+#  of the longest path and the sum over the chains, all of the loops.   #
+#  The thinning removes one layer of pixels per pass, so a defect wider #
+#  than about max_thickness, twice its area over its contour pixels, is #
+#  measured on its box reduced by the max over blocks of pixels, at     #
+#  most max_thickness wide, which keeps the thin cracks joined to it.   #
+#-----------------------------------------------------------------------#
+# labels, n:     output of ndimage.label                                #
+# chord:         number of skeleton pixels per chord of the measured    #
+#                path                                                   #
+# max_thickness: thicker defects are measured at a lower resolution     #
+# Returns the length, max_width and closed arrays of the labels 1..n,   #
+# in pixels                                                             #
+#-----------------------------------------------------------------------#
+def skeleton_lengths(labels, n, chord=8, max_thickness=128):
+    height, width = labels.shape
+    padded = np.pad(labels, 1)
+    stride = width + 2
+    length = np.zeros(n + 1)
+    max_width = np.zeros(n + 1)
+    closed = np.zeros(n + 1, dtype=bool)
+
+    # background pixels next to a defect, where the nearest ones to its inside are, and
+    # the defect pixels on its contour
+    flat = padded.ravel()
+    inside = np.flatnonzero(flat != 0)
+    contour = np.zeros(len(inside), dtype=bool)
+    border = []
+    for offset in (-stride, -1, 1, stride):
+        outside = flat[inside + offset] == 0
+        contour |= outside
+        border.append(inside[outside] + offset)
+    border = np.unique(np.concatenate(border))
+    thickness = 2 * np.bincount(flat[inside], minlength=n + 1) / np.maximum(
+        np.bincount(flat[inside[contour]], minlength=n + 1), 1)
+    factor = thickness.astype(int) // max_thickness + 1
+    thick = np.flatnonzero(factor > 1)
+    boxes = ndimage.find_objects(labels) if len(thick) else []
+    for label in thick:
+        f = factor[label]
+        rows, cols = boxes[label - 1]
+        box = padded[rows.start + 1:rows.stop + 1, cols.start + 1:cols.stop + 1]
+        mask = box == label
+        # the defect is left out of the thinning below
+        box[mask] = 0
+        mask = np.pad(mask, ((0, -mask.shape[0] % f), (0, -mask.shape[1] % f)))
+        mask = mask.reshape(mask.shape[0] // f, f, mask.shape[1] // f, f).any(axis=(1, 3))
+        reduced = skeleton_lengths(mask.astype(np.int32), 1, chord, max_thickness)
+        length[label], max_width[label] = reduced[0][0] * f, reduced[1][0] * f
+        closed[label] = reduced[2][0]
+
+    skeleton = np.flatnonzero(np.pad(skeletonize(padded[1:-1, 1:-1]), 1))
+    skeleton_label = padded.ravel()[skeleton]
+    order = np.argsort(skeleton_label, kind='stable')
+    skeleton, skeleton_label = skeleton[order], skeleton_label[order]
+    y, x = np.divmod(skeleton, stride)
+
+    # graph of the skeleton pixels, each edge once: to the E, SE, S and SW neighbours
+    pixel_order = np.argsort(skeleton)
+    sorted_pixels = np.r_[skeleton[pixel_order], -1]
+    in_skeleton = np.zeros(padded.size, dtype=bool)
+    in_skeleton[skeleton] = True
+    rows, cols, weights, corner_free = [], [], [], []
+    for offset, w, corners in ((1, 1.0, ()), (stride + 1, np.sqrt(2), (1, stride)),
+                               (stride, 1.0, ()), (stride - 1, np.sqrt(2), (-1, stride))):
+        position = np.searchsorted(sorted_pixels[:-1], skeleton + offset)
+        linked = sorted_pixels[position] == skeleton + offset
+        rows.append(np.flatnonzero(linked))
+        cols.append(pixel_order[position[linked]])
+        weights.append(np.full(linked.sum(), w))
+        free = np.ones(len(rows[-1]), dtype=bool)
+        for corner in corners:
+            free &= ~in_skeleton[skeleton[rows[-1]] + corner]
+        corner_free.append(free)
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+
+    # loops per defect, E - V + C, without the diagonals across the corners
+    corner_free = np.concatenate(corner_free)
+    loop_rows, loop_cols = rows[corner_free], cols[corner_free]
+    def parts(kept):
+        return connected_components(coo_matrix(
+            (np.ones(kept.sum()), (loop_rows[kept], loop_cols[kept])),
+            shape=(len(skeleton), len(skeleton))), directed=False)[1]
+    _, first_pixels = np.unique(parts(np.ones(len(loop_rows), dtype=bool)), return_index=True)
+    closed[1:] |= (np.bincount(skeleton_label[loop_rows], minlength=n + 1)
+                   - np.bincount(skeleton_label, minlength=n + 1)
+                   + np.bincount(skeleton_label[first_pixels], minlength=n + 1))[1:] > 0
+
+    graph = coo_matrix((weights, (rows, cols)), shape=(len(skeleton), len(skeleton))).tocsr()
+
+    if len(skeleton):
+        radius, _ = cKDTree(np.column_stack(np.divmod(border, stride))).query(
+            np.column_stack([y, x]))
+        # a pixel at distance r from the background is the centre of a 2r - 1 wide band
+        np.maximum.at(max_width, skeleton_label, 2 * radius - 1)
+
+        def longest_path(graph, starts, group):
+            # the pixels of a group, started from its pixel in starts, are sorted by distance
+            # after the ones of the groups before it, and its farthest one is last
+            last = (np.cumsum(np.bincount(group)) - 1)[group[starts]]
+            def farthest(sources):
+                distance, predecessors, _ = dijkstra(graph, directed=False, indices=sources,
+                                                     min_only=True, return_predecessors=True)
+                # the pixels left out of the graph are not reached
+                reached = np.where(np.isinf(distance), -1, distance)
+                return np.lexsort((reached, group))[last], distance, predecessors
+            first_end, _, _ = farthest(starts)
+            second_end, distance, predecessors = farthest(first_end)
+
+            # Along the pixels the path length is up to 8% too long for directions between
+            # the axes and the diagonals, so it is measured along chords of a few pixels,
+            # walking back the paths of all the defects together.
+            path = np.zeros(len(starts))
+            current = second_end.copy()
+            previous = current.copy()
+            active = np.flatnonzero(distance[current] > 0)
+            step = 0
+            while len(active):
+                current[active] = predecessors[current[active]]
+                step += 1
+                done = current[active] == first_end[active]
+                if step % chord == 0 or done.any():
+                    ends = active if step % chord == 0 else active[done]
+                    path[ends] += np.hypot(y[current[ends]] - y[previous[ends]],
+                                           x[current[ends]] - x[previous[ends]])
+                    previous[ends] = current[ends]
+                active = active[~done]
+            return first_end, second_end, path
+        starts = np.flatnonzero(np.r_[True, skeleton_label[1:] != skeleton_label[:-1]])
+        first_end, second_end, path = longest_path(graph, starts, skeleton_label)
+        # the thinning stops about r - 1 pixels, so r - 1/2, short of each end of the defect
+        length[skeleton_label[second_end]] = np.where(
+            path > 0, path + radius[first_end] + radius[second_end] - 1,
+            2 * radius[second_end] - 1)
+
+        on_loop = closed[skeleton_label]
+        if on_loop.any():
+            # the loops of the closed defects, without the branches hanging from them
+            degree = np.bincount(np.r_[loop_rows, loop_cols], minlength=len(skeleton))
+            pruned = on_loop & (degree < 2)
+            while pruned.any():
+                on_loop &= ~pruned
+                np.subtract.at(degree, np.r_[loop_cols[pruned[loop_rows]],
+                                             loop_rows[pruned[loop_cols]]], 1)
+                pruned = on_loop & (degree < 2)
+            # a part between the junctions with as many edges as pixels is a loop without
+            # junction, cut at its first pixel and the neighbours of it, as the skeleton
+            # can be two pixels thick at a step
+            junction = on_loop & (degree > 2)
+            free = on_loop & ~junction
+            kept = free[loop_rows] & free[loop_cols]
+            chain = parts(kept)
+            pixels = np.bincount(chain[free], minlength=len(skeleton))
+            edges = np.bincount(chain[loop_rows[kept]], minlength=len(skeleton))
+            chain, first_pixels = np.unique(chain, return_index=True)
+            cut = np.zeros(len(skeleton), dtype=bool)
+            cut[first_pixels[(pixels[chain] > 0) & (edges[chain] >= pixels[chain])]] = True
+            free &= ~cut
+            free[np.r_[loop_cols[cut[loop_rows]], loop_rows[cut[loop_cols]]]] = False
+            kept = free[loop_rows] & free[loop_cols]
+            chain = np.where(free, parts(kept), len(skeleton))
+            chain_graph = coo_matrix(
+                (weights[corner_free][kept], (loop_rows[kept], loop_cols[kept])),
+                shape=(len(skeleton), len(skeleton))).tocsr()
+            free = np.flatnonzero(free)
+            _, chain_starts = np.unique(chain[free], return_index=True)
+            first_end, second_end, path = longest_path(chain_graph, free[chain_starts], chain)
+
+            # each end of a chain is joined to the nearest junction or cut pixel of its
+            # defect, the second one of a chain of one pixel between two of them
+            nodes = np.flatnonzero(junction | cut)
+            apart = float(stride + height)  # farther than any two pixels of one defect
+            tree = cKDTree(np.column_stack([y[nodes], x[nodes], skeleton_label[nodes] * apart]))
+            def joints(ends):
+                return tree.query(np.column_stack([y[ends], x[ends], skeleton_label[ends] * apart]),
+                                  k=2)[0]
+            first_joint, second_joint = joints(first_end), joints(second_end)
+            second_joint = np.where((first_end == second_end) & np.isfinite(second_joint[:, 1]),
+                                    second_joint[:, 1], second_joint[:, 0])
+            around = np.bincount(skeleton_label[first_end], minlength=n + 1,
+                                 weights=path + first_joint[:, 0] + second_joint)
+            loop = np.unique(skeleton_label[on_loop])
+            length[loop] = np.maximum(length[loop], around[loop])
+    return length[1:], max_width[1:], closed[1:]
+
+
+#-----------------------------------------------------------------------#
+#                            defect_regions                             #
+#  Label the connected components of a mask and measure all of them at  #
+#  once: the pixels of the defects are sorted by label a single time,   #
+#  the areas and moments are bincounts, and the bounding boxes are      #
+#  reductions over the runs of each label. There is no loop over the    #
+#  defects, so thousands of them cost about as much as one.             #
+#-----------------------------------------------------------------------#
+# mask:       (height, width) array, nonzero for defect pixels          #
+# pix_per_mm: scale of the mask, Ruler.pix_per_length at the mask       #
+#             resolution. The columns in mm are added when it is given. #
+# min_area:   smaller components are dropped, in pixels                 #
+# Returns a DataFrame with one row per defect, largest first            #
+#-----------------------------------------------------------------------#
+def defect_regions(mask, pix_per_mm=None, min_area=1):
+    mask = np.asarray(mask) != 0
+    labels, n = ndimage.label(mask, structure=EIGHT_CONNECTED)
+    regions = pd.DataFrame(columns=DEFECT_COLUMNS)
+    if n:
+        width = mask.shape[1]
+        index = np.flatnonzero(labels)
+        label = labels.ravel()[index]
+        order = np.argsort(label, kind='stable')
+        label, index = label[order], index[order]
+        y, x = np.divmod(index, width)
+        starts = np.flatnonzero(np.r_[True, label[1:] != label[:-1]])
+
+        area = np.bincount(label, minlength=n + 1)[1:].astype(np.float64)
+        def mean(values):
+            return np.bincount(label, weights=values, minlength=n + 1)[1:] / area
+        x, y = x.astype(np.float64), y.astype(np.float64)
+        cx, cy = mean(x), mean(y)
+        # central second moments; each pixel is a unit square, hence the 1/12
+        mu20 = mean(x * x) - cx * cx + 1 / 12
+        mu02 = mean(y * y) - cy * cy + 1 / 12
+        mu11 = mean(x * y) - cx * cy
+        half_difference = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+        major = 4 * np.sqrt((mu20 + mu02) / 2 + half_difference)
+        minor = 4 * np.sqrt(np.maximum((mu20 + mu02) / 2 - half_difference, 0))
+        # y points down, so the displayed angle is the opposite of the array one
+        orientation = np.degrees(-0.5 * np.arctan2(2 * mu11, mu20 - mu02)) + 0.0  # no -0.0
+        orientation[orientation <= -90] += 180
+
+        x0, y0 = np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts)
+        bbox_width = np.maximum.reduceat(x, starts) - x0 + 1
+        bbox_height = np.maximum.reduceat(y, starts) - y0 + 1
+        length, max_width, closed = skeleton_lengths(labels, n)
+        # the thinning erases a few tiny shapes, such as 2x2 squares, entirely
+        erased = length == 0
+        length[erased] = np.maximum(bbox_width, bbox_height)[erased]
+        max_width[erased] = np.minimum(bbox_width, bbox_height)[erased]
+        regions = pd.DataFrame({
+            'defect': np.arange(1, n + 1), 'area_px': area.astype(np.int64),
+            'x': x0.astype(np.int64), 'y': y0.astype(np.int64),
+            'width': bbox_width.astype(np.int64), 'height': bbox_height.astype(np.int64),
+            'centroid_x': cx, 'centroid_y': cy, 'orientation': orientation,
+            'major_axis': major, 'minor_axis': minor, 'length': length,
+            'max_width': max_width, 'closed': closed})
+        regions = regions[regions['area_px'] >= min_area]
+        regions = regions.sort_values('area_px', ascending=False, kind='stable',
+                                      ignore_index=True)
+        regions['defect'] = np.arange(1, len(regions) + 1)
+    if pix_per_mm:
+        regions = regions_in_mm(regions, pix_per_mm)
+    return regions
+
+
+#-----------------------------------------------------------------------#
+#                            regions_in_mm                              #
+#  Add the sizes and positions in millimetres, from the scale set with  #
+#  the ruler, to the regions of defect_regions                          #
+#-----------------------------------------------------------------------#
+def regions_in_mm(regions, pix_per_mm):
+    regions = regions.copy()
+    regions['area_mm2'] = regions['area_px'] / pix_per_mm ** 2
+    for column, column_mm in LENGTH_COLUMNS.items():
+        regions[column_mm] = regions[column] / pix_per_mm
+    return regions
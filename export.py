@@ -0,0 +1,121 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from runtime import as_device, available_cores, load_state_dict
+from unet import UNet_2D
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+#-----------------------------------------------------------------------#
+#                          export_torchscript                           #
+#  Trace UNet_2D fused for inference, with its BatchNorms folded into   #
+#  the convolutions and without Dropout, and freeze it so that the      #
+#  parameters become constants. The traced graph has no size-dependent  #
+#  control flow, so it accepts any input divisible by 16.               #
+#-----------------------------------------------------------------------#
+# model:      UNet_2D returning probabilities                           #
+# path:       output .ts file                                           #
+# input_size: (height, width) of the example input used for tracing     #
+#-----------------------------------------------------------------------#
+def export_torchscript(model, path, input_size=(320, 480)):
+    return save_frozen(model.cpu().fuse_for_inference(), path, input_size)
+
+
+def save_frozen(module, path, input_size=(320, 480)):
+    example = torch.rand(1, 1, *input_size)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(module.eval(), example))
+    frozen.save(path)
+    return frozen
+
+
+#-----------------------------------------------------------------------#
+#                             export_onnx                               #
+#  Export UNet_2D fused for inference to ONNX, with dynamic batch and   #
+#  image sizes. Requires the onnx package.                              #
+#-----------------------------------------------------------------------#
+def export_onnx(model, path, input_size=(320, 480), opset_version=17):
+    model = model.cpu().fuse_for_inference()
+    example = torch.rand(1, 1, *input_size)
+    kwargs = {}
+    if 'dynamo' in torch.onnx.export.__code__.co_varnames:
+        # the TorchScript-based exporter, which handles the dynamic axes below
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model, example, path, input_names=['image'],
+                          output_names=['probability'], opset_version=opset_version,
+                          do_constant_folding=True,
+                          dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'probability': {0: 'batch', 2: 'height', 3: 'width'}},
+                          **kwargs)
+
+
+#-----------------------------------------------------------------------#
+#                              OnnxRunner                               #
+#  Runs an exported ONNX model with ONNX Runtime on the CPU. It is      #
+#  called like UNet_2D, with a (B, 1, H, W) tensor, and returns the     #
+#  probabilities as a CPU tensor.                                       #
+#-----------------------------------------------------------------------#
+class OnnxRunner():
+    def __init__(self, path, threads=None):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or available_cores()
+        self.session = onnxruntime.InferenceSession(path, options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, input):
+        input = input.detach().cpu().numpy().astype(np.float32, copy=False)
+        return torch.from_numpy(self.session.run(None, {self.input_name: input})[0])
+
+
+#-----------------------------------------------------------------------#
+#                              load_runner                              #
+#  Load an exported model for inference: ONNX Runtime for a .onnx file  #
+#  on the CPU when it is installed, otherwise the TorchScript .ts file  #
+#  of the same name.                                                    #
+#-----------------------------------------------------------------------#
+def load_runner(path, device='cpu'):
+    device = as_device(device)
+    stem, ext = os.path.splitext(path)
+    if ext == '.onnx':
+        if onnxruntime is not None and device.type == 'cpu':
+            return OnnxRunner(path)
+        path = stem + '.ts'
+    return torch.jit.load(path, map_location=device).eval()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the UNet_2D parameters to frozen TorchScript and ONNX models.')
+    parser.add_argument('--model', default='model.pt', help='model parameter file')
+    parser.add_argument('--output', default=None,
+                        help='path of the exported files without extension, '
+                             'defaults to the model path')
+    parser.add_argument('--input-size', type=int, nargs=2, default=[320, 480],
+                        metavar=('HEIGHT', 'WIDTH'), help='example input size')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.model)[0]
+    model = UNet_2D(1, 1, 32, 0.2)
+    model.load_state_dict(load_state_dict(args.model, 'cpu'))
+    export_torchscript(model, output + '.ts', tuple(args.input_size))
+    print('saved', output + '.ts')
+    try:
+        export_onnx(model, output + '.onnx', tuple(args.input_size))
+        print('saved', output + '.onnx')
+    except (ImportError, torch.onnx.OnnxExporterError) as e:
+        print('ONNX export skipped:', e)
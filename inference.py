@@ -4,23 +4,23 @@
 import torch
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from transforms import ToTensor
-from metrics import performance_metrics 
+from metrics import ConfusionMatrix, ThresholdSweep
+from runtime import as_device
 
 #-----------------------------------------------------------------------#
 #                      plot_prediction_results                          #
 #  Performs prediction on the test dataset, plots and saves the images  #
 #-----------------------------------------------------------------------#
 # model:      trained model                                          #  
+# device:     device to run on (or the legacy train_on_gpu flag)        #
 # loaders:    Test dataloader                                           #
 # threshold:  Threshold value to create binary image                    #
 #-----------------------------------------------------------------------#
-def plot_prediction_results(model, train_on_gpu, loaders, threshold=0.5):
+def plot_prediction_results(model, device, loaders, threshold=0.5):
+    device = as_device(device)
     for batch_idx, (images, targets) in enumerate(loaders):
-        # Move image and mask Pytorch Tensor to GPU if CUDA is available.
-        if train_on_gpu:
-            images, targets = images.cuda(), targets.cuda()
+        # Move image and mask Pytorch Tensor to the device
+        images, targets = images.to(device), targets.to(device)
         # Set the model to inference mode
         model.eval()
         # Forward pass (inference) to get the output
@@ -49,68 +49,75 @@ def plot_prediction_results(model, train_on_gpu, loaders, threshold=0.5):
 
 #-----------------------------------------------------------------------#
 #                 get_inference_performance_metrics                     #
-#  Performs prediction on the test dataset, plots and saves the images  #
+#  Performs prediction on the test dataset and computes the metrics     #
+#  over all its pixels (micro) and per image (macro)                    #
 #-----------------------------------------------------------------------#
 # model:      trained model                                             #  
+# device:     device to run on (or the legacy train_on_gpu flag)        #
 # loaders:    Test dataloader                                           #
 # threshold:  Threshold value to create binary image                    #
 #-----------------------------------------------------------------------#
   
-def get_inference_performance_metrics(model, train_on_gpu, loaders, threshold= 0.5):
-    # A list to keep track of test performance metrics
-    test_metrics =[]
+def get_inference_performance_metrics(model, device, loaders, threshold= 0.5):
+    device = as_device(device)
     # Set the model to inference mode
     model.eval()
-    # Initialize variables to monitor performance metrics
-    specificity_val = 0
-    sensitivity_val = 0
-    precision_val = 0
-    F1_score_val = 0
-    F2_score_val = 0
-    DSC_val = 0
-    F_beta_score_val = 0
-    MAE_val = 0
-    accuracy_val =0
-    # initialize the number of test instances
-    test_cnt = 0
+    # confusion counts of every test image, kept on the device
+    confusion = ConfusionMatrix(threshold, smooth = 1e-6)
 
-    for batch_idx, (data, target) in enumerate(loaders):
-        # Move image and mask Pytorch Tensor to GPU if CUDA is available.
-        if train_on_gpu:
-            data, target = data.cuda(), target.cuda()
-        # forward pass (inference) to get the output
-        output = model(data)
-        output = output.cpu().detach().numpy()
-        # Binarize the output
-        output_b = (output>threshold)*1
-        output_b = np.squeeze(output_b)
-        batch_l = output_b.size
-        # update the total number of test pairs
-        test_cnt += batch_l
-        t1 = ToTensor()
-        # Transform output back to Pytorch Tensor and move it to GPU
-        output_b = t1(output_b)
-        output_b = output_b.cuda()
-        # Get average metrics per batch
-        m = performance_metrics(smooth = 1e-6)
-        specificity, sensitivity, precision, F1_score, F2_score, DSC, F_beta_score, MAE, accuracy = m( output_b, target)    
-        
-        specificity_val += specificity * batch_l
-        sensitivity_val += sensitivity * batch_l
-        precision_val += precision * batch_l
-        F1_score_val += F1_score * batch_l
-        F2_score_val += F2_score * batch_l 
-        DSC_val += DSC * batch_l 
-        F_beta_score_val += F_beta_score * batch_l
-        MAE_val += MAE * batch_l
-        accuracy_val += accuracy * batch_l
-        # Calculate the overall average metrics
-        specificity_val, sensitivity_val, precision_val, F1_score_val, F2_score_val, DSC_val , F_beta_score_val, MAE_val , accuracy_val= specificity_val/test_cnt, sensitivity_val/test_cnt, precision_val/test_cnt, F1_score_val/test_cnt, F2_score_val/test_cnt, DSC_val/test_cnt, F_beta_score_val/test_cnt, MAE_val/test_cnt, accuracy_val/test_cnt
-        
-        test_metrics.append((specificity_val, sensitivity_val, precision_val, F1_score_val, F2_score_val, DSC_val, F_beta_score_val, MAE_val, accuracy_val))
-    #save the test metrics as a Pandas DataFrame
-    df=pd.DataFrame.from_records(test_metrics, columns=[ 'specificity', 'sensitivity', 'precision', 'F1_score', 'F2_score', 'DSC','F_beta', 'MAE', 'acc' ])
+    with torch.no_grad():
+        for batch_idx, (data, target) in enumerate(loaders):
+            # Move image and mask Pytorch Tensor to the device
+            data, target = data.to(device), target.to(device)
+            # forward pass (inference) to get the output
+            output = model(data)
+            confusion.update(output, target)
+
+    # the only copy to the host
+    df = confusion.compute()
     # Save the test metrics
     df.to_csv('test_metrics.csv', index=False)       
     return df
 
+
+#-----------------------------------------------------------------------#
+#                        evaluate_thresholds                            #
+#  Runs the model once on the test dataset and computes the metrics of  #
+#  every threshold, saves them and plots the PR curve with the best     #
+#  threshold                                                            #
+#-----------------------------------------------------------------------#
+# model:      trained model                                             #  
+# device:     device to run on (or the legacy train_on_gpu flag)        #
+# loaders:    Test dataloader                                           #
+# n_bins:     number of thresholds evaluated, evenly spaced in [0, 1)   #
+# metric:     metric the best threshold maximizes, e.g. F_beta or DSC   #
+# Returns the metrics of every threshold and the row of the best one    #
+#-----------------------------------------------------------------------#
+def evaluate_thresholds(model, device, loaders, n_bins=1000, metric='F_beta'):
+    device = as_device(device)
+    model.eval()
+    sweep = ThresholdSweep(n_bins, smooth = 1e-6)
+
+    with torch.no_grad():
+        for data, target in loaders:
+            data, target = data.to(device), target.to(device)
+            sweep.update(model(data), target)
+
+    df = sweep.compute()
+    best = df.loc[df[metric].idxmax()]
+    df.to_csv('threshold_metrics.csv', index=False)
+
+    # PR curve, with the best operating point
+    fig = plt.figure(figsize=(5, 5))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(df['sensitivity'], df['precision'])
+    ax.plot(best['sensitivity'], best['precision'], 'o',
+            label=f'best {metric} = {best[metric]:.3f} at threshold {best["threshold"]:.3f}')
+    ax.set_xlabel('recall')
+    ax.set_ylabel('precision')
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.legend()
+    fig.savefig('pr_curve.png')
+    plt.close(fig)
+    return df, best
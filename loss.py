@@ -3,6 +3,7 @@
 #-----------------------------------------------------------------------#
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 #-----------------------------------------------------------------------#
@@ -26,6 +27,26 @@ class WeightedBCELoss(nn.Module):
                self.weights[0] * ((1 - targets) * torch.log(1 - inputs + self.smooth))
         return torch.neg(torch.mean(loss))
 
+#-----------------------------------------------------------------------#
+#                    WeightedBCEWithLogitsLoss                          #
+#  WeightedBCELoss of the pre-sigmoid outputs (UNet_2D with             #
+#  return_logits) in one fused kernel. log(sigmoid(x)) is computed as   #
+#  -softplus(-x), which is exact for large |x| and needs no smoothing.  #
+#  With pos_weight = w1 / w0 and a factor w0, the loss equals           #
+#  -(w1 * t * log(p) + w0 * (1 - t) * log(1 - p)).                      #
+#-----------------------------------------------------------------------#
+# weight:   weight tensor per class, the negative weight must not be 0  #
+#-----------------------------------------------------------------------#
+class WeightedBCEWithLogitsLoss(nn.Module):
+    def __init__(self, weights):
+        super().__init__()
+        self.weights = weights
+        
+    def forward(self, logits, targets):
+        weights = torch.as_tensor(self.weights, dtype=logits.dtype, device=logits.device)
+        loss = F.binary_cross_entropy_with_logits(logits, targets, pos_weight=weights[1] / weights[0])
+        return weights[0] * loss
+
 #-----------------------------------------------------------------------#
 #                             TverskyLoss                               #
 #                 Calculate and return the Tversky Loss                 #
@@ -67,3 +88,30 @@ class TverskyLoss(nn.Module):
         # return the loss
         return 1 - tversky
 
+
+
+#-----------------------------------------------------------------------#
+#                        TverskyWithLogitsLoss                          #
+#  TverskyLoss of the pre-sigmoid outputs. Only the probabilities are   #
+#  materialized: with sp = sum(p) and st = sum(t), fp = sp - tp and     #
+#  fn = st - tp, so tp is one fused multiply-sum and no product or      #
+#  complement tensor is allocated.                                      #
+#-----------------------------------------------------------------------#
+class TverskyWithLogitsLoss(nn.Module):
+    #returns the Tversky loss per batch
+    def __init__(self, smooth = 1e-10, alpha = 0.5, beta = 0.5):
+        super().__init__()
+        self.smooth = smooth
+        self.alpha = alpha
+        self.beta = beta
+
+    def forward(self, logits, y_true):
+        y_pred_flat = torch.sigmoid(logits).flatten()
+        y_true_flat = y_true.flatten().to(y_pred_flat.dtype)
+        tp = torch.dot(y_pred_flat, y_true_flat)
+        fp = y_pred_flat.sum() - tp
+        fn = y_true_flat.sum() - tp
+        # calculate the Tversky index
+        tversky = tp/(tp + self.alpha * fn + self.beta * fp + self.smooth)
+        # return the loss
+        return 1 - tversky
@@ -2,8 +2,8 @@ import sys
 import os
 import math
 
-from PyQt5.QtCore import QSize, Qt, QPointF
-from PyQt5.QtGui import QColor, QPainter, QPixmap, QImage, QCursor, QFont
+from PyQt5.QtCore import QObject, QSize, Qt, QPointF, QRectF, pyqtSignal
+from PyQt5.QtGui import QColor, QPainter, QPixmap, QImage, QCursor, QRegion
 from PyQt5.QtWidgets import (
     QApplication,
     QHBoxLayout,
@@ -14,51 +14,93 @@ from PyQt5.QtWidgets import (
     QWidget,
     QToolBar,
     QAction,
-    QStackedLayout,
     QFileDialog,
     QInputDialog,
     QMessageBox,
     QComboBox,
     QStatusBar,
     QSpinBox,
-    QFrame
+    QFrame,
+    QDockWidget,
+    QTableWidget,
+    QTableWidgetItem,
+    QHeaderView,
+    QSizePolicy
 )
 
 from qt_material import apply_stylesheet
 
 import numpy as np
-import pandas as pd
-from PIL import Image, ImageQt
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 
 import torch
-import torchvision.transforms
 from glob import glob
 import torch.optim as optim
 
 from unet import UNet_2D
-from train import train_2D
-from dataset import DefectDetectionDataset
-from loss import WeightedBCELoss, TverskyLoss
+from train import load_checkpoint
+from dataset import DefectDetectionDataset, DatasetCache, make_loader
+from dataset_stats import MaskStatistics, class_weights
+from transforms import BatchAugmentation
+from loss import WeightedBCEWithLogitsLoss, TverskyWithLogitsLoss
+from overlay import mask_to_overlay, overlay_to_binary, overlay_defects
+from defects import defect_regions, regions_in_mm
+from runtime import select_device, configure_runtime, load_state_dict
+from batch_inference import load_model
+from workers import SegmentationWorker, TrainingWorker, TileWorker
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setFixedSize(1800, 800)
         self.setWindowTitle("Composite Material Defect Detection")
+
+        # background thread building the tiles of the displayed images, used by the views
+        self.tile_worker = TileWorker(self)
+        self.tile_worker.image_ready.connect(self.imageOpened)
+        self.tile_worker.start()
         
         self.setupWindow()
         self.setupMenu()
         self.setupToolbar()
 
-        self.detect_model = UNet_2D(1,1,32,0.2).cuda()
-        # load the model
-        self.detect_model.load_state_dict(torch.load('model.pt'))
+        # run on the fastest available backend, tuned for inference
+        self.device = configure_runtime(select_device())
+        # load the model, the frozen export of model.pt when `python export.py` made one
+        self.detect_model = load_model('model.pt', self.device)
+
+        # background thread for detection
+        self.segmentation_jobs = {} # job id -> (image file, mask width), in submission order
+        self.segmentation_worker = SegmentationWorker(self.detect_model, self.device, self)
+        self.segmentation_worker.progress.connect(self.segmentationProgress)
+        self.segmentation_worker.result.connect(self.segmentationFinished)
+        self.segmentation_worker.failed.connect(self.segmentationFailed)
+        self.segmentation_worker.cancelled.connect(self.segmentationCancelled)
+        self.segmentation_worker.start()
+
+        # background thread for model updating, with its losses shown in a dock
+        self.training_worker = None
+        self.training_panel = TrainingPanel()
+        self.training_dock = QDockWidget("Update Model", self)
+        self.training_dock.setWidget(self.training_panel)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.training_dock)
+        self.training_dock.setFloating(True) # the main window has a fixed size
+        self.training_dock.hide()
+
+        # defects of the last detection, in pixels of its mask, listed in a dock
+        self.defects = None
+        self.defect_mask_scale = 1 # mask pixels per displayed pixel
+        self.defect_panel = DefectPanel()
+        self.defect_dock = QDockWidget("Defects", self)
+        self.defect_dock.setWidget(self.defect_panel)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.defect_dock)
+        self.defect_dock.setFloating(True)
+        self.defect_dock.hide()
+        self.ruler_layer.scale_changed.connect(self.showDefects)
     
     def setupWindow(self):
         self.total_layout = QVBoxLayout()
-        # 必须先进行以下设置，否则QStackedLayout的前后顺序会出问题
-        # 变成index小的层在下面（本来应该在上面）
         container = QWidget()
         container.setLayout(self.total_layout)
         self.setCentralWidget(container)
@@ -81,9 +123,11 @@ class MainWindow(QMainWindow):
         object_box.currentIndexChanged.connect(self.objectChanged)
         algorithm_label = QLabel("Detect Algorithm: ")
         algorithm_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-        algorithm_box = QComboBox()
-        algorithm_box.addItem("U-Net")
-        object_box.currentIndexChanged.connect(self.algorithmChanged)
+        self.algorithm_box = QComboBox()
+        self.algorithm_box.addItem("U-Net")
+        self.algorithm_box.addItem("U-Net (tiled, full resolution)")
+        self.algorithm_box.currentIndexChanged.connect(self.algorithmChanged)
+        self.tiled_detection = False
         status_label = QLabel("Current Status: ")
         status_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
         self.status_show = QLabel("")
@@ -91,7 +135,7 @@ class MainWindow(QMainWindow):
         self.selection_box.addWidget(object_label)
         self.selection_box.addWidget(object_box)
         self.selection_box.addWidget(algorithm_label)
-        self.selection_box.addWidget(algorithm_box)
+        self.selection_box.addWidget(self.algorithm_box)
         self.selection_box.addWidget(status_label)
         self.selection_box.addWidget(self.status_show)
     
@@ -100,10 +144,10 @@ class MainWindow(QMainWindow):
         # to be implemented
         pass
 
-    def algorithmChanged(self):
+    def algorithmChanged(self, i):
         # change algorithm to that selected from algorithm_box
-        # to be implemented
-        pass
+        # the tiled U-Net runs on the full resolution image instead of a 320x480 copy
+        self.tiled_detection = (i == 1)
 
     def setImageLayout(self):
         # layout to display images
@@ -133,24 +177,17 @@ class MainWindow(QMainWindow):
         original_img_header.setAlignment(Qt.AlignmentFlag.AlignCenter)
         original_v_box.addWidget(original_img_header)
 
-        self.original_label = QStackedLayout()
-        self.original_label.setStackingMode(QStackedLayout.StackingMode.StackAll)
-        original_v_box.addLayout(self.original_label)
+        # the image and the ruler lines share the transform of the view
+        self.original_view = LayerView(QSize(800, 600))
+        original_v_box.addWidget(self.original_view)
 
         self.default_back_pixmap = QPixmap(QSize(800, 600))
         self.default_back_pixmap.fill(QColor(48, 76, 98))
-        self.original_layer = Background(QSize(800, 600))
-        # self.original_layer.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.original_layer.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
+        self.original_layer = Background(QSize(800, 600), self.tile_worker)
         self.ruler_layer = Ruler(QSize(800, 600))
-        self.ruler_layer.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
-
-        self.original_label.addWidget(self.ruler_layer)
-        self.original_label.addWidget(self.original_layer)
-
-        self.original_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-
-        self.ruler_layer.background_partner = self.original_layer
+        # the first added is at the bottom
+        self.original_view.addLayer(self.original_layer)
+        self.original_view.addLayer(self.ruler_layer)
     
     def setAnnotationBox(self):
         # layout to display the annotated image
@@ -163,27 +200,15 @@ class MainWindow(QMainWindow):
         annotation_img_header.setAlignment(Qt.AlignmentFlag.AlignCenter)
         annotation_v_box.addWidget(annotation_img_header)
 
-        self.annotation_label = QStackedLayout()
-        self.annotation_label.setStackingMode(QStackedLayout.StackingMode.StackAll)
-        annotation_v_box.addLayout(self.annotation_label)
+        # the image and the mask share the transform of the view
+        self.annotation_view = LayerView(QSize(800, 600))
+        annotation_v_box.addWidget(self.annotation_view)
 
-        self.back_layer = Background(QSize(800, 600))
-        # 设置成中心对齐，鼠标位置就不对了，可能要重新算过
-        self.back_layer.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        # self.back_layer.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
+        self.back_layer = Background(QSize(800, 600), self.tile_worker)
         self.canvas = Canvas(QSize(800, 600))
-        self.canvas.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        # self.canvas.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
-        # 先加入的在上面
-        self.annotation_label.addWidget(self.canvas)
-        self.annotation_label.addWidget(self.back_layer)
-        
-        self.annotation_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-
-        # self.original_layer.background_partner = self.back_layer
-        # self.back_layer.background_partner = self.original_layer
-        # self.back_layer.canvas_partner = self.canvas
-        self.canvas.background_partner = self.back_layer
+        # the first added is at the bottom
+        self.annotation_view.addLayer(self.back_layer)
+        self.annotation_view.addLayer(self.canvas)
 
     def setToolBox(self):
         # layout of tools for ruler
@@ -212,6 +237,12 @@ class MainWindow(QMainWindow):
         self.ruler_layer.related_measure_label = self.measure_label
         tool_box.addWidget(self.measure_label)
 
+        # length and width of every defect of the segmentation result, as revised
+        self.measure_defects_button = QPushButton("Measure Defects")
+        self.measure_defects_button.clicked.connect(self.measureDefects)
+        self.measure_defects_button.setFixedSize(QSize(210, 40))
+        tool_box.addWidget(self.measure_defects_button)
+
         # layout of tools for annotation
         self.canvas.is_annotation = False # set the mode of whether annotating
 
@@ -283,6 +314,14 @@ class MainWindow(QMainWindow):
         self.ruler_layer.is_measure = True
         self.ruler_layer.setCursor(QCursor(Qt.CrossCursor))
 
+    def measureDefects(self):
+        # the mask is measured at the resolution it is drawn at
+        mask_pixmap = self.canvas.mask_pixmap
+        self.defects = defect_regions(overlay_defects(mask_pixmap.toImage()))
+        self.defect_mask_scale = mask_pixmap.width() / self.original_layer.back_pixmap.width()
+        self.showDefects()
+        self.defect_dock.show()
+
     def reviseButtonChecked(self, checked):
         self.canvas.is_annotation = checked
         if checked:
@@ -327,7 +366,10 @@ class MainWindow(QMainWindow):
 
     def setInfoLayout(self):
         # layout to show infomation, like the percentage of the defects
-        pass
+        info_box = QHBoxLayout()
+        self.total_layout.addLayout(info_box)
+        self.defect_info = QLabel("")
+        info_box.addWidget(self.defect_info)
     
     def setupMenu(self):
         # Create menu bar
@@ -376,7 +418,8 @@ class MainWindow(QMainWindow):
         save_menu.addAction(save_mask_act)
 
         self.image_file = None
-        self.image = None
+        # image file being decoded by the tile_worker
+        self.opening_file = None
         # image_pixmap is managed by Background
         self.mask_file = None
         self.mask_image = None
@@ -391,6 +434,12 @@ class MainWindow(QMainWindow):
         self.segmentation_act.setStatusTip("Do semantic segmentation.")
         self.segmentation_act.triggered.connect(self.doSegmentation)
 
+        self.cancel_segmentation_act = QAction("Cancel Detect", self)
+        self.cancel_segmentation_act.setShortcut('Ctrl+Shift+G')
+        self.cancel_segmentation_act.setStatusTip("Cancel the running and queued detections.")
+        self.cancel_segmentation_act.triggered.connect(self.cancelSegmentation)
+        self.cancel_segmentation_act.setEnabled(False)
+
         self.annotation_act = QAction("Annotate", self)
         self.annotation_act.setShortcut('Ctrl+H')
         self.annotation_act.setStatusTip("Do annotation on original images.")
@@ -414,6 +463,7 @@ class MainWindow(QMainWindow):
         # Create file menu and add actions
         operation_menu = menu_bar.addMenu("Operation")
         operation_menu.addAction(self.segmentation_act)
+        operation_menu.addAction(self.cancel_segmentation_act)
         operation_menu.addSeparator()
         operation_menu.addAction(self.annotation_act)
         operation_menu.addSeparator()
@@ -428,31 +478,39 @@ class MainWindow(QMainWindow):
 
 
     def openImageFile(self):
-        status_text = self.status_show.text()
-        self.status_show.setText("Opening image...")
-
         """Open an image file and display the contents in the original label widget."""
-        self.image_file, _ = QFileDialog.getOpenFileName(self, "Open Image", 
+        image_file, _ = QFileDialog.getOpenFileName(self, "Open Image", 
             "", "Images (*.png *.jpeg *.jpg *.bmp)")
         
-        if self.image_file:
-            self.image = QImage(self.image_file) # Create QImage instance
-            # Set the pixmap for the original_layer using the QImage instance
-            self.original_layer.back_pixmap = QPixmap(self.image).scaled(
-                    self.original_layer.width(), self.original_layer.height(), Qt.KeepAspectRatio)
-            # self.original_layer.back_pixmap = QPixmap(self.image).scaled(
-            #         self.original_layer.width(), self.original_layer.height(), Qt.KeepAspectRatioByExpanding)
-            self.original_layer.updatePixmap()
-
-            self.ruler_layer.ruler_pixmap = self.ruler_layer.ruler_pixmap.scaled(self.original_layer.back_pixmap.size(), Qt.IgnoreAspectRatio)
-            self.ruler_layer.updatePixmap()
-
-            # self.adjustSize() # Adjust the size of the main window to better fit its contents   
+        if image_file:
+            # decoded with its pyramid and preview by the tile_worker, shown by imageOpened
+            self.opening_file = image_file
+            self.statusBar().showMessage("Opening image...")
+            self.tile_worker.open(image_file, self.original_view.size())
         else:
             QMessageBox.information(self, "Error",
                 "No image opened!", QMessageBox.Ok)
-        
-        self.status_show.setText(status_text)
+
+    def imageOpened(self, image_file, pyramid, preview):
+        # an image opened meanwhile, or a clear, replaces this one
+        if image_file != self.opening_file:
+            return
+        self.opening_file = None
+        self.statusBar().clearMessage()
+        if pyramid is None:
+            QMessageBox.information(self, "Error",
+                f"Cannot open {image_file}!", QMessageBox.Ok)
+            return
+
+        self.image_file = image_file
+        # the full resolution image is shown through its pyramid, tiles built on demand,
+        # and the preview, scaled from a pyramid level, until they are built
+        self.original_layer.pyramid = pyramid
+        self.original_layer.back_pixmap = QPixmap.fromImage(preview)
+        self.original_layer.updatePixmap()
+
+        self.ruler_layer.ruler_pixmap = self.ruler_layer.ruler_pixmap.scaled(self.original_layer.back_pixmap.size(), Qt.IgnoreAspectRatio)
+        self.ruler_layer.updatePixmap()
             
     def openMaskFile(self):
         status_text = self.status_show.text()
@@ -486,21 +544,11 @@ class MainWindow(QMainWindow):
 
                 self.mask_image = QImage(self.mask_file) # Create QImage instance
                 # set the pixel transparency
-                w = self.mask_image.width()
-                h = self.mask_image.height()
-                for i in range(w):
-                    for j in range(h):
-                        pixel_color = self.mask_image.pixelColor(i, j)
-                        if pixel_color == QColor(0, 0, 0):
-                            pixel_color.setAlphaF(0)
-                            self.mask_image.setPixelColor(i, j, pixel_color)
-                        elif pixel_color == QColor(255, 255, 255):
-                            pixel_color.setAlphaF(0.6)
-                            self.mask_image.setPixelColor(i, j, pixel_color)
+                self.mask_image = mask_to_overlay(self.mask_image)
                 
                 # # Set the pixmap for the annotation_label using the QImage instance
                 self.canvas.mask_pixmap = QPixmap(self.mask_image).scaled(
-                        self.canvas.width(), self.canvas.height(), Qt.KeepAspectRatio)
+                        self.annotation_view.width(), self.annotation_view.height(), Qt.KeepAspectRatio)
                 self.canvas.updatePixmap() # Qpainter is related to self.mask_pixmap
 
                 # self.adjustSize() # Adjust the size of the main window to better fit its contents
@@ -543,14 +591,7 @@ class MainWindow(QMainWindow):
                 write_confirmed = True
         
             if write_confirmed:
-                mask = self.canvas.mask_pixmap.toImage()
-                w = mask.width()
-                h = mask.height()
-                for i in range(w):
-                    for j in range(h):
-                        pixel_color = mask.pixelColor(i, j)
-                        pixel_color.setAlphaF(1)
-                        mask.setPixelColor(i, j, pixel_color)
+                mask = overlay_to_binary(self.canvas.mask_pixmap.toImage())
                 
                 mask.save(self.mask_save, quality=100)
         
@@ -597,14 +638,7 @@ class MainWindow(QMainWindow):
                 write_confirmed = True
         
             if write_confirmed:
-                mask = self.canvas.mask_pixmap.toImage()
-                w = mask.width()
-                h = mask.height()
-                for i in range(w):
-                    for j in range(h):
-                        pixel_color = mask.pixelColor(i, j)
-                        pixel_color.setAlphaF(1)
-                        mask.setPixelColor(i, j, pixel_color)
+                mask = overlay_to_binary(self.canvas.mask_pixmap.toImage())
 
                 mask.save(self.mask_save, quality=100)
 
@@ -616,76 +650,92 @@ class MainWindow(QMainWindow):
 
     def doSegmentation(self):
         if self.image_file:
-            status_text = self.status_show.text()
-            self.status_show.setText("Doing segmentation...")
-            before_cursor = self.cursor()
-            self.setCursor(QCursor(Qt.BusyCursor))
-
-            # first transfer QPixmap to QImage, then to PIL image, and finally to tensor
-            input = self.original_layer.back_pixmap.toImage()
-            input = ImageQt.fromqimage(input)
-            input = input.convert('L')
-            input_size = input.size
-            print(input_size)
-            resize = torchvision.transforms.Resize((320, 480))
-            input = resize(input)
-            tt = torchvision.transforms.ToTensor()
-            input = tt(input)
-            input = torch.unsqueeze(input, 0)
-            input = input.cuda()
-
-            # predict
-            self.detect_model.eval()
-            output = self.detect_model(input)
-
-            # first transfer tensor to PIL, and then to QIamge & QPixmap
-            output = torch.squeeze(output, 0)
-            # print(output.size())
-            output_b = (output > 0.5) * 1.0
-            tp = torchvision.transforms.ToPILImage()
-            output_b = tp(output_b)
+            # detection runs in the background, the operator can keep working
+            # and queue the next image before this one is finished
+            if self.tiled_detection:
+                # detect on overlapping 320x480 tiles of the full resolution image
+                input = self.original_layer.pyramid.image
+            else:
+                # detect on a 320x480 copy of the displayed image
+                input = self.original_layer.back_pixmap.toImage()
+            job_id = self.segmentation_worker.submit(
+                    input, self.original_layer.back_pixmap.size(), self.tiled_detection)
+            # the defects are measured on the mask, at the resolution of the input
+            self.segmentation_jobs[job_id] = (self.image_file, input.width())
+            self.cancel_segmentation_act.setEnabled(True)
+            if len(self.segmentation_jobs) == 1:
+                self.segmentationProgress(job_id, 0)
             
-            size_back = torchvision.transforms.Resize((input_size[1], input_size[0]), torchvision.transforms.InterpolationMode.NEAREST)
-            output_b = size_back(output_b)
-            # output_b = output_b.convert('RGB')
-            predict_mask = output_b.toqpixmap()
-
-            predict_mask_image = predict_mask.toImage() # Create QImage instance
-            trans_mask_image = QImage(predict_mask_image.size(), QImage.Format_ARGB32)
-            # set the pixel transparency
-            w = predict_mask_image.width()
-            h = predict_mask_image.height()
-            for i in range(w):
-                for j in range(h):
-                    pixel_color = predict_mask_image.pixelColor(i, j)
-                    if pixel_color == QColor(0, 0, 0):
-                        pixel_color.setAlphaF(0)
-                        # print(pixel_color.alphaF())
-                        trans_mask_image.setPixelColor(i, j, pixel_color)
-                        # print(predict_mask_image.pixelColor(i, j).alphaF())
-                    elif pixel_color == QColor(255, 255, 255):
-                        pixel_color.setAlphaF(0.6)
-                        trans_mask_image.setPixelColor(i, j, pixel_color)
+        else:
+            QMessageBox.information(self, "Error",
+                "No image opened!", QMessageBox.Ok)
 
+    def cancelSegmentation(self):
+        self.segmentation_worker.cancel()
+
+    def segmentationProgress(self, job_id, percent):
+        queued = len(self.segmentation_jobs) - 1
+        message = f"Doing segmentation... {percent}%"
+        if queued > 0:
+            message += f" ({queued} queued)"
+        self.statusBar().showMessage(message)
+
+    def segmentationFinished(self, job_id, overlay, regions):
+        image_file, mask_width = self.segmentation_jobs.pop(job_id, (None, None))
+        # the result is dropped if another image has been opened meanwhile
+        if image_file is not None and image_file == self.image_file:
             self.back_layer.back_pixmap = self.original_layer.back_pixmap
+            self.back_layer.pyramid = self.original_layer.pyramid
             self.back_layer.updatePixmap()
-            self.canvas.mask_pixmap = QPixmap(trans_mask_image)
+            self.canvas.mask_pixmap = QPixmap(overlay)
             self.canvas.updatePixmap()
+            self.defects = regions
+            self.defect_mask_scale = mask_width / self.original_layer.back_pixmap.width()
+            self.showDefects()
+            self.defect_dock.show()
+        self.segmentationDone()
+
+    def showDefects(self):
+        # the ruler measures displayed pixels, the defects are in mask pixels
+        if self.defects is None:
+            self.defect_info.setText("")
+            self.defect_panel.setRegions(None)
+            return
+        pix_per_mm = self.ruler_layer.pix_per_length * self.defect_mask_scale
+        regions = regions_in_mm(self.defects, pix_per_mm) if pix_per_mm else self.defects
+        self.defect_panel.setRegions(regions)
+        self.defect_info.setText(self.defect_panel.summary)
+
+    def segmentationFailed(self, job_id, message):
+        self.segmentation_jobs.pop(job_id, None)
+        self.segmentationDone()
+        QMessageBox.information(self, "Error",
+            f"Segmentation failed: {message}", QMessageBox.Ok)
+
+    def segmentationCancelled(self, job_id):
+        self.segmentation_jobs.pop(job_id, None)
+        self.segmentationDone()
+
+    def segmentationDone(self):
+        if self.segmentation_jobs:
+            return
+        self.statusBar().clearMessage()
+        self.cancel_segmentation_act.setEnabled(False)
 
-            self.status_show.setText(status_text)
-            self.setCursor(before_cursor)
-            
-        else:
-            QMessageBox.information(self, "Error",
-                "No image opened!", QMessageBox.Ok)
-            
-        
+    def closeEvent(self, e):
+        self.segmentation_worker.stop()
+        self.tile_worker.stop()
+        if self.training_worker is not None:
+            self.training_worker.cancel()
+            self.training_worker.wait()
+        super().closeEvent(e)
 
     def doAnnotation(self):
         # first copy the original image as background
         if self.image_file:
             # Set the pixmap for the annotation_label using the QImage instance
             self.back_layer.back_pixmap = self.original_layer.back_pixmap
+            self.back_layer.pyramid = self.original_layer.pyramid
             self.back_layer.updatePixmap()
             # print(self.back_layer.back_pixmap.size())
             # print(self.back_layer.size())
@@ -728,19 +778,23 @@ class MainWindow(QMainWindow):
 
     def doClear(self):
         self.original_layer.back_pixmap = self.default_back_pixmap
+        self.original_layer.pyramid = None
         self.original_layer.updatePixmap()
         self.ruler_layer.ruler_pixmap = QPixmap(QSize(800, 600))
         self.ruler_layer.ruler_pixmap.fill(self.ruler_layer.back_color)
         self.ruler_layer.updatePixmap()
         self.ruler_layer.pix_per_length = 0
+        self.defects = None
+        self.showDefects()
         self.back_layer.back_pixmap = self.default_back_pixmap
+        self.back_layer.pyramid = None
         self.back_layer.updatePixmap()
         self.canvas.mask_pixmap = QPixmap(QSize(800, 600))
         self.canvas.mask_pixmap.fill(self.canvas.back_color)
         self.canvas.updatePixmap()
 
         self.image_file = None
-        self.image = None
+        self.opening_file = None
         self.mask_file = None
         self.mask_image = None
 
@@ -753,16 +807,36 @@ class MainWindow(QMainWindow):
         self.status_show.setText("")
     
     def doRetrainModel(self):
-        status_text = self.status_show.text()
-        self.status_show.setText("Updating model parameters...")
-        before_cursor = self.cursor()
-        self.setCursor(Qt.BusyCursor)
+        if self.training_worker is not None:
+            return
+        self.statusBar().showMessage("Updating model parameters...")
+        self.retrain_act.setEnabled(False)
 
+        n_epochs = 10
+        # train the model
+        # WARN!!!!!!
+        # if you are very sure to overwrite the original parameter, change the parameter file to "model.pt"
+        self.training_worker = TrainingWorker(self.prepareRetraining, n_epochs, self.device, 'model_retrain.pt', self)
+        self.training_worker.batch_loss.connect(self.training_panel.addBatchLoss)
+        self.training_worker.epoch_loss.connect(self.training_panel.addEpochLoss)
+        self.training_worker.trained.connect(self.retrainFinished)
+        self.training_worker.failed.connect(self.retrainFailed)
+        self.training_worker.cancelled.connect(self.retrainCancelled)
+        self.training_panel.start(self.training_worker, n_epochs)
+        self.training_dock.show()
+        self.training_worker.start()
+
+    def prepareRetraining(self):
+        # runs in the training thread: make datasets, loaders, model, criterion and optimizer
         # some basic settings
-        train_on_gpu = torch.cuda.is_available()
         batch_size = 16
-        num_workers = 0
-        n_epochs = 10
+        num_workers = None  # one loader process per available core but one
+        fast_training = False  # mixed precision and channels_last, check with `benchmark.py amp`
+        input_size = (320, 480)  # training crops, e.g. (640, 960) to keep small defects visible
+        micro_batch_size = None  # accumulate the gradients of smaller micro-batches, and
+        checkpointing = False    # recompute activations, to save memory (`benchmark.py memory`)
+        patience = 3  # stop after this many epochs without improvement
+        checkpoint_path = 'model_retrain.ckpt'  # full training state, saved after each epoch
         optimizer_type = 'Adam' """Either Adam or SGD, adjust the learning rate in the
                                 "Specify the loss function and optimizer" section"""
         criterion_type = 'TverskyLoss'  """ Adjust the penalties in the "Specify the loss 
@@ -773,64 +847,102 @@ class MainWindow(QMainWindow):
         for c in ['set1', 'set2']:
             image_path[c] = glob('dataset/' + c + '/*.jpeg',recursive=True)
 
+        # decoded and resized pairs are cached, only the pairs saved or revised
+        # since the last update are decoded again
+        cache_dir = 'dataset/.cache'
+        DatasetCache(cache_dir, input_size).prune(image_path['set1'] + image_path['set2'])
+
         fucai_defect_dataset ={}
-        fucai_defect_dataset['train'] = DefectDetectionDataset (image_path['set1'], 'train')
-        fucai_defect_dataset['val'] = DefectDetectionDataset (image_path['set2'], 'val')
+        # the loaders collate uint8 pairs, the augmentation runs on whole batches on the device
+        fucai_defect_dataset['train'] = DefectDetectionDataset (image_path['set1'], 'train', input_size, cache_dir=cache_dir,
+                                                                batch_transform=True)
+        fucai_defect_dataset['val'] = DefectDetectionDataset (image_path['set2'], 'val', input_size, cache_dir=cache_dir,
+                                                              batch_transform=True)
+        gray = all(fucai_defect_dataset[phase].gray_images() for phase in ['train', 'val'])
+        batch_transforms = {'train': BatchAugmentation(gray=gray),
+                            'val': BatchAugmentation(augment=False, gray=gray)}
         
+        # decode in parallel worker processes, sized from the available cores
         loaders={}
-        loaders['train'] = torch.utils.data.DataLoader(fucai_defect_dataset['train'], 
-                                                    batch_size=batch_size,
-                                                    shuffle=True,
-                                                    num_workers=num_workers)
-        loaders['val'] = torch.utils.data.DataLoader(fucai_defect_dataset['val'], 
-                                                    batch_size=batch_size,
-                                                    shuffle=False, 
-                                                    num_workers=num_workers)
+        loaders['train'] = make_loader(fucai_defect_dataset['train'], batch_size, self.device,
+                                       shuffle=True, num_workers=num_workers)
+        loaders['val'] = make_loader(fucai_defect_dataset['val'], batch_size, self.device,
+                                     shuffle=False, num_workers=num_workers)
         
         # set train details
-        self.detect_model.load_state_dict(torch.load('model.pt'))
-        if train_on_gpu:
-            self.detect_model.cuda()
-
-        positive_weight = 0
-        negative_weight = 0
-        total_pixels = 0
-        for _, target in fucai_defect_dataset['train']:
-            positive_weight += ((target.cpu().numpy()) >= 0.5).sum()
-            negative_weight += ((target.cpu().numpy()) < 0.5).sum()
-            total_pixels += (320 * 480)
-        positive_weight /= total_pixels
-        negative_weight /= total_pixels
+        # train a separate model, self.detect_model keeps serving detections meanwhile
+        # the losses take the pre-sigmoid outputs, stable and without temporaries
+        model = UNet_2D(1,1,32,0.2, return_logits=True).to(self.device)
+        model.load_state_dict(load_state_dict('model.pt', self.device))
+
+        # pixel ratios from the raw masks, only new or revised masks are read again
+        stats = MaskStatistics('dataset/.stats.csv').update(image_path['set1'])
+        positive_weight, negative_weight = class_weights(stats)
         print('positive weight = ',positive_weight, '\tnegative weight = ', negative_weight)
 
         if criterion_type == 'WeightedBCE':
             weight = np.array([negative_weight, positive_weight])
             weight = torch.from_numpy(weight)
-            criterion = WeightedBCELoss(weights=weight)
+            criterion = WeightedBCEWithLogitsLoss(weights=weight)
         else:
-            criterion = TverskyLoss(1e-10,0.3,.7)
+            criterion = TverskyWithLogitsLoss(1e-10,0.3,.7)
+        learning_rate = 0.00005 if optimizer_type == 'SGD' else 0.0001
         if optimizer_type == 'SGD':
-            optimizer = optim.SGD(self.detect_model.parameters(), lr=0.00005, momentum=0.9)
+            optimizer = optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
         else:
-            optimizer = optim.Adam(self.detect_model.parameters(), lr = 0.0001)
-        
-        # train the model
-        # WARN!!!!!!
-        # if you are very sure to overwrite the original parameter, change the parameter file to "model.pt"
-        self.detect_model = train_2D(n_epochs, loaders, self.detect_model, optimizer, criterion, train_on_gpu, 'model_retrain.pt')
-        loss=pd.read_csv('loss_epoch.csv',header=0,index_col=False)
-        plt.plot(loss['epoch'],loss['Training Loss'],'r',loss['epoch'],loss['Validation Loss'],'g')
-        plt.xlabel('epochs')
-        plt.ylabel('Loss')
-        plt.legend(labels=['Train','Valid'])
-        plt.show()
-        plt.savefig('loss_epoch.png')
-
-        self.detect_model.load_state_dict(torch.load('model_retrain.pt'))
-
-        self.status_show.setText(status_text)
-        self.setCursor(before_cursor)
+            optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+        # halve the learning rate when the validation loss stops decreasing
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=1)
+
+        # continue an interrupted retraining, or start from the best parameters and the
+        # optimizer state of the last retraining
+        resume = False
+        if os.path.exists(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path, self.device)
+            if not checkpoint['stopped'] and checkpoint['epoch'] < checkpoint['n_epochs']:
+                resume = True
+            else:
+                # the checkpoint holds the last epoch, model_retrain.pt the best one
+                best_path = 'model_retrain.pt'
+                model.load_state_dict(load_state_dict(best_path, self.device)
+                                      if os.path.exists(best_path) else checkpoint['model'])
+                optimizer.load_state_dict(checkpoint['optimizer'])
+                # the scheduler of the last retraining cut the saved learning rate, each
+                # retraining starts again from the configured one
+                for group in optimizer.param_groups:
+                    group['lr'] = learning_rate
+                    if 'initial_lr' in group:
+                        group['initial_lr'] = learning_rate
         
+        return dict(loaders=loaders, model=model, optimizer=optimizer, criterion=criterion,
+                    batch_transforms=batch_transforms, amp=fast_training,
+                    channels_last=fast_training, micro_batch_size=micro_batch_size,
+                    checkpointing=checkpointing, checkpoint_path=checkpoint_path, resume=resume,
+                    scheduler=scheduler, patience=patience)
+
+    def retrainFinished(self, model):
+        # hot-swap the new parameters, the detection in progress finishes with the old ones
+        model.return_logits = False
+        model = model.fuse_for_inference()
+        self.detect_model = model
+        self.segmentation_worker.model = model
+        self.training_panel.figure.savefig('loss_epoch.png')
+        self.retrainDone("Model parameters updated.")
+
+    def retrainFailed(self, message):
+        self.retrainDone("Updating model parameters failed.")
+        QMessageBox.information(self, "Error",
+            f"Updating model parameters failed: {message}", QMessageBox.Ok)
+
+    def retrainCancelled(self):
+        self.retrainDone("Updating model parameters cancelled.")
+
+    def retrainDone(self, message):
+        self.training_worker.wait()
+        self.training_worker = None
+        self.training_panel.stop(message)
+        self.statusBar().showMessage(message, 5000)
+        self.retrain_act.setEnabled(True)
 
     def setupToolbar(self):
         toolbar = QToolBar("Operation")
@@ -842,6 +954,7 @@ class MainWindow(QMainWindow):
         # actions have been defined in setupMenu
         toolbar.addSeparator()
         toolbar.addAction(self.segmentation_act)
+        toolbar.addAction(self.cancel_segmentation_act)
         toolbar.addSeparator()
         toolbar.addAction(self.annotation_act)
         toolbar.addSeparator()
@@ -853,58 +966,119 @@ class MainWindow(QMainWindow):
         toolbar.addSeparator()
 
 
-class Background(QLabel):
+# Draw only the part of pixmap under the exposed widget rect, for a painter scaled by
+# scale with the pixmap at lefttop: brush strokes repaint a few hundred pixels instead of
+# resampling the whole 4K image. The source is aligned to whole pixels, so the result is
+# the same as drawing the whole pixmap.
+def draw_exposed(painter, rect, pixmap, lefttop, scale):
+    source = QRectF(rect.x() / scale - lefttop.x(), rect.y() / scale - lefttop.y(),
+                    rect.width() / scale, rect.height() / scale)
+    source = source.toAlignedRect().adjusted(-1, -1, 1, 1).intersected(pixmap.rect())
+    if not source.isEmpty():
+        painter.drawPixmap(QRectF(source).translated(lefttop), pixmap, QRectF(source))
+
+
+class LayerView(QWidget):
+    # One widget showing a stack of layers, the first added at the bottom, with one
+    # transform for all of them: the middle button drags and the wheel scales the view,
+    # and each frame is painted once for all the layers. While the transform changes, the
+    # layers are drawn straight onto the widget. Once a layer changes, each layer is kept
+    # drawn at the current transform in a cache of the widget size, and only the parts
+    # changed since the last frame are drawn again: a brush stroke redraws the mask under
+    # the stroke and composes it over the cached background.
     def __init__(self, img_size):
         super().__init__()
-        self.back_pixmap = QPixmap(img_size)
-        self.back_pixmap.fill(QColor(48, 76, 98))
-        self.updatePixmap()
+        self.img_size = img_size
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.layers = []
+        self.caches = [] # layer drawn at the current transform
+        self.dirty = [] # QRegion of the cache to draw again
+        self.cached = False # whether the caches are of the current transform
 
         # for transformation
         # =========================================
         # QPainter coord
         self.lefttop = QPointF(0, 0)
-        self.moved_lefttop = QPointF(0, 0)
         # QWidget coord
         self.original_center = QPointF(img_size.width() / 2, img_size.height() / 2)
         self.start_pos = None
-        self.end_pos = None
         self.middle_click = False
+        self.cursor_before_move = self.cursor()
         self.scale = 1
-
-        # reference of partner canvas and background
-        # all the images transform together
-        self.canvas_partner = None
-        self.background_partner = None
         # =========================================
 
-    
-    def updatePixmap(self):
-        self.setPixmap(self.back_pixmap)
+    def sizeHint(self):
+        return self.img_size
+
+    def minimumSizeHint(self):
+        return self.img_size
+
+    def addLayer(self, layer):
+        layer.view = self
+        self.layers.append(layer)
+        self.caches.append(None)
+        self.dirty.append(QRegion())
+        self.cached = False
+        self.update()
+
+    # top left corner of a pixmap in QPainter coord, centered in the widget
+    def origin(self, pixmap):
+        move_x = self.original_center.x() / self.scale - pixmap.width() / 2
+        move_y = self.original_center.y() / self.scale - pixmap.height() / 2
+        return QPointF(self.lefttop.x() + move_x, self.lefttop.y() + move_y)
+
+    def toPixmap(self, layer, pos):
+        origin = self.origin(layer.pixmap())
+        return QPointF(pos.x() / self.scale - origin.x(), pos.y() / self.scale - origin.y())
+
+    # rect: part of the layer pixmap to draw again, all of it when None
+    # cache: whether to start caching the layers, False when only the drawing of an
+    # unchanged layer is refined, so that pans and zooms stay uncached
+    def updateLayer(self, layer, rect=None, cache=True):
+        i = self.layers.index(layer)
+        if rect is None:
+            dirty = self.rect()
+        else:
+            rect = rect.translated(self.origin(layer.pixmap()))
+            dirty = QRectF(rect.x() * self.scale, rect.y() * self.scale,
+                           rect.width() * self.scale, rect.height() * self.scale)
+            dirty = dirty.toAlignedRect().intersected(self.rect())
+        if not self.cached:
+            if not cache:
+                self.update(dirty)
+                return
+            self.cached = True
+            self.dirty = [QRegion(self.rect()) for _ in self.layers]
+        self.dirty[i] = self.dirty[i].united(dirty)
+        self.update(dirty)
+
+    def updateTransform(self):
+        self.cached = False
         self.update()
 
+    def resizeEvent(self, e):
+        self.caches = [None for _ in self.layers]
+        self.updateTransform()
+
     # see https://blog.csdn.net/hi_sir_destroy/article/details/120049703
     # ====================================================================
     def mousePressEvent(self, e):
-        """
-        mouse press events for the widget
-        :param e: QMouseEvent
-        :return:
-        """
         if e.button() == Qt.MiddleButton:
             self.middle_click = True
             self.start_pos = e.pos()
+            self.cursor_before_move = self.cursor()
             self.setCursor(QCursor(Qt.ClosedHandCursor))
- 
+        else:
+            for layer in reversed(self.layers):
+                layer.mousePressEvent(e)
+
     def mouseReleaseEvent(self, e):
-        """
-        mouse release events for the widget
-        :param e: QMouseEvent
-        :return:
-        """
         if e.button() == Qt.MiddleButton:
             self.middle_click = False
-            self.setCursor(QCursor(Qt.ArrowCursor))
+            self.setCursor(self.cursor_before_move)
+        else:
+            for layer in reversed(self.layers):
+                layer.mouseReleaseEvent(e)
 
     def wheelEvent(self, e):
         angle = e.angleDelta() / 8  # 返回QPoint对象，为滚轮转过的数值，单位为1/8度
@@ -914,72 +1088,185 @@ class Background(QLabel):
             self.scale *= 1.1
         else:  # 滚轮下滚
             self.scale *= 1 / 1.1
-        # self.adjustSize()
-        self.update()
-    
+        self.updateTransform()
+
     def mouseMoveEvent(self, e):
-        """
-        mouse move events for the widget
-        :param e: QMouseEvent
-        :return:
-        """
         if self.middle_click:
-            self.end_pos = e.pos()
             # QPainter coord
-            move_distance = (self.end_pos - self.start_pos) / self.scale # scale the distance
+            move_distance = (e.pos() - self.start_pos) / self.scale # scale the distance
             self.lefttop = self.lefttop + move_distance
             self.start_pos = e.pos()
-            self.update()
-    
+            self.updateTransform()
+        else:
+            for layer in reversed(self.layers):
+                layer.mouseMoveEvent(e)
+
     def paintEvent(self, e):
-        """
-        receive paint events
-        :param e: QPaintEvent
-        :return:
-        """
-        if self.back_pixmap:
-            scale_painter = QPainter()
-            scale_painter.begin(self)
-            scale_painter.scale(self.scale, self.scale)
-            # QPainter coord
-            # move to the canter of widget to display
-            move_x = self.original_center.x() / self.scale - self.back_pixmap.width() / 2
-            move_y = self.original_center.y() / self.scale - self.back_pixmap.height() / 2
-            self.moved_lefttop = QPointF(self.lefttop.x() + move_x, self.lefttop.y() + move_y)
-            # QPainter coord
-            scale_painter.drawPixmap(self.moved_lefttop, self.back_pixmap)
-            scale_painter.end()
-            self.updateCanvasPartner()
-            self.updateBackgroundPartner()
+        painter = QPainter(self)
+        if not self.cached:
+            painter.scale(self.scale, self.scale)
+        for i, layer in enumerate(self.layers):
+            layer.prepare()
+            if not self.cached:
+                layer.draw(painter, e.rect(), self.origin(layer.pixmap()), self.scale)
+                continue
+            if not self.dirty[i].isEmpty():
+                self.drawCache(i)
+            painter.drawPixmap(e.rect(), self.caches[i], e.rect())
+        painter.end()
     # ====================================================================
 
-    def updateCanvasPartner(self):
-        if self.canvas_partner:
-            self.canvas_partner.lefttop = self.lefttop
-            self.canvas_partner.start_pos = self.start_pos
-            self.canvas_partner.end_pos = self.end_pos
-            self.canvas_partner.scale = self.scale
+    def drawCache(self, i):
+        if self.caches[i] is None:
+            self.caches[i] = QPixmap(self.size())
+            self.caches[i].fill(Qt.transparent) # with an alpha channel
+        dirty = self.dirty[i].boundingRect()
+        painter = QPainter(self.caches[i])
+        painter.setClipRect(dirty)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(dirty, Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.scale(self.scale, self.scale)
+        layer = self.layers[i]
+        layer.draw(painter, dirty, self.origin(layer.pixmap()), self.scale)
+        painter.end()
+        self.dirty[i] = QRegion()
+
+
+class Layer(QObject):
+    # One pixmap of a LayerView. The mouse events of the view, but the middle button and
+    # the wheel, are passed on to its layers, top first.
+    def __init__(self):
+        super().__init__()
+        self.view = None
 
-            self.canvas_partner.update()
-    
-    def updateBackgroundPartner(self):
-        if self.background_partner:
-            self.background_partner.lefttop = self.lefttop
-            self.background_partner.start_pos = self.start_pos
-            self.background_partner.end_pos = self.end_pos
-            self.background_partner.scale = self.scale
+    def pixmap(self):
+        raise NotImplementedError
+
+    def updatePixmap(self):
+        self.update()
+
+    # rect: changed part of the pixmap, all of it when None
+    def update(self, rect=None):
+        if self.view is not None:
+            self.view.updateLayer(self, rect)
+
+    # position in the pixmap of a mouse event
+    def toPixmap(self, pos):
+        return self.view.toPixmap(self, pos)
+
+    def setCursor(self, cursor):
+        if self.view is not None:
+            self.view.setCursor(cursor)
+
+    # called before the layer is composed into a frame
+    def prepare(self):
+        pass
+
+    # draw the part of the layer under the widget rect, for a painter scaled by scale
+    # with the pixmap at origin
+    def draw(self, painter, rect, origin, scale):
+        draw_exposed(painter, rect, self.pixmap(), origin, scale)
 
-            self.background_partner.update()
+    def mousePressEvent(self, e):
+        pass
+
+    def mouseReleaseEvent(self, e):
+        pass
+
+    def mouseMoveEvent(self, e):
+        pass
 
 
-class Ruler(QLabel):
+class Background(Layer):
+    # With a pyramid, the image is drawn at the resolution of the zoom from the tiles of
+    # the matching pyramid level, only those under the exposed rect. The back_pixmap, the
+    # image scaled to the view, still sets the layer coordinates and is drawn where the
+    # tile_worker has not built the tiles yet.
+    def __init__(self, img_size, tile_worker=None):
+        super().__init__()
+        self.back_pixmap = QPixmap(img_size)
+        self.back_pixmap.fill(QColor(48, 76, 98))
+        self.pyramid = None
+        self.tile_worker = tile_worker
+        if tile_worker is not None:
+            tile_worker.tile_ready.connect(self.tileReady)
+
+    def pixmap(self):
+        return self.back_pixmap
+
+    # image pixels per layer pixel
+    def imageScale(self):
+        return (self.pyramid.width / self.back_pixmap.width(),
+                self.pyramid.height / self.back_pixmap.height())
+
+    # rect of a pyramid tile in layer coordinates
+    def tileRect(self, level, tx, ty):
+        sx, sy = self.imageScale()
+        x0, y0, x1, y1 = self.pyramid.tileBounds(level, tx, ty)
+        return QRectF((x0 << level) / sx, (y0 << level) / sy,
+                      ((x1 - x0) << level) / sx, ((y1 - y0) << level) / sy)
+
+    # pyramid level and tiles under a widget rect, no tiles when the level is 0
+    def tilesUnder(self, rect, origin, scale):
+        # widget rect in full resolution pixels
+        sx, sy = self.imageScale()
+        x0 = max(math.floor((rect.left() / scale - origin.x()) * sx), 0)
+        y0 = max(math.floor((rect.top() / scale - origin.y()) * sy), 0)
+        x1 = min(math.ceil(((rect.right() + 1) / scale - origin.x()) * sx), self.pyramid.width)
+        y1 = min(math.ceil(((rect.bottom() + 1) / scale - origin.y()) * sy), self.pyramid.height)
+        level = self.pyramid.levelFor(min(sx, sy) / scale)
+        if level == 0 or x0 >= x1 or y0 >= y1:
+            return level, []
+        return level, self.pyramid.tilesCovering(level, x0, y0, x1, y1)
+
+    def draw(self, painter, rect, origin, scale):
+        if self.pyramid is None or self.back_pixmap.isNull():
+            super().draw(painter, rect, origin, scale)
+            return
+        level, keys = self.tilesUnder(rect, origin, scale)
+        if level == 0:
+            # zoomed in to full resolution, the image is drawn as a pixmap would be
+            sx, sy = self.imageScale()
+            source = QRectF(rect.x() / scale - origin.x(), rect.y() / scale - origin.y(),
+                            rect.width() / scale, rect.height() / scale)
+            source = QRectF(source.left() * sx, source.top() * sy,
+                            source.width() * sx, source.height() * sy)
+            source = source.toAlignedRect().adjusted(-1, -1, 1, 1).intersected(self.pyramid.image.rect())
+            if not source.isEmpty():
+                target = QRectF(source.x() / sx, source.y() / sy, source.width() / sx, source.height() / sy)
+                painter.drawImage(target.translated(origin), self.pyramid.image, QRectF(source))
+            return
+
+        tiles = [self.pyramid.cache.get(key) for key in keys]
+        if None in tiles and self.tile_worker is None:
+            tiles = [self.pyramid.tile(*key) for key in keys]
+        elif None in tiles:
+            # the scaled image until the tiles are built, those of the whole view
+            draw_exposed(painter, rect, self.back_pixmap, origin, scale)
+            _, visible = self.tilesUnder(self.view.rect(), origin, scale)
+            self.tile_worker.request(self.pyramid, [key for key in visible
+                                                    if self.pyramid.cache.get(key) is None],
+                                     self)
+        for key, tile in zip(keys, tiles):
+            if tile is not None:
+                painter.drawImage(self.tileRect(*key).translated(origin), tile)
+
+    def tileReady(self, pyramid, level, tx, ty):
+        if pyramid is self.pyramid and self.view is not None:
+            self.view.updateLayer(self, self.tileRect(level, tx, ty), cache=False)
+
+
+class Ruler(Layer):
+    # pix_per_length set by the operator
+    scale_changed = pyqtSignal(float)
+
     def __init__(self, img_size):
         super().__init__()
         self.ruler_pixmap = QPixmap(img_size)
         self.back_color = QColor(0, 0, 0)
         self.back_color.setAlphaF(0)
         self.ruler_pixmap.fill(self.back_color)
-        self.updatePixmap()
 
         self.first_x, self.first_y, self.second_x, self.second_y = None, None, None, None
         self.is_first_point = True
@@ -993,52 +1280,26 @@ class Ruler(QLabel):
         self.is_ruler = False
         self.is_measure = False
 
-        # for transformation
-        # =========================================
-        # QPainter coord
-        self.lefttop = QPointF(0, 0)
-        self.moved_lefttop = QPointF(0, 0)
-        # QWidget coord
-        self.original_center = QPointF(img_size.width() / 2, img_size.height() / 2)
-        self.start_pos = None
-        self.end_pos = None
-        self.middle_click = False
-        self.scale = 1
-
-        # reference of partner canvas and background
-        # all the images transform together
-        self.background_partner = None
-        # =========================================
-
         self.entered_length = 0
         self.selected_pix = 0
         self.pix_per_length = 0
         self.related_ruler_label = QLabel()
         self.related_measure_label = QLabel()
 
-    
-    def updatePixmap(self):
-        self.setPixmap(self.ruler_pixmap)
-        self.update()
+    def pixmap(self):
+        return self.ruler_pixmap
 
-    # see https://blog.csdn.net/hi_sir_destroy/article/details/120049703
-    # ====================================================================
     def mousePressEvent(self, e):
         """
         mouse press events for the widget
         :param e: QMouseEvent
         :return:
         """
-        if e.button() == Qt.MiddleButton:
-            self.middle_click = True
-            self.start_pos = e.pos()
-            self.setCursor(QCursor(Qt.ClosedHandCursor))
-        
         if e.button() == Qt.LeftButton:
             if self.is_annotation:
                 if self.is_measure:
                     if self.pix_per_length == 0:
-                        QMessageBox.information(self, "Error",
+                        QMessageBox.information(self.view, "Error",
                             "No scale added!", QMessageBox.Ok)
                         self.is_measure = False
                         self.setCursor(QCursor(Qt.ArrowCursor))
@@ -1047,11 +1308,9 @@ class Ruler(QLabel):
 
                 if self.is_first_point:
                     self.ruler_pixmap.fill(self.back_color)
-                    self.updatePixmap()
-                    self.first_x = (e.x() - self.moved_lefttop.x() * self.scale) / self.scale
-                    self.first_y = (e.y() - self.moved_lefttop.y() * self.scale) / self.scale
+                    point = self.toPixmap(e.pos())
+                    self.first_x, self.first_y = point.x(), point.y()
                     self.point_painter = QPainter(self.ruler_pixmap)
-                    self.setPixmap(self.ruler_pixmap)
                     self.pp = self.point_painter.pen()
                     self.pp.setWidth(self.point_width)
                     self.pp.setColor(self.point_color)
@@ -1061,20 +1320,17 @@ class Ruler(QLabel):
                     self.update()
                     self.is_first_point = False
                 else:
-                    self.second_x = (e.x() - self.moved_lefttop.x() * self.scale) / self.scale
-                    self.second_y = (e.y() - self.moved_lefttop.y() * self.scale) / self.scale
+                    point = self.toPixmap(e.pos())
+                    self.second_x, self.second_y = point.x(), point.y()
                     self.point_painter = QPainter(self.ruler_pixmap)
-                    self.setPixmap(self.ruler_pixmap)
                     self.pp = self.point_painter.pen()
                     self.pp.setWidth(self.point_width)
                     self.pp.setColor(self.point_color)
                     self.point_painter.setPen(self.pp)
                     self.point_painter.drawPoint(QPointF(self.second_x, self.second_y))
                     self.point_painter.end()
-                    self.update()
 
                     self.line_painter = QPainter(self.ruler_pixmap)
-                    self.setPixmap(self.ruler_pixmap)
                     self.lp = self.line_painter.pen()
                     self.lp.setWidth(self.line_width)
                     self.lp.setColor(self.line_color)
@@ -1086,16 +1342,17 @@ class Ruler(QLabel):
                     self.selected_pix = math.sqrt((self.first_x - self.second_x) ** 2 + (self.first_y - self.second_y) ** 2)
 
                     if self.is_ruler:
-                        self.entered_length, ok = QInputDialog.getDouble(self, "Pick Length", "Input the length of the the selected line (mm): ", value=0, min=0, decimals=2,)
+                        self.entered_length, ok = QInputDialog.getDouble(self.view, "Pick Length", "Input the length of the the selected line (mm): ", value=0, min=0, decimals=2,)
                         if ok:
                             try:
                                 self.pix_per_length = self.selected_pix / self.entered_length
                                 self.related_ruler_label.setText(f"Scale is {self.pix_per_length:.2f} pix/mm")
+                                self.scale_changed.emit(self.pix_per_length)
                             except ZeroDivisionError:
-                                QMessageBox.information(self, "Error",
+                                QMessageBox.information(self.view, "Error",
                                 "Length not valid!", QMessageBox.Ok)
                         else:
-                            QMessageBox.information(self, "Error",
+                            QMessageBox.information(self.view, "Error",
                                 "Length not valid!", QMessageBox.Ok)
                         self.is_ruler = False
 
@@ -1107,82 +1364,22 @@ class Ruler(QLabel):
                     self.setCursor(QCursor(Qt.ArrowCursor))
                     self.is_first_point = True
                     self.is_annotation = False
- 
- 
-    def mouseReleaseEvent(self, e):
-        """
-        mouse release events for the widget
-        :param e: QMouseEvent
-        :return:
-        """
-        if e.button() == Qt.MiddleButton:
-            self.middle_click = False
-            self.setCursor(QCursor(Qt.ArrowCursor))
-
-    def wheelEvent(self, e):
-        angle = e.angleDelta() / 8  # 返回QPoint对象，为滚轮转过的数值，单位为1/8度
-        angleY = angle.y()
-        # 获取当前鼠标相对于view的位置
-        if angleY > 0:
-            self.scale *= 1.1
-        else:  # 滚轮下滚
-            self.scale *= 1 / 1.1
-        # self.adjustSize()
-        self.update()
-    
-    def mouseMoveEvent(self, e):
-        """
-        mouse move events for the widget
-        :param e: QMouseEvent
-        :return:
-        """
-        if self.middle_click:
-            self.end_pos = e.pos()
-            # QPainter coord
-            move_distance = (self.end_pos - self.start_pos) / self.scale # scale the distance
-            self.lefttop = self.lefttop + move_distance
-            self.start_pos = e.pos()
-            self.update()
-    
-    def paintEvent(self, e):
-        """
-        receive paint events
-        :param e: QPaintEvent
-        :return:
-        """
-        if self.ruler_pixmap:
-            scale_painter = QPainter()
-            scale_painter.begin(self)
-            scale_painter.scale(self.scale, self.scale)
-            # QPainter coord
-            # move to the canter of widget to display
-            move_x = self.original_center.x() / self.scale - self.ruler_pixmap.width() / 2
-            move_y = self.original_center.y() / self.scale - self.ruler_pixmap.height() / 2
-            self.moved_lefttop = QPointF(self.lefttop.x() + move_x, self.lefttop.y() + move_y)
-            # QPainter coord
-            scale_painter.drawPixmap(self.moved_lefttop, self.ruler_pixmap)
-            scale_painter.end()
-            self.updateBackgroundPartner()
-    # ====================================================================
-    
-    def updateBackgroundPartner(self):
-        if self.background_partner:
-            self.background_partner.lefttop = self.lefttop
-            self.background_partner.start_pos = self.start_pos
-            self.background_partner.end_pos = self.end_pos
-            self.background_partner.scale = self.scale
 
-            self.background_partner.update()
 
-
-class Canvas(QLabel):
+class Canvas(Layer):
     def __init__(self, img_size):
         super().__init__()
         self.mask_pixmap = QPixmap(img_size)
         self.back_color = QColor(0, 0, 0)
         self.back_color.setAlphaF(0)
         self.mask_pixmap.fill(self.back_color)
-        self.updatePixmap()
+
+        # brush stroke: one painter on mask_pixmap from press to release, the points of the
+        # mouse moves are drawn at the next paint, once per frame
+        self.painter = None
+        self.stroke_pixmap = None
+        self.stroke_points = []
+        self.stroke_dot = False
 
         self.last_x, self.last_y = None, None
         self.pen_color = QColor("#ffffff")
@@ -1195,149 +1392,261 @@ class Canvas(QLabel):
 
         self.left_click = False
 
-        # for transformation
-        # =========================================
-        # QPainter coord
-        self.lefttop = QPointF(0, 0)
-        self.moved_lefttop = QPointF(0, 0)
-        # QWidget coord
-        self.original_center = QPointF(img_size.width() / 2, img_size.height() / 2)
-        self.start_pos = None
-        self.end_pos = None
-        self.middle_click = False
-        self.scale = 1
-
-        # reference of partner background
-        # all the images transform together
-        self.background_partner = None
-        # =========================================
+    def pixmap(self):
+        return self.mask_pixmap
 
     def updatePixmap(self):
-        self.setPixmap(self.mask_pixmap)
+        self.endStroke()
         self.update()
 
     def set_pen_color(self, c):
         self.pen_color = QColor(c)
         self.pen_color.setAlphaF(0.6)
 
-    def mouseMoveEvent(self, e):
-        if self.left_click:
-            # if self.last_x is None:  # First event.
-            #     return  # Ignore the first time.
+    def beginStroke(self, point, dot=True):
+        self.painter = QPainter(self.mask_pixmap)
+        self.stroke_pixmap = self.mask_pixmap
+        self.p = self.painter.pen()
+        self.p.setWidth(self.pen_width)
+
+        if self.is_eraser:
+            # refer to https://blog.csdn.net/weixin_47878978/article/details/113174513
+            self.painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            self.p.setColor(self.back_color)
+        else:
+            self.painter.setCompositionMode(QPainter.CompositionMode_Source)
+            self.p.setColor(self.pen_color)
+        self.painter.setPen(self.p)
+        # a click without move leaves a dot
+        self.stroke_points = [point]
+        self.stroke_dot = dot
+        if dot:
+            self.update(self.strokeRect(point, point))
+
+    def addStrokePoint(self, point):
+        self.update(self.strokeRect(self.stroke_points[-1], point))
+        self.stroke_points.append(point)
+
+    # draw the segments added since the last paint, each as its own line like a single
+    # move would, so the mask does not depend on how the moves were coalesced
+    def flushStroke(self):
+        if self.painter is None or self.stroke_pixmap is not self.mask_pixmap:
+            return # no stroke, or the mask was replaced during the stroke
+        points = self.stroke_points
+        if self.stroke_dot:
+            self.painter.drawPoint(points[0])
+            self.stroke_dot = False
+        for start, end in zip(points[:-1], points[1:]):
+            self.painter.drawLine(start, end)
+        self.stroke_points = points[-1:]
+
+    def endStroke(self):
+        if self.painter is not None:
+            self.flushStroke()
+            self.painter.end()
+        self.painter = None
+        self.stroke_pixmap = None
+        self.stroke_points = []
 
-            # print(e.x(), e.y())
-            # print(self.lefttop.x(), self.lefttop.y())
+    # rect of the mask covered by the segment from start to end; the square caps stick
+    # out by up to half the pen width times sqrt(2)
+    def strokeRect(self, start, end):
+        pad = self.pen_width + 2
+        return QRectF(start, end).normalized().adjusted(-pad, -pad, pad, pad)
 
+    def prepare(self):
+        self.flushStroke()
+
+    def mouseMoveEvent(self, e):
+        if self.left_click:
             if not self.is_annotation: # the painter only work when annotation
                 return
 
-            # QWidget coord
-            now_x = (e.x() - self.moved_lefttop.x() * self.scale) / self.scale
-            now_y = (e.y() - self.moved_lefttop.y() * self.scale) / self.scale
+            now = self.toPixmap(e.pos())
 
-            # painter = QPainter(self.pixmap())
-            self.painter = QPainter(self.mask_pixmap)
-            self.setPixmap(self.mask_pixmap)
-            self.p = self.painter.pen()
-            self.p.setWidth(self.pen_width)
-        
-            if self.is_eraser:
-                # refer to https://blog.csdn.net/weixin_47878978/article/details/113174513
-                self.painter.setCompositionMode(QPainter.CompositionMode_Clear)
-                self.p.setColor(self.back_color)
-            else:
-                self.painter.setCompositionMode(QPainter.CompositionMode_Source)
-                self.p.setColor(self.pen_color)
-            self.painter.setPen(self.p)
-            self.painter.drawLine(QPointF(self.last_x, self.last_y), QPointF(now_x, now_y))
-            self.painter.end()
-            self.update()
+            # only the dirty rect of the segment is repainted, at the next frame
+            if self.painter is None:
+                self.beginStroke(QPointF(self.last_x, self.last_y), dot=False)
+            self.addStrokePoint(now)
 
             # Update the origin for next time.
-            self.last_x = now_x
-            self.last_y = now_y
-        
-        elif self.middle_click:
-            self.end_pos = e.pos()
-            # QPainter coord
-            move_distance = (self.end_pos - self.start_pos) / self.scale # scale the distance
-            self.lefttop = self.lefttop + move_distance
-            self.start_pos = e.pos()
-            self.update()
+            self.last_x = now.x()
+            self.last_y = now.y()
 
     def mousePressEvent(self, e):
         if e.button() == Qt.LeftButton:
             self.left_click = True
-            self.last_x = (e.x() - self.moved_lefttop.x() * self.scale) / self.scale
-            self.last_y = (e.y() - self.moved_lefttop.y() * self.scale) / self.scale
-            self.painter = QPainter(self.mask_pixmap)
-            self.setPixmap(self.mask_pixmap)
-            self.p = self.painter.pen()
-            self.p.setWidth(self.pen_width)
-        
-            if self.is_eraser:
-                # refer to https://blog.csdn.net/weixin_47878978/article/details/113174513
-                self.painter.setCompositionMode(QPainter.CompositionMode_Clear)
-                self.p.setColor(self.back_color)
-            else:
-                self.painter.setCompositionMode(QPainter.CompositionMode_Source)
-                self.p.setColor(self.pen_color)
-            self.painter.setPen(self.p)
+            point = self.toPixmap(e.pos())
+            self.last_x, self.last_y = point.x(), point.y()
             if self.is_annotation:
-                self.painter.drawPoint(QPointF(self.last_x, self.last_y))
-            self.painter.end()
-            self.update()
-        elif e.button() == Qt.MiddleButton:
-            self.middle_click = True
-            self.start_pos = e.pos()
-            self.cursor_before_move = self.cursor()
-            self.setCursor(QCursor(Qt.ClosedHandCursor))
+                self.beginStroke(point)
 
     def mouseReleaseEvent(self, e):
         if e.button() == Qt.LeftButton:
             self.left_click = False
             self.last_x = None
             self.last_y = None
-        if e.button() == Qt.MiddleButton:
-            self.middle_click = False
-            self.setCursor(self.cursor_before_move)
-    
-    def wheelEvent(self, e):
-        angle = e.angleDelta() / 8  # 返回QPoint对象，为滚轮转过的数值，单位为1/8度
-        angleY = angle.y()
-        # 获取当前鼠标相对于view的位置
-        if angleY > 0:
-            self.scale *= 1.1
-        else:  # 滚轮下滚
-            self.scale *= 1 / 1.1
-        # self.adjustSize()
-        self.update()
+            self.endStroke()
 
-        # print(self.mask_pixmap.size())
-    
-    def paintEvent(self, e):
-        if self.mask_pixmap:
-            scale_painter = QPainter()
-            scale_painter.begin(self)
-            scale_painter.scale(self.scale, self.scale)
-            # QPainter coord
-            # move to the canter of widget to display
-            move_x = self.original_center.x() / self.scale - self.mask_pixmap.width() / 2
-            move_y = self.original_center.y() / self.scale - self.mask_pixmap.height() / 2
-            self.moved_lefttop = QPointF(self.lefttop.x() + move_x, self.lefttop.y() + move_y)
-            # QPainter coord
-            scale_painter.drawPixmap(self.moved_lefttop, self.mask_pixmap)
-            scale_painter.end()
-            self.updateBackgroundPartner()
-    
-    def updateBackgroundPartner(self):
-        if self.background_partner:
-            self.background_partner.lefttop = self.lefttop
-            self.background_partner.start_pos = self.start_pos
-            self.background_partner.end_pos = self.end_pos
-            self.background_partner.scale = self.scale
-
-            self.background_partner.update()
+
+class TrainingPanel(QWidget):
+    # live chart of the losses while the model parameters are updated
+    def __init__(self):
+        super().__init__()
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+
+        self.figure = Figure(figsize=(6, 3), tight_layout=True)
+        self.chart = FigureCanvasQTAgg(self.figure)
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        self.axes.set_xlabel('epochs')
+        self.axes.set_ylabel('Loss')
+        self.batch_line, = self.axes.plot([], [], 'r', alpha=0.3, linewidth=1)
+        self.train_line, = self.axes.plot([], [], 'r-o', label='Train')
+        self.valid_line, = self.axes.plot([], [], 'g-o', label='Valid')
+        self.axes.legend(handles=[self.train_line, self.valid_line])
+        layout.addWidget(self.chart)
+
+        self.info_label = QLabel("")
+        layout.addWidget(self.info_label)
+
+        button_box = QHBoxLayout()
+        layout.addLayout(button_box)
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.setCheckable(True)
+        self.pause_button.clicked.connect(self.pauseClicked)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancelClicked)
+        button_box.addWidget(self.pause_button)
+        button_box.addWidget(self.cancel_button)
+
+        self.worker = None
+        self.stop("")
+
+    def start(self, worker, n_epochs):
+        self.worker = worker
+        self.batch_x, self.batch_y = [], []
+        self.epoch_x, self.train_y, self.valid_y = [], [], []
+        for line in [self.batch_line, self.train_line, self.valid_line]:
+            line.set_data([], [])
+        self.axes.set_xlim(0, n_epochs)
+        self.pause_button.setChecked(False)
+        self.pause_button.setText("Pause")
+        self.pause_button.setEnabled(True)
+        self.cancel_button.setEnabled(True)
+        self.info_label.setText("Preparing the train set...")
+        self.chart.draw_idle()
+
+    def stop(self, message):
+        self.worker = None
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        self.info_label.setText(message)
+
+    def addBatchLoss(self, epoch, batch_idx, n_batches, loss):
+        self.batch_x.append(epoch - 1 + (batch_idx + 1) / n_batches)
+        self.batch_y.append(loss)
+        self.batch_line.set_data(self.batch_x, self.batch_y)
+        self.info_label.setText(f"Epoch {epoch}: batch {batch_idx + 1} / {n_batches}, loss {loss:.4f}")
+        self.redraw()
+
+    def addEpochLoss(self, epoch, train_loss, valid_loss):
+        self.epoch_x.append(epoch)
+        self.train_y.append(train_loss)
+        self.valid_y.append(valid_loss)
+        self.train_line.set_data(self.epoch_x, self.train_y)
+        self.valid_line.set_data(self.epoch_x, self.valid_y)
+        self.info_label.setText(f"Epoch {epoch}: training loss {train_loss:.4f}, validation loss {valid_loss:.4f}")
+        self.redraw()
+
+    def redraw(self):
+        self.axes.relim()
+        self.axes.autoscale_view(scalex=False)
+        self.chart.draw_idle()
+
+    def pauseClicked(self, checked):
+        if self.worker is None:
+            return
+        if checked:
+            self.worker.pause()
+            self.pause_button.setText("Resume")
+        else:
+            self.worker.resume()
+            self.pause_button.setText("Pause")
+
+    def cancelClicked(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        self.info_label.setText("Cancelling...")
+
+
+class DefectPanel(QWidget):
+    # table of the defects of the last detection, largest first
+    max_rows = 500
+
+    def __init__(self):
+        super().__init__()
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        self.info_label = QLabel("")
+        layout.addWidget(self.info_label)
+        self.table = QTableWidget()
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.setMinimumSize(QSize(900, 300))
+        layout.addWidget(self.table)
+        self.summary = ""
+
+    def setRegions(self, regions):
+        # regions of defect_regions, with the columns in mm when a scale is set
+        self.table.clearContents()
+        self.table.setRowCount(0)
+        if regions is None:
+            self.summary = ""
+            self.info_label.setText("")
+            return
+        if 'area_mm2' in regions:
+            columns = [('defect', 'Defect', '{:d}'), ('area_mm2', 'Area (mm²)', '{:.3f}'),
+                       ('centroid_x_mm', 'X (mm)', '{:.2f}'), ('centroid_y_mm', 'Y (mm)', '{:.2f}'),
+                       ('width_mm', 'Width (mm)', '{:.2f}'), ('height_mm', 'Height (mm)', '{:.2f}'),
+                       ('major_axis_mm', 'Major axis (mm)', '{:.2f}'),
+                       ('minor_axis_mm', 'Minor axis (mm)', '{:.2f}'),
+                       ('orientation', 'Angle (°)', '{:.1f}'),
+                       ('length_mm', 'Length (mm)', '{:.2f}'),
+                       ('max_width_mm', 'Max width (mm)', '{:.3f}'),
+                       ('closed', 'Closed', '{}')]
+            total = (f"{regions['area_mm2'].sum():.3f} mm², longest "
+                     f"{regions['length_mm'].max() if len(regions) else 0:.2f} mm")
+        else:
+            columns = [('defect', 'Defect', '{:d}'), ('area_px', 'Area (pix)', '{:d}'),
+                       ('centroid_x', 'X (pix)', '{:.1f}'), ('centroid_y', 'Y (pix)', '{:.1f}'),
+                       ('width', 'Width (pix)', '{:d}'), ('height', 'Height (pix)', '{:d}'),
+                       ('major_axis', 'Major axis (pix)', '{:.1f}'),
+                       ('minor_axis', 'Minor axis (pix)', '{:.1f}'),
+                       ('orientation', 'Angle (°)', '{:.1f}'),
+                       ('length', 'Length (pix)', '{:.1f}'),
+                       ('max_width', 'Max width (pix)', '{:.1f}'),
+                       ('closed', 'Closed', '{}')]
+            total = f"{regions['area_px'].sum()} pix, add a scale for mm"
+        self.summary = f"{len(regions)} defects, total area {total}"
+        shown = regions.head(self.max_rows)
+        if len(shown) < len(regions):
+            self.info_label.setText(self.summary + f" (largest {len(shown)} listed)")
+        else:
+            self.info_label.setText(self.summary)
+
+        self.table.setColumnCount(len(columns))
+        self.table.setHorizontalHeaderLabels([header for _, header, _ in columns])
+        self.table.setRowCount(len(shown))
+        for j, (column, _, fmt) in enumerate(columns):
+            for i, value in enumerate(shown[column].tolist()):
+                item = QTableWidgetItem(fmt.format(value))
+                item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self.table.setItem(i, j, item)
 
 
 if __name__ == '__main__':
@@ -2,6 +2,8 @@
 #                          Library imports                              #
 #-----------------------------------------------------------------------#
 import torch
+import numpy as np
+import pandas as pd
 
 #-----------------------------------------------------------------------#
 #                        Performance metrics                            #
@@ -25,43 +27,177 @@ import torch
 # tn:     number of true negatives                                      #
 # fn:     number of false negatives                                     #
 # DSC:    Dice_Similarity_Coefficient                                   #
-# MAE:    mean absolute error
+# MAE:    mean absolute error of the probabilities, not thresholded     #
 #-----------------------------------------------------------------------#
+# The confusion counts are those of the binary masks, a defect above    #
+# 0.5 as in postprocess_mask                                            #
+#-----------------------------------------------------------------------#
+
+
+METRIC_NAMES = ['specificity', 'sensitivity', 'precision', 'F1_score', 'F2_score', 'DSC',
+                'F_beta', 'MAE', 'acc']
+
+
+#-----------------------------------------------------------------------#
+#                          confusion_counts                             #
+#  Confusion matrix of every image of a batch in one fused pass: the    #
+#  code pred * 2 + target of each pixel, offset by 4 per image, is      #
+#  counted with a single scatter_add into a fixed size tensor. Unlike   #
+#  bincount, which reads the largest code back to size its output on    #
+#  CUDA, nothing waits for the device.                                  #
+#-----------------------------------------------------------------------#
+# Returns a (batch, 4) int64 tensor of tn, fn, fp, tp on the device     #
+#-----------------------------------------------------------------------#
+def confusion_counts(y_pred, y_true):
+    n = y_pred.shape[0]
+    codes = y_pred.reshape(n, -1).long() * 2 + y_true.reshape(n, -1).long()
+    codes += 4 * torch.arange(n, device=codes.device)[:, None]
+    return count_codes(codes.flatten(), 4 * n).view(n, 4)
+
+
+# number of occurrences of each of the codes 0..size - 1, without a host sync
+def count_codes(codes, size):
+    ones = torch.ones(1, dtype=torch.int64, device=codes.device).expand(codes.numel())
+    return torch.zeros(size, dtype=torch.int64, device=codes.device).scatter_add_(0, codes, ones)
+
+
+#-----------------------------------------------------------------------#
+#                          metrics_from_counts                          #
+#  The performance metrics from confusion counts, elementwise, so that  #
+#  arrays of per-image counts give per-image metrics                    #
+#-----------------------------------------------------------------------#
+def metrics_from_counts(tn, fn, fp, tp, smooth = 1e-10, beta_2 = 0.3):
+    tn, fn, fp, tp = [np.asarray(c, dtype=np.float64) for c in (tn, fn, fp, tp)]
+    specificity = tn / (tn + fp + smooth)
+    sensitivity = tp/(tp + fn + smooth)
+    precision =  tp/(tp + fp + smooth)
+    F2_score = (5*tp + smooth)/(5*tp + 4*fn +  fp + smooth)
+    DSC = (2*tp + smooth)/(2*tp + fn + fp + smooth)
+    F1_score = (2 * precision * sensitivity + smooth) / (precision + sensitivity + smooth)
+    F_beta_score =((1+beta_2)* precision * sensitivity + 
+                   smooth)/((beta_2*precision) + sensitivity + smooth)
+    # the absolute error of a binary prediction is 1 on the false pixels
+    MAE = (fp + fn)/(tp + tn + fp + fn)
+    accuracy = (tp + tn)/(tp + tn + fp + fn)
+    return specificity, sensitivity, precision, F1_score, F2_score, DSC, \
+           F_beta_score, MAE, accuracy
 
 
 class performance_metrics():
     def __init__(self, smooth = 1e-10, beta_2=0.3):
         super().__init__()
         self.smooth = smooth
-        self.beta_2 = 0.3
+        self.beta_2 = beta_2
             
     def __call__(self, y_pred, y_true):
-        # Flatten both prediction and GT tensors
-        y_pred_flat = torch.flatten(y_pred)
-        y_true_flat = torch.flatten(y_true)
-        # calculate the parameters
-        tp = (y_pred_flat * y_true_flat).sum()
-        tn = ((1 - y_pred_flat) * (1- y_true_flat)).sum()
-        fp = (y_pred_flat * (1 - y_true_flat)).sum()
-        fn = ((1 - y_pred_flat) * y_true_flat).sum()
-        # continue the calculation in numpy
-        tp = tp.cpu().detach().numpy()
-        fp = fp.cpu().detach().numpy()
-        tn = tn.cpu().detach().numpy()
-        fn = fn.cpu().detach().numpy()
-        #calculate the metrics
-        specificity = tn / (tn + fp + self.smooth)
-        sensitivity = tp/(tp + fn + self.smooth)
-        precision =  tp/(tp + fp + self.smooth)
-        F2_score = (5*tp + self.smooth)/(5*tp + 4*fn +  fp + self.smooth)
-        DSC = (2*tp + self.smooth)/(2*tp + fn + fp + self.smooth)
-        F1_score = (2 * precision * sensitivity + self.smooth) / (precision 
-                                                                  + sensitivity 
-                                                                  + self.smooth)
-        F_beta_score =((1+self.beta_2)* precision * sensitivity + 
-                       self.smooth)/((self.beta_2*precision) + sensitivity + self.smooth)
-        MAE = (torch.abs(y_pred_flat - y_true_flat)).sum()/(len(y_pred_flat))
-        accuracy = (tp + tn)/(tp + tn + fp + fn)
-        return specificity, sensitivity, precision, F1_score, F2_score, DSC, \
-               F_beta_score, MAE.cpu().numpy(), accuracy
+        # confusion counts of the whole batch of binary masks and the mean absolute error
+        # of the probabilities, copied to the host at once
+        counts = confusion_counts(y_pred.reshape(1, -1) > 0.5, y_true.reshape(1, -1) >= 0.5)[0]
+        MAE = (y_pred.double() - y_true.double()).abs().mean()
+        tn, fn, fp, tp, MAE = torch.cat([counts.double(), MAE.reshape(1)]).tolist()
+        metrics = list(metrics_from_counts(tn, fn, fp, tp, self.smooth, self.beta_2))
+        metrics[METRIC_NAMES.index('MAE')] = np.float64(MAE)
+        return tuple(metrics)
+
+
+#-----------------------------------------------------------------------#
+#                           ConfusionMatrix                             #
+#  Streaming accumulator of the confusion counts of a dataset. update() #
+#  only queues work on the device; compute() copies the per-image       #
+#  counts to the host once and derives the metrics over all the pixels #
+#  of the dataset (micro average) and the mean of the metrics of every  #
+#  image (macro average).                                               #
+#-----------------------------------------------------------------------#
+# threshold: a pixel is predicted as a defect when its probability is   #
+#            above it, as in postprocess_mask                           #
+#-----------------------------------------------------------------------#
+class ConfusionMatrix():
+    def __init__(self, threshold = 0.5, smooth = 1e-10, beta_2 = 0.3):
+        super().__init__()
+        self.threshold = threshold
+        self.smooth = smooth
+        self.beta_2 = beta_2
+        self.counts = []
+
+    def update(self, output, target):
+        """
+        Args:
+            output: (B, 1, H, W) defect probabilities
+            target: (B, 1, H, W) masks in [0, 1]
+        """
+        self.counts.append(confusion_counts(output > self.threshold, target >= 0.5))
+
+    def per_image_counts(self):
+        # (n_images, 4) array of tn, fn, fp, tp
+        if not self.counts:
+            return np.zeros((0, 4), dtype=np.int64)
+        return torch.cat(self.counts).cpu().numpy()
+
+    def compute(self):
+        """
+        Returns:
+            DataFrame with the micro and macro averages of the metrics
+        """
+        counts = self.per_image_counts()
+        micro = metrics_from_counts(*counts.sum(axis=0), self.smooth, self.beta_2)
+        macro = [m.mean() for m in metrics_from_counts(*counts.T, self.smooth, self.beta_2)]
+        df = pd.DataFrame([micro, macro], columns=METRIC_NAMES)
+        df.insert(0, 'average', ['micro', 'macro'])
+        return df
+
+
+#-----------------------------------------------------------------------#
+#                           ThresholdSweep                              #
+#  Streaming accumulator of the histograms of the predicted defect      #
+#  probabilities of the defect and background pixels. Its memory is     #
+#  constant whatever the dataset size, and the confusion counts of any  #
+#  threshold follow from cumulative sums of the histograms, so a single #
+#  inference pass gives the metrics of every threshold.                 #
+#-----------------------------------------------------------------------#
+# n_bins: number of thresholds, k / n_bins for k < n_bins. A pixel is   #
+#         predicted as a defect above the threshold, as in              #
+#         postprocess_mask                                              #
+#-----------------------------------------------------------------------#
+class ThresholdSweep():
+    def __init__(self, n_bins = 1000, smooth = 1e-10, beta_2 = 0.3):
+        super().__init__()
+        self.n_bins = n_bins
+        self.smooth = smooth
+        self.beta_2 = beta_2
+        self.histogram = None
+
+    def update(self, output, target):
+        """
+        Args:
+            output: (B, 1, H, W) defect probabilities
+            target: (B, 1, H, W) masks in [0, 1]
+        """
+        # bin b holds the probabilities above b of the thresholds, compared in the dtype
+        # of the output like output > threshold
+        output = output.flatten()
+        thresholds = torch.arange(self.n_bins, device=output.device) / self.n_bins
+        bins = torch.searchsorted(thresholds.to(output.dtype), output)
+        bins += (self.n_bins + 1) * (target.flatten() >= 0.5).long()
+        histogram = count_codes(bins, 2 * (self.n_bins + 1))
+        self.histogram = histogram if self.histogram is None else self.histogram + histogram
+
+    def compute(self):
+        """
+        Returns:
+            DataFrame of the thresholds and their metrics, with the recall
+            (sensitivity) and precision of the PR curve
+        """
+        histogram = self.histogram.cpu().numpy().reshape(2, self.n_bins + 1)
+        # pixels with a probability above threshold k, in bin k + 1 or above, per class
+        above = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        tp, fp = above[1], above[0]
+        fn, tn = histogram[1].sum() - tp, histogram[0].sum() - fp
+        df = pd.DataFrame(np.stack(metrics_from_counts(tn, fn, fp, tp, self.smooth, self.beta_2),
+                                   axis=1), columns=METRIC_NAMES)
+        df.insert(0, 'threshold', np.arange(self.n_bins) / self.n_bins)
+        return df
 
+    def best_threshold(self, metric = 'F_beta'):
+        # the row of the threshold maximizing the metric
+        df = self.compute()
+        return df.loc[df[metric].idxmax()]
@@ -0,0 +1,100 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import sys
+import numpy as np
+from PyQt5.QtGui import QImage
+
+
+#-----------------------------------------------------------------------#
+#               NumPy views over QImage pixel buffers                   #
+#-----------------------------------------------------------------------#
+# Format_ARGB32 stores every pixel as a native-endian 32-bit 0xAARRGGBB #
+# word, so the byte order in memory is B, G, R, A on little-endian      #
+# machines and A, R, G, B on big-endian ones.                           #
+# Rows may be padded (bytesPerLine >= 4 * width), so the view is built  #
+# over the full stride and then cut to the visible width.               #
+#-----------------------------------------------------------------------#
+if sys.byteorder == 'little':
+    B, G, R, A = 0, 1, 2, 3
+else:
+    A, R, G, B = 0, 1, 2, 3
+
+# alpha of the white defect pixels shown over the background image
+OVERLAY_ALPHA = round(0.6 * 255)
+
+
+def qimage_view(image):
+    """
+    Args:
+        image: QImage in Format_ARGB32 (or any 32-bit format)
+    Returns:
+        writable (height, width, 4) uint8 array sharing memory with image.
+        The array is only valid as long as the QImage is alive.
+    """
+    w = image.width()
+    h = image.height()
+    ptr = image.bits()
+    ptr.setsize(image.sizeInBytes())
+    buffer = np.frombuffer(ptr, np.uint8).reshape(h, image.bytesPerLine())
+    return buffer[:, :w * 4].reshape(h, w, 4)
+
+
+def binary_to_overlay(mask):
+    """
+    Args:
+        mask: (height, width) array, nonzero for defect pixels
+    Returns:
+        QImage in Format_ARGB32. Defect pixels are white with alpha 0.6,
+        the others are fully transparent black.
+    """
+    mask = np.asarray(mask) != 0
+    h, w = mask.shape
+    overlay = QImage(w, h, QImage.Format_ARGB32)
+    overlay.fill(0)
+    view = qimage_view(overlay)
+    view[mask] = 255
+    view[..., A][mask] = OVERLAY_ALPHA
+    return overlay
+
+
+def mask_to_overlay(image):
+    """
+    Args:
+        image: QImage of a black and white mask, in any format
+    Returns:
+        ARGB32 copy of image where black pixels are fully transparent
+        and white pixels have alpha 0.6. Other colors are left untouched.
+    """
+    overlay = image.convertToFormat(QImage.Format_ARGB32)
+    view = qimage_view(overlay)
+    rgb = view[..., [R, G, B]]
+    view[..., A][(rgb == 0).all(axis=-1)] = 0
+    view[..., A][(rgb == 255).all(axis=-1)] = OVERLAY_ALPHA
+    return overlay
+
+
+def overlay_to_binary(image):
+    """
+    Args:
+        image: QImage of a mask overlay, typically QPixmap.toImage()
+    Returns:
+        opaque ARGB32 copy of image, ready to be saved as a binary mask.
+        Transparent pixels become black and painted pixels keep their color.
+    """
+    # un-premultiply first, so that partly transparent white stays white
+    binary = image.convertToFormat(QImage.Format_ARGB32)
+    qimage_view(binary)[..., A] = 255
+    return binary
+
+
+def overlay_defects(image):
+    """
+    Args:
+        image: QImage of a mask overlay, typically QPixmap.toImage()
+    Returns:
+        (height, width) bool array, True for the painted (not transparent) pixels
+    """
+    # the view is only valid while the converted copy is referenced
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    return qimage_view(image)[..., A] > 0
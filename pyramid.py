@@ -0,0 +1,174 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+
+#-----------------------------------------------------------------------#
+#                             TileCache                                 #
+#  Least recently used tiles of an ImagePyramid, bounded by their size  #
+#  in bytes. It is shared by the thread building the tiles and the GUI  #
+#  thread drawing them.                                                 #
+#-----------------------------------------------------------------------#
+class TileCache():
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        with self.lock:
+            if key in self.tiles:
+                self.n_bytes -= self.tiles.pop(key).sizeInBytes()
+            self.tiles[key] = tile
+            self.n_bytes += tile.sizeInBytes()
+            while self.n_bytes > self.max_bytes and len(self.tiles) > 1:
+                _, evicted = self.tiles.popitem(last=False)
+                self.n_bytes -= evicted.sizeInBytes()
+
+
+#-----------------------------------------------------------------------#
+#                            image_array                                #
+#  Read-only (height, width, channels) view of an 8 or 32-bit QImage.   #
+#  Unlike bits, constBits does not detach a QImage shared with others,  #
+#  the view is only valid while the QImage is referenced.               #
+#-----------------------------------------------------------------------#
+def image_array(image):
+    channels = image.depth() // 8
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    return np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())[
+        :, :image.width() * channels].reshape(image.height(), image.width(), channels)
+
+
+#-----------------------------------------------------------------------#
+#                          downsample_2x2                               #
+#  Halve a (height, width, channels) uint8 array by averaging each 2x2  #
+#  block, an odd last row or column is averaged with itself             #
+#-----------------------------------------------------------------------#
+def downsample_2x2(array):
+    h, w = array.shape[:2]
+    if h % 2 or w % 2:
+        array = np.pad(array, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    total = array[0::2, 0::2].astype(np.uint16)
+    total += array[1::2, 0::2]
+    total += array[0::2, 1::2]
+    total += array[1::2, 1::2]
+    return ((total + 2) >> 2).astype(np.uint8)
+
+
+#-----------------------------------------------------------------------#
+#                            ImagePyramid                               #
+#  Multi-resolution tiles of a large image. Level 0 is the image itself #
+#  and each level halves the previous one, down to a level that fits in #
+#  one tile. The tiles of the levels above 0 are built on demand from   #
+#  the 4 tiles below them, so showing the whole image reads each pixel  #
+#  once, and only the tiles in the TileCache are kept in memory.        #
+#-----------------------------------------------------------------------#
+# image:     QImage at full resolution. Gray images stay 8-bit, the     #
+#            others are read as 32-bit RGB. The QImage is shared, not   #
+#            copied, when already in one of these formats.              #
+# tile_size: width and height of a tile, in pixels of its level         #
+# max_bytes: size of the TileCache                                      #
+#-----------------------------------------------------------------------#
+class ImagePyramid():
+    def __init__(self, image, tile_size=256, max_bytes=256 * 2 ** 20):
+        if image.format() not in (QImage.Format_Grayscale8, QImage.Format_RGB32,
+                                  QImage.Format_ARGB32):
+            image = image.convertToFormat(QImage.Format_Grayscale8 if image.isGrayscale()
+                                          else QImage.Format_RGB32)
+        self.image = image
+        self.width = image.width()
+        self.height = image.height()
+        self.tile_size = tile_size
+        self.n_levels = 1 + max(0, math.ceil(math.log2(max(self.width, self.height, 1) / tile_size)))
+        self.cache = TileCache(max_bytes)
+
+        self.array = image_array(image)
+
+    def levelSize(self, level):
+        return -(-self.width >> level), -(-self.height >> level)
+
+    # the coarsest level with at least one pixel per screen pixel, source_per_screen
+    # being the number of level 0 pixels per screen pixel
+    def levelFor(self, source_per_screen):
+        if source_per_screen < 2:
+            return 0
+        return min(int(math.log2(source_per_screen)), self.n_levels - 1)
+
+    # indices of the tiles of level covering the level 0 pixels [x0, x1) x [y0, y1)
+    def tilesCovering(self, level, x0, y0, x1, y1):
+        span = self.tile_size << level
+        return [(level, tx, ty) for ty in range(y0 // span, (y1 - 1) // span + 1)
+                                for tx in range(x0 // span, (x1 - 1) // span + 1)]
+
+    # level pixels [x0, x1) x [y0, y1) of a tile
+    def tileBounds(self, level, tx, ty):
+        w, h = self.levelSize(level)
+        x0, y0 = tx * self.tile_size, ty * self.tile_size
+        return x0, y0, min(x0 + self.tile_size, w), min(y0 + self.tile_size, h)
+
+    def tile(self, level, tx, ty):
+        """
+        Args:
+            level, tx, ty: level above 0, and column and row of the tile in the level
+        Returns:
+            the tile as a QImage, from the cache or built now from the pixels below it
+        """
+        key = (level, tx, ty)
+        tile = self.cache.get(key)
+        if tile is None:
+            size = 2 * self.tile_size
+            if level == 1:
+                below = self.array[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size]
+            else:
+                # the up to 2x2 tiles of level - 1 below this one, held while joined
+                w, h = self.levelSize(level - 1)
+                tiles = [[self.tile(level - 1, column, row)
+                          for column in range(2 * tx, 2 * tx + 2) if column * self.tile_size < w]
+                         for row in range(2 * ty, 2 * ty + 2) if row * self.tile_size < h]
+                below = np.concatenate([np.concatenate([image_array(tile) for tile in row], axis=1)
+                                        for row in tiles], axis=0)
+            array = downsample_2x2(below)
+            h, w = array.shape[:2]
+            tile = QImage(array.data, w, h, array.strides[0], self.image.format()).copy()
+            self.cache.put(key, tile)
+        return tile
+
+    def preview(self, width, height):
+        """
+        Args:
+            width, height: size to fit the image in, keeping its aspect ratio
+        Returns:
+            the image scaled to fit as a QImage, smoothly scaled from the
+            coarsest level at least that large, whose tiles are built and cached
+        """
+        level = self.levelFor(max(self.width / width, self.height / height))
+        if level == 0:
+            image = self.image
+        else:
+            # the tiles of the level, held while joined
+            w, h = self.levelSize(level)
+            tiles = [[self.tile(level, tx, ty) for tx in range(-(-w // self.tile_size))]
+                     for ty in range(-(-h // self.tile_size))]
+            array = np.concatenate([np.concatenate([image_array(tile) for tile in row], axis=1)
+                                    for row in tiles], axis=0)
+            image = QImage(array.data, w, h, array.strides[0], self.image.format()).copy()
+        return image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
@@ -0,0 +1,94 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import argparse
+import os
+import random
+from glob import glob
+
+import torch
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from batch_inference import preprocess_image
+from export import save_frozen
+from runtime import load_state_dict
+from unet import UNet_2D
+
+
+#-----------------------------------------------------------------------#
+#                         quantization_backend                          #
+#  The int8 kernels of this CPU: x86 (fbgemm with onednn) on Intel and  #
+#  AMD, qnnpack on ARM                                                  #
+#-----------------------------------------------------------------------#
+def quantization_backend():
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in torch.backends.quantized.supported_engines:
+            return backend
+    raise RuntimeError('no int8 quantization backend in this PyTorch build')
+
+
+#-----------------------------------------------------------------------#
+#                         calibration_batches                           #
+#  A random sample of images, preprocessed as for detection             #
+#-----------------------------------------------------------------------#
+# images_path_list: images to sample from, e.g. the dataset/set2 jpegs  #
+# n_samples:        number of images in the sample                      #
+# Returns a list of (B, 1, height, width) tensors                       #
+#-----------------------------------------------------------------------#
+def calibration_batches(images_path_list, n_samples=32, batch_size=8, input_size=(320, 480),
+                        seed=0):
+    paths = sorted(images_path_list)
+    paths = random.Random(seed).sample(paths, min(n_samples, len(paths)))
+    images = []
+    for path in paths:
+        with Image.open(path) as image:
+            images.append(preprocess_image(image, input_size))
+    return [torch.stack(images[i:i + batch_size]) for i in range(0, len(images), batch_size)]
+
+
+#-----------------------------------------------------------------------#
+#                            quantize_int8                              #
+#  Static post-training int8 quantization of UNet_2D for the CPU. The   #
+#  model is fused for inference, observers record the activation ranges #
+#  on the calibration batches, and the convolutions and transposed      #
+#  convolutions are converted to int8 kernels with per-channel weights. #
+#  SiLU and the output sigmoid have no int8 kernel and stay in float.   #
+#-----------------------------------------------------------------------#
+# model:       UNet_2D returning probabilities                          #
+# calibration: list of (B, 1, H, W) input batches                       #
+# Returns the quantized module, which runs on the CPU only              #
+#-----------------------------------------------------------------------#
+def quantize_int8(model, calibration, backend=None):
+    backend = backend or quantization_backend()
+    torch.backends.quantized.engine = backend
+    model = model.cpu().fuse_for_inference()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (calibration[0],))
+    with torch.no_grad():
+        for batch in calibration:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Quantize the UNet_2D parameters to an int8 TorchScript model for the CPU.')
+    parser.add_argument('--model', default='model.pt', help='model parameter file')
+    parser.add_argument('--output', default=None,
+                        help='int8 model file, defaults to <model>_int8.ts')
+    parser.add_argument('--calibration', default='dataset/set2',
+                        help='directory of the jpeg images to calibrate on')
+    parser.add_argument('--samples', type=int, default=32,
+                        help='number of calibration images')
+    args = parser.parse_args()
+
+    images = glob(os.path.join(args.calibration, '*.jpeg'))
+    if not images:
+        parser.error('no jpeg image in ' + args.calibration)
+    model = UNet_2D(1, 1, 32, 0.2)
+    model.load_state_dict(load_state_dict(args.model, 'cpu'))
+    quantized = quantize_int8(model, calibration_batches(images, args.samples))
+    output = args.output or os.path.splitext(args.model)[0] + '_int8.ts'
+    save_frozen(quantized, output)
+    print('saved', output)
@@ -0,0 +1,105 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import os
+import torch
+
+
+#-----------------------------------------------------------------------#
+#                            select_device                              #
+#     Pick the fastest available backend: CUDA, then Apple MPS, then    #
+#     the CPU. A device name can be given to force a backend.           #
+#-----------------------------------------------------------------------#
+def select_device(name=None):
+    if name is not None:
+        return torch.device(name)
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    mps = getattr(torch.backends, 'mps', None)
+    if mps is not None and mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+#-----------------------------------------------------------------------#
+#                              as_device                                #
+#  Accept a torch.device, a device name, or the legacy train_on_gpu     #
+#  flag used by train_2D and the inference functions.                   #
+#-----------------------------------------------------------------------#
+def as_device(device):
+    if isinstance(device, bool):
+        return torch.device('cuda' if device else 'cpu')
+    return torch.device(device)
+
+
+#-----------------------------------------------------------------------#
+#                          available_cores                              #
+#  Number of cores this process may run on. torch defaults to all the   #
+#  physical cores of the machine, which oversubscribes a process that   #
+#  is restricted by CPU affinity (e.g. containers, taskset).            #
+#-----------------------------------------------------------------------#
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+#-----------------------------------------------------------------------#
+#                          configure_runtime                            #
+#  Tune the backend for inference speed. Call once, before the first    #
+#  forward pass (inter-op threads cannot be changed afterwards).        #
+#-----------------------------------------------------------------------#
+# device:            device the model runs on                           #
+# intra_op_threads:  threads used inside one op (convolutions), all     #
+#                    available cores by default                         #
+# inter_op_threads:  threads running independent ops concurrently.      #
+#                    UNet_2D is a sequential graph in eager mode, so a  #
+#                    single thread avoids competing with the intra-op   #
+#                    pool.                                              #
+#-----------------------------------------------------------------------#
+def configure_runtime(device, intra_op_threads=None, inter_op_threads=1):
+    device = as_device(device)
+    if device.type == 'cuda':
+        # the input size is fixed, let cuDNN pick the fastest convolution
+        torch.backends.cudnn.benchmark = True
+    elif device.type == 'cpu':
+        torch.set_num_threads(intra_op_threads or available_cores())
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # already set, or parallel work has already started
+            pass
+        # denormal numbers are very slow on x86 and irrelevant here
+        torch.set_flush_denormal(True)
+    return device
+
+
+#-----------------------------------------------------------------------#
+#                    autocast_dtype / grad_scaler                       #
+#  Mixed precision settings of the fast training mode: bfloat16 on the  #
+#  CPU, which has the exponent range of float32 and needs no loss       #
+#  scaling, and float16 with a gradient scaler on CUDA. Other backends  #
+#  train in float32.                                                    #
+#-----------------------------------------------------------------------#
+def autocast_dtype(device):
+    device = as_device(device)
+    if device.type == 'cuda':
+        return torch.float16
+    if device.type == 'cpu':
+        return torch.bfloat16
+    return None
+
+
+def grad_scaler(device, enabled=True):
+    enabled = enabled and as_device(device).type == 'cuda'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+#-----------------------------------------------------------------------#
+#                          load_state_dict                              #
+#     Load parameters saved on any device onto the given device         #
+#-----------------------------------------------------------------------#
+def load_state_dict(path, device):
+    return torch.load(path, map_location=as_device(device))
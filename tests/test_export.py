@@ -0,0 +1,9 @@
+from benchmark import benchmark_export
+
+
+def test_exported_models_match_eager():
+    summary, failures = benchmark_export(
+        sizes=((64, 96), (96, 128)),
+        model_kwargs=dict(in_channels=1, out_channels=1, init_features=4, dropout_p=0.2))
+    assert not failures, summary.to_string(index=False)
+    assert {'fused', 'TorchScript'} <= set(summary['runtime'])
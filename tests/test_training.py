@@ -0,0 +1,28 @@
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from benchmark import check_fast_training
+from transforms import BatchAugmentation
+
+
+# uint8 images of bright rectangles on noise, and their masks
+def rectangles(n, size=(32, 48), seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randint(0, 96, (n, 1) + size, dtype=torch.uint8, generator=generator)
+    masks = torch.zeros((n, 1) + size, dtype=torch.uint8)
+    for i in range(n):
+        y, x = torch.randint(0, size[0] - 8, (2,), generator=generator).tolist()
+        masks[i, :, y:y + 8, x:x + 16] = 255
+    images[masks > 0] = 224
+    return TensorDataset(images, masks)
+
+
+def test_fast_training_matches_float32():
+    loaders = {'train': DataLoader(rectangles(16, seed=0), batch_size=4),
+               'val': DataLoader(rectangles(8, seed=1), batch_size=4)}
+    batch_transforms = {'train': BatchAugmentation(augment=False),
+                        'val': BatchAugmentation(augment=False)}
+    summary, failures = check_fast_training(
+        loaders, batch_transforms, 'cpu', n_epochs=2,
+        model_kwargs=dict(in_channels=1, out_channels=1, init_features=4, dropout_p=0.2))
+    assert not failures, summary.to_string(index=False)
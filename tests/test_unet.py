@@ -0,0 +1,49 @@
+import torch
+import torch.nn as nn
+
+from unet import UNet_2D
+
+
+def small_unet():
+    torch.manual_seed(0)
+    model = UNet_2D(in_channels=1, out_channels=1, init_features=4, dropout_p=0.2)
+    # non-trivial BatchNorm statistics, so that every stage changes the output
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2)
+    return model.eval()
+
+
+# the forward pass of UNet_2D written out, each stage run once
+def reference_forward(model, x):
+    enc1 = model.encoder1(x)
+    enc2 = model.encoder2(model.pool(enc1))
+    enc3 = model.encoder3(model.pool(enc2))
+    enc4 = model.encoder4(model.pool(enc3))
+    bottleneck = model.bottleneck(model.pool(enc4))
+    dec4 = model.decoder4(torch.cat((model.upconv4(bottleneck), enc4), dim=1))
+    dec3 = model.decoder3(torch.cat((model.upconv3(dec4), enc3), dim=1))
+    dec2 = model.decoder2(torch.cat((model.upconv2(dec3), enc2), dim=1))
+    dec1 = model.decoder1(torch.cat((model.upconv1(dec2), enc1), dim=1))
+    return torch.sigmoid(model.conv(dec1))
+
+
+def test_forward_matches_reference():
+    model = small_unet()
+    x = torch.rand(2, 1, 32, 48)
+    with torch.no_grad():
+        assert torch.equal(model(x), reference_forward(model, x))
+
+
+def test_every_layer_runs_once():
+    model = small_unet()
+    calls = {}
+    for name, m in model.named_modules():
+        if any(True for _ in m.parameters(recurse=False)):
+            m.register_forward_hook(
+                lambda m, input, output, name=name: calls.update({name: calls.get(name, 0) + 1}))
+    with torch.no_grad():
+        model(torch.rand(1, 1, 32, 48))
+    assert calls['decoder4.conv1'] == 1
+    assert set(calls.values()) == {1}
@@ -0,0 +1,94 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+#-----------------------------------------------------------------------#
+#                            tile_starts                                #
+#  Start offsets of overlapping tiles covering length. The stride is    #
+#  tile - overlap, and the last tile is aligned with the end.           #
+#-----------------------------------------------------------------------#
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    n_tiles = math.ceil((length - tile) / stride) + 1
+    return [min(i * stride, length - tile) for i in range(n_tiles)]
+
+
+#-----------------------------------------------------------------------#
+#                           check_overlap                               #
+#  Raise a ValueError unless the tiles advance: with an overlap of a    #
+#  whole tile or more the stride is not positive and no tile is placed  #
+#-----------------------------------------------------------------------#
+def check_overlap(tile_size, overlap):
+    if not all(0 <= o < t for t, o in zip(tile_size, overlap)):
+        raise ValueError(f'overlap {tuple(overlap)} must be at least 0 and smaller than '
+                         f'the tile size {tuple(tile_size)}')
+
+
+#-----------------------------------------------------------------------#
+#                            blend_window                               #
+#  Weights of the pixels of one tile. They are 1 in the centre and fall #
+#  off with a raised cosine over the overlap, so that the predictions   #
+#  near tile borders, which lack context, count less when blending.     #
+#-----------------------------------------------------------------------#
+def blend_window(tile_size, overlap):
+    def ramp(length, overlap):
+        w = np.ones(length, np.float32)
+        if overlap > 0:
+            r = 0.5 - 0.5 * np.cos(np.pi * (np.arange(overlap) + 0.5) / overlap)
+            w[:overlap] = r
+            w[-overlap:] = r[::-1]
+        return w
+    return np.outer(ramp(tile_size[0], overlap[0]), ramp(tile_size[1], overlap[1]))
+
+
+#-----------------------------------------------------------------------#
+#                          tiled_inference                              #
+#  Sliding-window inference of UNet_2D at the native image resolution   #
+#-----------------------------------------------------------------------#
+# model:      UNet_2D in eval mode, on device                           #
+# image:      (height, width) grayscale image in [0, 1], array or tensor#
+# tile_size:  (height, width) of a tile, the network input size         #
+# overlap:    (height, width) overlap between neighbouring tiles        #
+# batch_size: number of tiles per forward pass. Only this many tiles    #
+#             and the two full-size accumulators are held in memory.    #
+# progress:   optional callable, called with (done, total) tiles after  #
+#             each batch                                                #
+# Returns the (height, width) defect probability map as a numpy array   #
+#-----------------------------------------------------------------------#
+def tiled_inference(model, image, device, tile_size=(320, 480), overlap=(64, 96),
+                    batch_size=4, progress=None):
+    check_overlap(tile_size, overlap)
+    image = torch.as_tensor(image, dtype=torch.float32)
+    height, width = image.shape
+    th, tw = tile_size
+    # images smaller than a tile are padded by repeating the border
+    pad_h, pad_w = max(0, th - height), max(0, tw - width)
+    if pad_h or pad_w:
+        image = F.pad(image[None, None], (0, pad_w, 0, pad_h), mode='replicate')[0, 0]
+    ph, pw = image.shape
+
+    window = torch.from_numpy(blend_window(tile_size, overlap))
+    prob = torch.zeros(ph, pw)
+    weight = torch.zeros(ph, pw)
+    positions = [(y, x) for y in tile_starts(ph, th, overlap[0])
+                 for x in tile_starts(pw, tw, overlap[1])]
+
+    with torch.no_grad():
+        for i in range(0, len(positions), batch_size):
+            chunk = positions[i:i + batch_size]
+            tiles = torch.stack([image[y:y + th, x:x + tw] for y, x in chunk])
+            output = model(tiles[:, None].to(device))[:, 0].float().cpu()
+            for (y, x), o in zip(chunk, output):
+                prob[y:y + th, x:x + tw] += o * window
+                weight[y:y + th, x:x + tw] += window
+            if progress is not None:
+                progress(i + len(chunk), len(positions))
+
+    return (prob / weight)[:height, :width].numpy()
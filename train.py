@@ -1,23 +1,158 @@
 #-----------------------------------------------------------------------#
 #                          Library imports                              #
 #-----------------------------------------------------------------------#
+import contextlib
+import os
+import random
 import torch
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
+from runtime import as_device, autocast_dtype, grad_scaler, load_state_dict
+
+#-----------------------------------------------------------------------#
+#                   save_checkpoint / load_checkpoint                   #
+#  Full training state written at the end of every epoch: model,        #
+#  optimizer, scheduler and gradient scaler states, the random number   #
+#  generators, the epoch, the best validation loss, the loss history    #
+#  and the early stopping counter. The file is written to a temporary   #
+#  name and renamed, so a crash while saving keeps the last checkpoint. #
+#-----------------------------------------------------------------------#
+def save_checkpoint(path, **state):
+    state['rng'] = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(),
+                        python=random.getstate(),
+                        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path, device):
+    # the checkpoint holds python and numpy objects besides tensors
+    return torch.load(path, map_location=as_device(device), weights_only=False)
+
+
+def restore_rng(rng):
+    torch.set_rng_state(rng['torch'].cpu())
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['python'])
+    if rng['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in rng['cuda']])
+
+
+#-----------------------------------------------------------------------#
+#                              train_step                               #
+#  One optimizer step on a batch. With micro_batch_size, the batch is   #
+#  split into micro-batches whose gradients are accumulated, so that    #
+#  only the activations of one micro-batch are held in memory. Each     #
+#  micro-batch loss is weighted by its share of the batch; losses over  #
+#  whole batches such as the Tversky loss and the BatchNorm statistics  #
+#  are then computed per micro-batch.                                   #
+#-----------------------------------------------------------------------#
+# scaler:   gradient scaler of mixed precision training, or None        #
+# autocast: callable returning the context of the forward passes        #
+# Returns the batch loss                                                #
+#-----------------------------------------------------------------------#
+def train_step(model, optimizer, criterion, data, target, micro_batch_size=None, scaler=None,
+               autocast=contextlib.nullcontext):
+    if scaler is None:
+        scaler = grad_scaler('cpu', enabled=False)
+    n = data.shape[0]
+    step = micro_batch_size or n
+    batch_loss = 0.0
+    # Clear the gradients of all optimized variable
+    optimizer.zero_grad()
+    for start in range(0, n, step):
+        micro_data, micro_target = data[start:start + step], target[start:start + step]
+        # Forward pass (inference) to get the output
+        with autocast():
+            output = model(micro_data)
+        # Calculate the micro-batch loss
+        loss = criterion(output.float(), micro_target) * (micro_data.shape[0] / n)
+        # Backpropagation, accumulating the gradients
+        scaler.scale(loss).backward()
+        batch_loss += loss.detach()
+    # Update weights
+    scaler.step(optimizer)
+    scaler.update()
+    return batch_loss
+
 
 #-----------------------------------------------------------------------#
 #                                train_2D                               #
 #              Train 2D UNet for some number of epochs                  #
 #-----------------------------------------------------------------------#
-def train_2D(n_epochs, loaders, model, optimizer, criterion, train_on_gpu, path):
+# device:   device to train on, the legacy train_on_gpu flag is also    #
+#           accepted                                                    #
+# path:     file the parameters are saved to when validation improves,  #
+#           they are loaded back into model before it is returned       #
+# on_batch: optional callable(epoch, batch_idx, n_batches, loss),       #
+#           called after each training batch                            #
+# on_epoch: optional callable(epoch, train_loss, valid_loss), called    #
+#           after each epoch                                            #
+# batch_transforms: optional dict of callables(data, target) keyed like #
+#           loaders, applied to each batch on the device, e.g.          #
+#           transforms.BatchAugmentation                                #
+# amp:      run the forward passes in mixed precision (bfloat16 on CPU, #
+#           float16 with gradient scaling on CUDA), losses in float32   #
+# channels_last: train in the NHWC memory format, faster convolutions   #
+#           on recent CPUs and tensor core GPUs                         #
+# history_path: csv the losses of every epoch are saved to              #
+# micro_batch_size: accumulate the gradients of micro-batches of this   #
+#           size, trading throughput for a lower peak memory            #
+# checkpointing: recompute the activations of the UNet_2D blocks in the #
+#           backward pass instead of storing them                       #
+# checkpoint_path: file the full training state is saved to after each  #
+#           epoch, see save_checkpoint                                  #
+# resume:   continue the run saved in checkpoint_path, if it exists,    #
+#           from the epoch after the saved one, up to n_epochs          #
+# scheduler: optional learning rate scheduler, stepped after each       #
+#           epoch, with the validation loss for ReduceLROnPlateau       #
+# patience: stop early after this many epochs without an improvement   #
+#           of the validation loss by more than min_delta               #
+#-----------------------------------------------------------------------#
+def train_2D(n_epochs, loaders, model, optimizer, criterion, device, path,
+             on_batch=None, on_epoch=None, batch_transforms=None, amp=False,
+             channels_last=False, history_path='loss_epoch.csv', micro_batch_size=None,
+             checkpointing=False, checkpoint_path=None, resume=False, scheduler=None,
+             patience=None, min_delta=0.0):
+    device = as_device(device)
+    model.checkpointing = checkpointing
+    amp_dtype = autocast_dtype(device) if amp else None
+    scaler = grad_scaler(device, enabled=amp_dtype is not None)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model.to(memory_format=memory_format)
+    def autocast():
+        if amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device.type, dtype=amp_dtype)
     #keep track of train and validation losses
     loss_epoch=[]
     # initialize tracker for minimum validation loss
     valid_loss_min = np.inf
+    # epochs since the validation loss last improved
+    stale_epochs = 0
+    first_epoch = 1
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path, device)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if scheduler is not None and checkpoint['scheduler'] is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        # a run saved without amp has the empty state of a disabled scaler
+        if scaler.is_enabled() and checkpoint['scaler']:
+            scaler.load_state_dict(checkpoint['scaler'])
+        restore_rng(checkpoint['rng'])
+        loss_epoch = checkpoint['loss_epoch']
+        valid_loss_min = checkpoint['valid_loss_min']
+        stale_epochs = checkpoint['stale_epochs']
+        first_epoch = checkpoint['epoch'] + 1
+        if checkpoint['stopped']:
+            first_epoch = n_epochs + 1
+        print(f'Resuming from epoch {first_epoch} of {checkpoint_path}')
     show_every = 10
     # Epoch training loop
-    for epoch in tqdm( range(1, n_epochs+1), total = n_epochs+1):
+    for epoch in tqdm( range(first_epoch, n_epochs+1), total = n_epochs+1-first_epoch):
         print(f'=== Epoch #{epoch} ===')
         # Initialize variables to monitor training and validation loss
         train_loss = 0.0
@@ -31,23 +166,19 @@ def train_2D(n_epochs, loaders, model, optimizer, criterion, train_on_gpu, path)
         print('=== Training ===')
         # Batch training loop
         for batch_idx, (data, target) in enumerate(loaders['train']):
-            # Move to GPU
-            if train_on_gpu:
-                data, target = data.cuda(), target.cuda()
+            # Move to device
+            data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            if batch_transforms is not None:
+                data, target = batch_transforms['train'](data, target)
+            data = data.contiguous(memory_format=memory_format)
             if batch_idx % show_every == 0:
                 print(f'{batch_idx + 1} / {len(loaders["train"])}...')
-            # Clear the gradients of all optimized variable
-            optimizer.zero_grad() 
-            # Forward pass (inference) to get the output
-            output = model(data) 
-            # Calculate the batch loss
-            loss = criterion(output, target) 
-            # Backpropagation
-            loss.backward() 
-            # Update weights
-            optimizer.step() 
+            loss = train_step(model, optimizer, criterion, data, target, micro_batch_size,
+                              scaler, autocast)
             # Update training loss
-            train_loss += ((1 / (batch_idx + 1)) * (loss.data - train_loss)) 
+            train_loss += ((1 / (batch_idx + 1)) * (loss - train_loss)) 
+            if on_batch is not None:
+                on_batch(epoch, batch_idx, len(loaders['train']), loss.item())
                          
         ######################    
         # validate the model #
@@ -59,15 +190,21 @@ def train_2D(n_epochs, loaders, model, optimizer, criterion, train_on_gpu, path)
             for batch_idx, (data, target) in enumerate(loaders['val']):
                 if batch_idx % show_every == 0:
                     print(f'{batch_idx + 1} / {len(loaders["val"])}...')
-                # Move to GPU 
-                if train_on_gpu:
-                    data, target = data.cuda(), target.cuda()
-                # Forward pass (inference)
-                output = model(data)
-                # Calculate the batch loss
-                loss = criterion (output, target)
+                # Move to device
+                data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+                if batch_transforms is not None:
+                    data, target = batch_transforms['val'](data, target)
+                data = data.contiguous(memory_format=memory_format)
+                # Forward pass (inference) and batch loss, in micro-batches
+                step = micro_batch_size or data.shape[0]
+                loss = 0.0
+                for start in range(0, data.shape[0], step):
+                    with autocast():
+                        output = model(data[start:start + step])
+                    loss += criterion(output.float(), target[start:start + step]) * \
+                        (output.shape[0] / data.shape[0])
                 # Update validation loss
-                valid_loss +=  ((1 / (batch_idx + 1)) * (loss.data - valid_loss))
+                valid_loss +=  ((1 / (batch_idx + 1)) * (loss - valid_loss))
         # print training/validation losses
         print('Epoch: {} \tTraining Loss: {:.4f} \tValidation Loss: {:.4f}'.format(
             epoch, 
@@ -75,17 +212,42 @@ def train_2D(n_epochs, loaders, model, optimizer, criterion, train_on_gpu, path)
             valid_loss
             ))
                 
+        valid_loss = float(valid_loss)
+        if valid_loss < valid_loss_min - min_delta:
+            stale_epochs = 0
+        else:
+            stale_epochs += 1
         if valid_loss < valid_loss_min:
             print('Validation loss decreased.  Saving model ...')            
             torch.save(model.state_dict(), path)
             valid_loss_min = valid_loss
 
-        loss_epoch.append((epoch, train_loss.cpu().detach().numpy(), valid_loss.cpu().detach().numpy()))
+        # adjust the learning rate
+        if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(valid_loss)
+        elif scheduler is not None:
+            scheduler.step()
+        stopped = patience is not None and stale_epochs >= patience
 
-    # Save the loss_epoch history
-    df=pd.DataFrame.from_records(loss_epoch, columns=['epoch', 'Training Loss', 'Validation Loss'])
-    df.to_csv('loss_epoch.csv', index=False)  
+        loss_epoch.append((epoch, float(train_loss), valid_loss))
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, model=model.state_dict(),
+                            optimizer=optimizer.state_dict(),
+                            scheduler=scheduler.state_dict() if scheduler is not None else None,
+                            scaler=scaler.state_dict(), epoch=epoch, loss_epoch=loss_epoch,
+                            valid_loss_min=valid_loss_min, stale_epochs=stale_epochs,
+                            stopped=stopped, n_epochs=n_epochs)
+        # Save the loss_epoch history
+        df=pd.DataFrame.from_records(loss_epoch, columns=['epoch', 'Training Loss', 'Validation Loss'])
+        df.to_csv(history_path, index=False)  
+        if on_epoch is not None:
+            on_epoch(epoch, float(train_loss), valid_loss)
+        if stopped:
+            print(f'No improvement for {stale_epochs} epochs, stopping early.')
+            break
 
-    # Return the trained model
+    # Return the model with the parameters of the epoch with the lowest validation loss,
+    # not those of the last epoch, which early stopping leaves patience epochs behind
+    if valid_loss_min < np.inf and os.path.exists(path):
+        model.load_state_dict(load_state_dict(path, device))
     return model
-
@@ -7,6 +7,8 @@ import torchvision.transforms.functional as TF
 import torch.nn as nn
 import random
 import numpy as np
+import math
+import torch
 
 
 class Resize(object):
@@ -99,3 +101,213 @@ class ToTensor(object):
         return TF.to_tensor(img)  
 
 
+
+
+#-----------------------------------------------------------------------#
+#                         BatchAugmentation                             #
+#  Augmentation of whole collated batches as tensors, on any device.    #
+#  It draws the same random operations as the per-sample PIL pipeline   #
+#  of DefectDetectionDataset.transform: random resized crop, color      #
+#  jitter, grayscale, resize, horizontal and vertical flips and a       #
+#  rotation by 0, -90, 90 or 180 degrees. The geometric operations are  #
+#  composed into one nearest-neighbour index map per sample, applied    #
+#  to images and masks with a single gather.                            #
+#-----------------------------------------------------------------------#
+# augment:     False to only convert the batch (validation)             #
+# scale, ratio: RandomResizedCrop parameters                            #
+# brightness, contrast, saturation, hue: ColorJitter parameters         #
+# gray:        the images are grayscale files, collated as RGB: only    #
+#              their first channel is used, saturation and hue leave    #
+#              them unchanged. Set once for the dataset, see            #
+#              DefectDetectionDataset.gray_images, rather than checked  #
+#              on every batch on the device.                            #
+#-----------------------------------------------------------------------#
+class BatchAugmentation(object):
+    def __init__(self, augment=True, scale=(0.3, 0.8), ratio=(0.5, 1.5),
+                 brightness=0.5, contrast=0.5, saturation=0.5, hue=0.5, gray=False):
+        super().__init__()
+        self.augment = augment
+        self.gray = gray
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, images, masks):
+        """
+        Args:
+            images: (B, 3, H, W) or (B, 1, H, W) uint8 tensor
+            masks:  (B, 1, H, W) uint8 tensor
+        Returns:
+            (B, 1, H, W) grayscale images and masks as float tensors in [0, 1]
+        """
+        if self.gray and images.shape[1] == 3:
+            # saturation and hue leave gray images unchanged
+            images = images[:, :1]
+        if self.augment:
+            size = images.shape[-2:]
+            params = self.random_geometry(images.shape[0], size, images.device)
+            index, valid = self.geometry(size, *params)
+            images = self.gather(images, index, valid)
+            masks = self.gather(masks, index, valid)
+        images = images.float() / 255
+        masks = masks.float() / 255
+        if self.augment:
+            images = self.color_jitter(images, valid)
+        if images.shape[1] == 3:
+            images = rgb_to_gray(images)
+        return images, masks
+
+    def crop_params(self, n, size, device):
+        # RandomResizedCrop.get_params for a whole batch: sample 10 candidates per
+        # image and keep the first one that fits, falling back to a central crop
+        height, width = size
+        area = height * width
+        tries = 10
+        target_area = area * torch.empty(n, tries, device=device).uniform_(*self.scale)
+        log_ratio = torch.log(torch.tensor(self.ratio, device=device))
+        aspect = torch.exp(torch.empty(n, tries, device=device).uniform_(*log_ratio))
+        w = torch.sqrt(target_area * aspect).round()
+        h = torch.sqrt(target_area / aspect).round()
+        fits = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = torch.argmax(fits.int(), dim=1)
+        h = h.gather(1, first[:, None])[:, 0]
+        w = w.gather(1, first[:, None])[:, 0]
+        # central crop of the ratio closest to the image when nothing fits
+        any_fits = fits.any(dim=1)
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fallback = (round(width / min(self.ratio)), width)
+        elif in_ratio > max(self.ratio):
+            fallback = (height, round(height * max(self.ratio)))
+        else:
+            fallback = (height, width)
+        h = torch.where(any_fits, h, torch.full_like(h, fallback[0]))
+        w = torch.where(any_fits, w, torch.full_like(w, fallback[1]))
+        i = torch.floor(torch.rand(n, device=device) * (height - h + 1))
+        j = torch.floor(torch.rand(n, device=device) * (width - w + 1))
+        i = torch.where(any_fits, i, (height - h) // 2)
+        j = torch.where(any_fits, j, (width - w) // 2)
+        return i, j, h, w
+
+    def random_geometry(self, n, size, device):
+        # crop rectangle, flip signs and quarter turns of every image
+        i, j, h, w = self.crop_params(n, size, device)
+        h_sign = torch.where(torch.rand(n, device=device) > 0.5, -1.0, 1.0)
+        v_sign = torch.where(torch.rand(n, device=device) > 0.5, -1.0, 1.0)
+        quarter_turns = torch.tensor([0, -1, 1, 2], device=device)[
+            torch.randint(0, 4, (n,), device=device)]
+        return i, j, h, w, h_sign, v_sign, quarter_turns
+
+    @staticmethod
+    def geometry(size, i, j, h, w, h_sign, v_sign, quarter_turns):
+        """
+        Args:
+            size:           (H, W) of the batch
+            i, j, h, w:     (B,) crop rectangles, resized back to (H, W)
+            h_sign, v_sign: (B,) -1 to flip horizontally, vertically
+            quarter_turns:  (B,) counter-clockwise rotation in quarter turns
+        Returns:
+            index: (B, H, W) flat source pixel of every output pixel
+            valid: (B, 1, 1, W) False in the columns a rotation leaves empty
+        """
+        height, width = size
+        device = i.device
+        i, j, h, w, h_sign, v_sign = [p.long()[:, None] for p in (i, j, h, w, h_sign, v_sign)]
+        cos = torch.cos(quarter_turns * math.pi / 2).round().long()[:, None]
+        sin = torch.sin(quarter_turns * math.pi / 2).round().long()[:, None]
+        # doubled pixel centres relative to the image centre, to stay in integers
+        x = 2 * torch.arange(width, device=device)[None] - (width - 1)
+        y = 2 * torch.arange(height, device=device)[None] - (height - 1)
+
+        def source(u, start, crop, length):
+            # undo the nearest resize of the crop, sampling at the pixel centres
+            u = u + (length - 1)
+            valid = (u >= 0) & (u < 2 * length)
+            return (start + (u + 1) * crop // (2 * length)).clamp(0, length - 1), valid
+
+        # Quarter turns and flips never mix the axes: without rotation the source
+        # column depends on the output column only, with a rotation by 90 degrees
+        # on the output row only. The index map is then the sum of a row map and
+        # a column map.
+        xs_x, _ = source(cos * h_sign * x, j, w, width)
+        ys_y, _ = source(cos * v_sign * y, i, h, height)
+        xs_y, _ = source(-sin * h_sign * y, j, w, width)
+        ys_x, valid_x = source(sin * v_sign * x, i, h, height)
+        turned = sin != 0
+        rows = torch.where(turned, xs_y, ys_y * width)
+        columns = torch.where(turned, ys_x * width, xs_x)
+        valid = valid_x | ~turned
+        return rows[:, :, None] + columns[:, None, :], valid[:, None, None, :]
+
+    @staticmethod
+    def gather(batch, index, valid):
+        b, c, height, width = batch.shape
+        index = index.view(b, 1, -1).expand(b, c, -1)
+        out = batch.reshape(b, c, -1).gather(2, index).view(b, c, height, width)
+        return out * valid
+
+    def color_jitter(self, images, valid):
+        # The four adjustments in a random order per image, as ColorJitter does.
+        # Brightness, contrast and saturation are blends a * x + c * gray(x) + b, so
+        # each step is one pass over the batch, with a = 1, b = c = 0 for the images
+        # that draw another adjustment at this step.
+        n = images.shape[0]
+        device = images.device
+        color = images.shape[1] == 3
+        brightness = torch.empty(n, device=device).uniform_(1 - self.brightness, 1 + self.brightness)
+        contrast = torch.empty(n, device=device).uniform_(1 - self.contrast, 1 + self.contrast)
+        saturation = torch.empty(n, device=device).uniform_(1 - self.saturation, 1 + self.saturation)
+        hue = torch.empty(n, device=device).uniform_(-self.hue, self.hue)
+        order = torch.argsort(torch.rand(n, 4, device=device), dim=1)
+        ones, zeros = torch.ones(n, device=device), torch.zeros(n, device=device)
+        count = torch.broadcast_to(valid, images[:, :1].shape).sum(dim=(1, 2, 3)).clamp(min=1)
+        for op in order.t():
+            a = torch.where(op == 0, brightness, ones)
+            b = zeros
+            if (op == 1).any():
+                # contrast around the mean gray level of the cropped image
+                gray = rgb_to_gray(images) if color else images
+                mean = (gray * valid).sum(dim=(1, 2, 3)) / count
+                a = torch.where(op == 1, contrast, a)
+                b = torch.where(op == 1, (1 - contrast) * mean, b)
+            if color and (op == 2).any():
+                a = torch.where(op == 2, saturation, a)
+                c = torch.where(op == 2, 1 - saturation, zeros)
+                b = b[:, None, None, None] + rgb_to_gray(images) * c[:, None, None, None]
+            else:
+                b = b[:, None, None, None]
+            images = torch.addcmul(b, images, a[:, None, None, None]).clamp_(0, 1)
+            selected = op == 3
+            if color and selected.any():
+                images[selected] = adjust_hue(images[selected], hue[selected][:, None, None, None])
+        return images * valid
+
+
+def rgb_to_gray(images):
+    # ITU-R 601-2 luma, as PIL's convert('L')
+    r, g, b = images.unbind(dim=1)
+    return (0.299 * r + 0.587 * g + 0.114 * b)[:, None]
+
+
+def adjust_hue(images, hue_factor):
+    """
+    Args:
+        images:     (B, 3, H, W) RGB float tensor in [0, 1]
+        hue_factor: (B, 1, 1, 1) shift of the hue, in turns
+    """
+    r, g, b = images.unbind(dim=1)
+    maxc, argmax = images.max(dim=1)
+    minc, _ = images.min(dim=1)
+    delta = maxc - minc
+    safe = delta + (delta == 0)
+    h = torch.where(argmax == 0, (g - b) / safe,
+                    torch.where(argmax == 1, (b - r) / safe + 2, (r - g) / safe + 4))
+    h = (h / 6 + hue_factor[:, 0]) % 1
+    s = delta / (maxc + (maxc == 0))
+    # HSV to RGB in closed form, one ramp per channel
+    k = (torch.tensor([5., 3., 1.], device=images.device)[None, :, None, None] + 6 * h[:, None]) % 6
+    ramp = torch.minimum(k, 4 - k).clamp(0, 1)
+    return maxc[:, None] * (1 - s[:, None] * ramp)
@@ -1,9 +1,12 @@
 #-----------------------------------------------------------------------#
 #                          Library imports                              #
 #-----------------------------------------------------------------------#
+import copy
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from collections import OrderedDict
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 #-----------------------------------------------------------------------#
@@ -34,6 +37,11 @@ from collections import OrderedDict
 #                doubles at the successive encoding steps and halves at #
 #                each decoding layer.                                   #
 # dropout_p:     dropout probability                                    #
+# return_logits: return the pre-sigmoid outputs, for the loss functions #
+#                taking logits                                          #
+# checkpointing: when training, recompute the activations inside the    #
+#                encoder, bottleneck and decoder blocks in the backward #
+#                pass instead of storing them, for a lower peak memory  #
 # mean, std:     mean and standard deviation to be used for weight      #
 #                initialization using Gaussian distribution.            #
 #                The standard deviation is the square root of (2/N),    #
@@ -41,7 +49,8 @@ from collections import OrderedDict
 #-----------------------------------------------------------------------#
 class UNet_2D(nn.Module):
     #2D UNet architecture
-    def __init__(self, in_channels=1, out_channels=1, init_features=64, dropout_p= 0.5):
+    def __init__(self, in_channels=1, out_channels=1, init_features=64, dropout_p= 0.5,
+                 return_logits=False):
         super().__init__()
         features = init_features
         
@@ -76,6 +85,9 @@ class UNet_2D(nn.Module):
         # Dropout
         self.dropout = nn.Dropout(dropout_p)
 
+        self.return_logits = return_logits
+        self.checkpointing = False
+
         self.weight_init()   
 
     @staticmethod
@@ -98,7 +110,6 @@ class UNet_2D(nn.Module):
                     # standard deviation based on a 3*3 convolution
                     std =  (2/(3*3* m.out_channels))**(0.5)
                     UNet_2D.normal_init(m, mean, std)
-                    print('initialize')
             except:
                 pass
     
@@ -122,37 +133,81 @@ class UNet_2D(nn.Module):
 
     def forward(self, x):
         # Encoding path
-        enc1 = self.encoder1(x)
+        enc1 = self.block(self.encoder1, x)
         p1 = self.dropout(self.pool(enc1))
-        enc2 = self.encoder2(p1)
+        enc2 = self.block(self.encoder2, p1)
         p2 = self.dropout(self.pool(enc2))
-        enc3 = self.encoder3(p2)
+        enc3 = self.block(self.encoder3, p2)
         p3 = self.dropout(self.pool(enc3))
-        enc4 = self.encoder4(p3)
+        enc4 = self.block(self.encoder4, p3)
         p4 = self.dropout(self.pool(enc4))
 
         # Bottleneck
-        bottleneck = self.bottleneck(p4)      
+        bottleneck = self.block(self.bottleneck, p4)      
 
         # Decoding path
         dec4 = self.dropout(self.upconv4(bottleneck))
         dec4 = torch.cat((dec4, enc4), dim=1)
-        dec4 = self.decoder4(dec4)
-        dec4 = self.dropout(self.upconv4(bottleneck))
-        dec4 = torch.cat((dec4, enc4), dim=1)
-        dec4 = self.decoder4(dec4)
+        dec4 = self.block(self.decoder4, dec4)
         dec3 = self.dropout(self.upconv3(dec4))
         dec3 = torch.cat((dec3, enc3), dim=1)
-        dec3 = self.decoder3(dec3)
+        dec3 = self.block(self.decoder3, dec3)
         dec2 = self.dropout(self.upconv2(dec3))
         dec2 = torch.cat((dec2, enc2), dim=1)
-        dec2 = self.decoder2(dec2)
+        dec2 = self.block(self.decoder2, dec2)
         dec1 = self.dropout(self.upconv1(dec2))
         dec1 = torch.cat((dec1, enc1), dim=1)
-        dec1 = self.decoder1(dec1)
+        dec1 = self.block(self.decoder1, dec1)
         #self.WS()
         # Output
-        return torch.sigmoid(self.conv(dec1))
+        logits = self.conv(dec1)
+        if self.return_logits:
+            return logits
+        return torch.sigmoid(logits)
+
+    def block(self, block, x):
+        if not (self.checkpointing and self.training and torch.is_grad_enabled()):
+            return block(x)
+        recomputing = [False]
+        def run(x):
+            if not recomputing[0]:
+                recomputing[0] = True
+                return block(x)
+            # the recomputation must not update the BatchNorm running statistics and batch
+            # counts twice, they are put back as the first pass left them
+            buffers = [buffer for m in block.modules()
+                       if isinstance(m, nn.BatchNorm2d) and m.track_running_stats
+                       for buffer in (m.running_mean, m.running_var, m.num_batches_tracked)]
+            saved = [buffer.clone() for buffer in buffers]
+            try:
+                return block(x)
+            finally:
+                with torch.no_grad():
+                    for buffer, value in zip(buffers, saved):
+                        buffer.copy_(value)
+        return torch.utils.checkpoint.checkpoint(run, x, use_reentrant=False)
+
+    # Inference-only copy: every BatchNorm is folded into the preceding convolution, with
+    # the running statistics, and Dropout is removed. The eval outputs are unchanged, up to
+    # float rounding, but each block saves the two memory passes of its BatchNorms.
+    def fuse_for_inference(self):
+        model = copy.deepcopy(self).eval()
+        for block in (model.encoder1, model.encoder2, model.encoder3, model.encoder4,
+                      model.bottleneck, model.decoder4, model.decoder3, model.decoder2,
+                      model.decoder1):
+            for conv, norm in (('conv1', 'norm1'), ('conv2', 'norm2')):
+                setattr(block, conv, fuse_conv_bn_eval(getattr(block, conv), getattr(block, norm)))
+                setattr(block, norm, nn.Identity())
+        model.dropout = nn.Identity()
+        model.fused = True
+        for p in model.parameters():
+            p.requires_grad_(False)
+        return model
+
+    def train(self, mode=True):
+        if mode and getattr(self, 'fused', False):
+            raise RuntimeError('a model fused for inference cannot be trained')
+        return super().train(mode)
 
     @staticmethod
     def _block(in_features, out_features):               
@@ -0,0 +1,311 @@
+#-----------------------------------------------------------------------#
+#                          Library imports                              #
+#-----------------------------------------------------------------------#
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torchvision.transforms
+from PIL import ImageQt
+from PyQt5.QtCore import QThread, QSize, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from batch_inference import preprocess_image, postprocess_mask
+from defects import defect_regions
+from overlay import binary_to_overlay
+from pyramid import ImagePyramid
+from tiling import tiled_inference
+from train import train_2D
+
+
+class InferenceCancelled(Exception):
+    """Raised inside a worker to abandon a cancelled job."""
+
+
+class TrainingCancelled(Exception):
+    """Raised inside a training worker to stop a cancelled training run."""
+
+
+#-----------------------------------------------------------------------#
+#                         SegmentationWorker                            #
+#  Runs the detection jobs of the GUI in a background thread, so that   #
+#  the Qt event loop never blocks on preprocessing, the forward pass or #
+#  the overlay generation. Jobs are queued and processed in order.      #
+#-----------------------------------------------------------------------#
+# Signals (all carry the job id returned by submit):                    #
+# progress:  percentage of the job done                                 #
+# result:    the mask overlay, a QImage of the requested display size,  #
+#            and the defect_regions of the mask, in pixels of the image #
+#            detected on                                                #
+# failed:    error message                                              #
+# cancelled: the job was cancelled before it finished                   #
+#-----------------------------------------------------------------------#
+class SegmentationWorker(QThread):
+    progress = pyqtSignal(int, int)
+    result = pyqtSignal(int, QImage, object)
+    failed = pyqtSignal(int, str)
+    cancelled = pyqtSignal(int)
+
+    def __init__(self, model, device, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.device = device
+        self.jobs = queue.Queue()
+        self.next_id = 0
+        self.pending_ids = set()
+        self.cancelled_ids = set()
+        self.lock = threading.Lock()
+
+    def submit(self, image, display_size, tiled=False, threshold=0.5):
+        """
+        Args:
+            image:        QImage to detect the defects in. It is copied, QPixmaps
+                          cannot be used outside the GUI thread.
+            display_size: QSize of the returned overlay
+            tiled:        run tiled_inference at the image resolution instead
+                          of resizing the image to 320x480
+        Returns:
+            id of the queued job
+        """
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.pending_ids.add(job_id)
+        self.jobs.put((job_id, image.copy(), QSize(display_size), tiled, threshold))
+        return job_id
+
+    def cancel(self, job_id=None):
+        # cancel one job, or all the pending jobs
+        with self.lock:
+            if job_id is None:
+                self.cancelled_ids |= self.pending_ids
+            elif job_id in self.pending_ids:
+                self.cancelled_ids.add(job_id)
+
+    def stop(self):
+        self.cancel()
+        self.jobs.put(None)
+        self.wait()
+
+    def checkCancelled(self, job_id):
+        with self.lock:
+            if job_id in self.cancelled_ids:
+                raise InferenceCancelled()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job_id = job[0]
+            try:
+                self.checkCancelled(job_id)
+                overlay, regions = self.segment(*job)
+            except InferenceCancelled:
+                self.cancelled.emit(job_id)
+            except Exception as e:
+                self.failed.emit(job_id, str(e))
+            else:
+                self.result.emit(job_id, overlay, regions)
+            finally:
+                with self.lock:
+                    self.pending_ids.discard(job_id)
+                    self.cancelled_ids.discard(job_id)
+
+    def segment(self, job_id, image, display_size, tiled, threshold):
+        # first transfer QImage to PIL image, and then to tensor
+        input = ImageQt.fromqimage(image).convert('L')
+        size = input.size
+        self.progress.emit(job_id, 10)
+
+        # read the model once, it may be swapped by a retraining meanwhile
+        model = self.model
+        model.eval()
+        if tiled:
+            def tile_progress(done, total):
+                self.checkCancelled(job_id)
+                self.progress.emit(job_id, 10 + 80 * done // total)
+            input = torchvision.transforms.functional.to_tensor(input)[0]
+            output = tiled_inference(model, input, self.device, progress=tile_progress)
+        else:
+            input = preprocess_image(input).unsqueeze(0).to(self.device)
+            with torch.no_grad():
+                output = model(input)[0, 0].cpu().numpy()
+        self.checkCancelled(job_id)
+        self.progress.emit(job_id, 90)
+
+        # binary mask at the image size, then the transparent overlay at the display size
+        mask = np.asarray(postprocess_mask(output, size, threshold))
+        overlay = binary_to_overlay(mask)
+        if overlay.size() != display_size:
+            overlay = overlay.scaled(display_size)
+        regions = defect_regions(mask)
+        self.progress.emit(job_id, 100)
+        return overlay, regions
+
+
+#-----------------------------------------------------------------------#
+#                           TrainingWorker                              #
+#  Runs train_2D in a background thread and streams the losses back to  #
+#  the GUI. The training can be paused and cancelled between batches.   #
+#-----------------------------------------------------------------------#
+# prepare:  callable run in the worker thread, returning a dict of the  #
+#           train_2D arguments: loaders, model, optimizer, criterion    #
+#           and optionally batch_transforms                             #
+# n_epochs, device, path: train_2D settings                             #
+# Signals:                                                              #
+# batch_loss: epoch, batch index, number of batches, training loss      #
+# epoch_loss: epoch, training loss, validation loss                     #
+# trained:    the model with the parameters of the best epoch           #
+# failed:     error message                                             #
+# cancelled:  the training was cancelled                                #
+#-----------------------------------------------------------------------#
+class TrainingWorker(QThread):
+    batch_loss = pyqtSignal(int, int, int, float)
+    epoch_loss = pyqtSignal(int, float, float)
+    trained = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, prepare, n_epochs, device, path, parent=None):
+        super().__init__(parent)
+        self.prepare = prepare
+        self.n_epochs = n_epochs
+        self.device = device
+        self.path = path
+        self.is_cancelled = False
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+        self.is_cancelled = True
+        self.resumed.set()
+
+    def checkpoint(self):
+        # block while paused, and stop when cancelled
+        self.resumed.wait()
+        if self.is_cancelled:
+            raise TrainingCancelled()
+
+    def onBatch(self, epoch, batch_idx, n_batches, loss):
+        self.batch_loss.emit(epoch, batch_idx, n_batches, loss)
+        self.checkpoint()
+
+    def onEpoch(self, epoch, train_loss, valid_loss):
+        self.epoch_loss.emit(epoch, train_loss, valid_loss)
+        self.checkpoint()
+
+    def run(self):
+        try:
+            train_args = self.prepare()
+            model = train_args['model']
+            self.checkpoint()
+            train_2D(self.n_epochs, device=self.device, path=self.path,
+                     on_batch=self.onBatch, on_epoch=self.onEpoch, **train_args)
+            model.eval()
+        except TrainingCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.trained.emit(model)
+
+
+#-----------------------------------------------------------------------#
+#                             TileWorker                                #
+#  Builds the tiles of ImagePyramids in a background thread, so that    #
+#  the viewer only draws the tiles already in the cache. Each requester #
+#  has its own pending request, which its next request replaces: only   #
+#  the tiles visible now are built, and the views sharing the worker    #
+#  are served in turn. Opening an image, decoding it and building its   #
+#  pyramid and preview, is done first.                                  #
+#-----------------------------------------------------------------------#
+# Signals:                                                              #
+# tile_ready:  pyramid, level, column and row of a tile now cached      #
+# image_ready: path, and ImagePyramid and preview QImage of the image,  #
+#              None and a null QImage when it cannot be opened          #
+#-----------------------------------------------------------------------#
+class TileWorker(QThread):
+    tile_ready = pyqtSignal(object, int, int, int)
+    image_ready = pyqtSignal(str, object, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.requests = OrderedDict()
+        self.opening = None
+        self.is_stopped = False
+        self.condition = threading.Condition()
+
+    def request(self, pyramid, keys, requester=None):
+        """
+        Args:
+            pyramid:   ImagePyramid to build the tiles of
+            keys:      (level, column, row) of the tiles, the first ones built first
+            requester: the object whose previous request this one replaces, the
+                       pyramid by default
+        """
+        requester = pyramid if requester is None else requester
+        with self.condition:
+            self.requests.pop(requester, None)
+            if keys:
+                self.requests[requester] = (pyramid, list(reversed(keys)))
+            self.condition.notify()
+
+    def open(self, path, preview_size):
+        """
+        Args:
+            path:         image file, replacing the one being opened if any
+            preview_size: QSize the preview is fitted in
+        """
+        with self.condition:
+            self.opening = (path, preview_size)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.is_stopped = True
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.requests and self.opening is None and not self.is_stopped:
+                    self.condition.wait()
+                if self.is_stopped:
+                    return
+                opening, self.opening = self.opening, None
+                if opening is None:
+                    # one tile of the oldest served requester, then it waits its turn
+                    requester, (pyramid, keys) = next(iter(self.requests.items()))
+                    key = keys.pop()
+                    if keys:
+                        self.requests.move_to_end(requester)
+                    else:
+                        del self.requests[requester]
+            if opening is not None:
+                self.openImage(*opening)
+                continue
+            pyramid.tile(*key)
+            self.tile_ready.emit(pyramid, *key)
+
+    def openImage(self, path, preview_size):
+        try:
+            image = QImage(path)
+            if image.isNull():
+                raise ValueError('cannot decode ' + path)
+            pyramid = ImagePyramid(image)
+            # the decoded image is not kept when the pyramid converted it
+            del image
+            preview = pyramid.preview(preview_size.width(), preview_size.height())
+        except Exception:
+            pyramid, preview = None, QImage()
+        self.image_ready.emit(path, pyramid, preview)